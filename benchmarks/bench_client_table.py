@@ -0,0 +1,52 @@
+"""Memory and build time of a ClientTable against a dictionary of Client
+objects from load_users, for the same generated users file.
+
+    python benchmarks/bench_client_table.py [rows]
+"""
+import csv
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mailchimp_subscriber import ClientTable, load_users  # noqa: E402
+
+
+def write_users(path, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for i in range(rows):
+            writer.writerow(['user{}@columbia.edu'.format(i), 'Jane',
+                             'Doe', 'Met at the fair', 'Staff'])
+
+
+def measure(build, path):
+    """ returns (seconds, bytes held) for building from path"""
+    start = time.perf_counter()
+    build(path)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    built = build(path)
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del built
+    return seconds, held
+
+
+def main(rows=200000):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'users.csv')
+        write_users(path, rows)
+        print('{} rows'.format(rows))
+        for name, build in (('dict of Client', load_users),
+                            ('ClientTable', ClientTable.from_csv)):
+            seconds, held = measure(build, path)
+            print('{:<15} {:6.2f}s {:8.1f} MiB {:6.0f} bytes/row'.format(
+                name, seconds, held / 1048576.0, held / rows))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,71 @@
+"""Header-resolved row projection against csv.DictReader.
+
+Both sides read the same users file, whose header uses aliases in a
+shuffled order, and produce the five COLUMNS values for every row.
+
+    python benchmarks/bench_columns.py [rows]
+"""
+import csv
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mailchimp_subscriber import (  # noqa: E402
+    COLUMNS, RowProjector, resolve_header
+)
+
+HEADER = ['Job Title', 'Surname', 'E-mail', 'Notes', 'First Name', 'Extra']
+
+
+def make_users(rows):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(HEADER)
+    for i in range(rows):
+        writer.writerow(['Staff', 'Doe', 'user{}@columbia.edu'.format(i),
+                         'Met at the fair', 'Jane', 'x'])
+    return out.getvalue()
+
+
+def projected(text):
+    reader = csv.reader(io.StringIO(text))
+    project = RowProjector(resolve_header(next(reader)))
+    return [project(row) for row in reader]
+
+
+def dict_reader(text):
+    reader = csv.DictReader(io.StringIO(text))
+    fields = resolve_header(reader.fieldnames)
+    names = {column: reader.fieldnames[fields[column]] for column in COLUMNS}
+    return [tuple(row[names[column]] for column in COLUMNS)
+            for row in reader]
+
+
+def best_of(fn, text, runs=5):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(rows=200000):
+    text = make_users(rows)
+    assert projected(text) == dict_reader(text)
+    project = best_of(projected, text)
+    dicts = best_of(dict_reader, text)
+    print('{} rows'.format(rows))
+    print('RowProjector:   {:.3f}s ({:.0f} rows/s)'.format(project,
+                                                           rows / project))
+    print('csv.DictReader: {:.3f}s ({:.0f} rows/s)'.format(dicts,
+                                                           rows / dicts))
+    print('speedup: {:.2f}x'.format(dicts / project))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,69 @@
+"""Encoding detection cost against users file size.
+
+detect_encoding only samples the head and a fixed number of strided blocks,
+so its cost should stay flat as the file grows. For comparison this also
+times chardet over the whole file, on the smaller sizes only.
+
+    python benchmarks/bench_encoding.py [max_mb]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mailchimp_subscriber import detect_encoding  # noqa: E402
+
+ROW = 'jose{}@columbia.edu,Jos\xe9,M\xfcller,Notes,Faculty\r\n'
+WHOLE_FILE_LIMIT = 4
+
+
+def write_users(path, mb, encoding):
+    rows = []
+    size = 0
+    i = 0
+    while (size < mb * 1024 * 1024):
+        row = ROW.format(i)
+        rows.append(row)
+        size += len(row)
+        i += 1
+    with open(path, 'w', encoding=encoding, newline='') as f:
+        f.write(''.join(rows))
+
+
+def best_of(fn, runs=5):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(max_mb=64):
+    import chardet
+    print('{:>8} {:>10} {:>14} {:>16}'.format(
+        'size MB', 'encoding', 'detect ms', 'whole-file ms'))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'users.csv')
+        mb = 1
+        while (mb <= max_mb):
+            for encoding in ('utf-8', 'cp1252'):
+                write_users(path, mb, encoding)
+                detected = detect_encoding(path)
+                detect = best_of(lambda: detect_encoding(path))
+                whole = ''
+                if (mb <= WHOLE_FILE_LIMIT):
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                    whole = '{:.1f}'.format(
+                        best_of(lambda: chardet.detect(data), 1) * 1000)
+                print('{:>8} {:>10} {:>14.2f} {:>16}'.format(
+                    mb, detected, detect * 1000, whole))
+            mb *= 4
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
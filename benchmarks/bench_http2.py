@@ -0,0 +1,126 @@
+"""HTTP/1.1 connection pool against HTTP/2 multiplexing, on local stand-ins.
+
+Starts two local member-lookup servers that answer every request after a
+fixed delay, standing in for Mailchimp's latency: a threaded HTTP/1.1 server
+and an asyncio HTTP/2 (h2c prior knowledge) server built on h2. The same
+number of concurrent GETs then goes through SessionTransport, capped at a
+few connections the way Mailchimp caps them, and through HTTP2Transport on
+a single connection.
+
+Needs httpx[http2] installed.
+
+    python benchmarks/bench_http2.py [requests] [threads] [latency_ms]
+"""
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import h2.config
+import h2.connection
+import h2.events
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mailchimp_subscriber import HTTP2Transport, SessionTransport  # noqa
+
+BODY = json.dumps({'status': 'subscribed',
+                   'merge_fields': {'FNAME': 'Jane', 'LNAME': 'Doe'}}).encode()
+HTTP1_CONNECTIONS = 4
+
+
+def http1_server(latency):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+class H2Protocol(asyncio.Protocol):
+    latency = 0.05
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=False))
+        self.conn.initiate_connection()
+        self.transport.write(self.conn.data_to_send())
+
+    def data_received(self, data):
+        for event in self.conn.receive_data(data):
+            if isinstance(event, h2.events.RequestReceived):
+                asyncio.ensure_future(self.respond(event.stream_id))
+            elif isinstance(event, h2.events.DataReceived):
+                self.conn.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id)
+        self.transport.write(self.conn.data_to_send())
+
+    async def respond(self, stream_id):
+        await asyncio.sleep(self.latency)
+        self.conn.send_headers(stream_id, [
+            (':status', '200'), ('content-type', 'application/json'),
+            ('content-length', str(len(BODY)))])
+        self.conn.send_data(stream_id, BODY, end_stream=True)
+        self.transport.write(self.conn.data_to_send())
+
+
+def http2_server(latency):
+    H2Protocol.latency = latency
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(
+        loop.create_server(H2Protocol, '127.0.0.1', 0))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return server.sockets[0].getsockname()[1]
+
+
+def run(transport, url, requests, threads):
+    def get(i):
+        response = transport(method='GET', url=url.format(i))
+        assert response.status_code == 200, response.status_code
+        return response.json()['status']
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        statuses = list(pool.map(get, range(requests)))
+    assert statuses == ['subscribed'] * requests
+    return time.perf_counter() - start
+
+
+def main(requests=400, threads=40, latency_ms=50):
+    latency = latency_ms / 1000.0
+    h1_url = 'http://127.0.0.1:{}/3.0/lists/1/members/{{}}'.format(
+        http1_server(latency))
+    h2_url = 'http://127.0.0.1:{}/3.0/lists/1/members/{{}}'.format(
+        http2_server(latency))
+    print('{} GETs from {} threads, {} ms server latency'.format(
+        requests, threads, latency_ms))
+    for name, transport, url in (
+            ('HTTP/1.1, {} pooled connections'.format(HTTP1_CONNECTIONS),
+             SessionTransport(HTTP1_CONNECTIONS), h1_url),
+            ('HTTP/2, 1 connection',
+             HTTP2Transport(1, prior_knowledge=True), h2_url)):
+        seconds = run(transport, url, requests, threads)
+        print('{:<32} {:6.2f}s {:8.0f} req/s'.format(
+            name, seconds, requests / seconds))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
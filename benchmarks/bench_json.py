@@ -0,0 +1,96 @@
+"""Encode and decode time per 10k members for each available JSONCodec:
+the create payloads add_users_to_mailchimp sends, the bulk bodies tagging
+sends 500 emails at a time, and the member resources lookups and mirror
+syncs get back.
+
+    python benchmarks/bench_json.py [members] [repeat]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mailchimp_subscriber import JSONCodec, SEGMENT_BATCH_SIZE  # noqa: E402
+
+
+def payloads(members):
+    return [{'email_address': 'user{}@columbia.edu'.format(i),
+             'status': 'pending',
+             'merge_fields': {'FNAME': 'Jane', 'LNAME': 'Doe-{}'.format(i)}}
+            for i in range(members)]
+
+
+def bulk_bodies(members):
+    emails = ['user{}@columbia.edu'.format(i) for i in range(members)]
+    return [{'members_to_add': emails[i:i + SEGMENT_BATCH_SIZE]}
+            for i in range(0, members, SEGMENT_BATCH_SIZE)]
+
+
+def responses(members):
+    """ member resources as Mailchimp returns them unprojected"""
+    return [{'id': '{:032x}'.format(i),
+             'email_address': 'user{}@columbia.edu'.format(i),
+             'unique_email_id': '{:010x}'.format(i),
+             'status': 'subscribed',
+             'merge_fields': {'FNAME': 'Jane', 'LNAME': 'Doe-{}'.format(i)},
+             'stats': {'avg_open_rate': 0.25, 'avg_click_rate': 0.05},
+             'ip_signup': '', 'timestamp_signup': '',
+             'ip_opt': '198.51.100.7',
+             'timestamp_opt': '2020-05-04T12:00:00+00:00',
+             'member_rating': 2,
+             'last_changed': '2020-05-04T12:00:00+00:00',
+             'language': 'en', 'vip': False,
+             'location': {'latitude': 40.8, 'longitude': -73.96,
+                          'gmtoff': -4, 'dstoff': 0, 'country_code': 'US',
+                          'timezone': 'America/New_York'},
+             'list_id': 'abc123',
+             '_links': [{'rel': 'self', 'method': 'GET',
+                         'href': 'https://us1.api.mailchimp.com/3.0/lists/'
+                                 'abc123/members/{:032x}'.format(i)}]}
+            for i in range(members)]
+
+
+def best(run, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def measure(codec, members, repeat):
+    create = payloads(members)
+    bulk = bulk_bodies(members)
+    encoded = [codec.dumps(member) for member in responses(members)]
+    return {
+        'encode create': best(lambda: [codec.dumps(p) for p in create],
+                              repeat),
+        'encode bulk': best(lambda: [codec.dumps(b) for b in bulk], repeat),
+        'decode member': best(lambda: [codec.loads(e) for e in encoded],
+                              repeat),
+    }
+
+
+def main(members=10000, repeat=5):
+    codecs = [JSONCodec('json')]
+    try:
+        codecs.append(JSONCodec('orjson'))
+    except ImportError:
+        print('orjson is not installed, timing the stdlib codec only')
+    print('ms per {} members (best of {})'.format(members, repeat))
+    results = [(codec.name, measure(codec, members, repeat))
+               for codec in codecs]
+    for task in results[0][1]:
+        line = '{:<14}'.format(task)
+        for name, timings in results:
+            line += ' {:>7} {:7.2f}'.format(name, timings[task] * 1000)
+        if (len(results) > 1):
+            line += '  {:5.1f}x'.format(
+                results[0][1][task] / results[-1][1][task])
+        print(line)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,65 @@
+"""Cold start benchmark for mailchimp_subscriber.
+
+Runs `python -X importtime -c "import mailchimp_subscriber"` in fresh
+interpreters, prints the slowest imports by cumulative time, then times a
+whole network-free invocation (--plan) end to end.
+
+    python benchmarks/bench_startup.py [runs]
+"""
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOP = 15
+
+
+def importtime():
+    """ returns (cumulative_us, self_us, module) rows for a cold import"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import mailchimp_subscriber'],
+        cwd=ROOT, stderr=subprocess.PIPE, universal_newlines=True,
+        check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if (not line.startswith('import time:') or 'self [us]' in line):
+            continue
+        own, cumulative, module = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), int(own), module.rstrip()))
+    return rows
+
+
+def time_invocation(argv, runs):
+    """ returns the best wall time of running the script with argv"""
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, 'mailchimp_subscriber.py'] + argv,
+                       cwd=ROOT, stdout=subprocess.DEVNULL, check=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(runs=5):
+    rows = importtime()
+    total = [row for row in rows if row[2].strip() == 'mailchimp_subscriber']
+    print('import mailchimp_subscriber: {:.1f} ms cumulative'.format(
+        total[0][0] / 1000.0))
+    loaded = {row[2].strip() for row in rows}
+    for heavy in ('requests', 'urllib3', 'mailchimp3', 'sqlite3'):
+        print('  {} imported at startup: {}'.format(heavy, heavy in loaded))
+    print('slowest imports (cumulative us, self us):')
+    for cumulative, own, module in sorted(rows, reverse=True)[:TOP]:
+        print('{:>10} {:>10} {}'.format(cumulative, own, module))
+
+    wall = time_invocation(['--plan', 'tests/test.conf',
+                            'tests/test-user-list.csv'], runs)
+    print('--plan invocation, best of {}: {:.1f} ms'.format(
+        runs, wall * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
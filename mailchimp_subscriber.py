@@ -1,12 +1,91 @@
 import sys
+import argparse
 import configparser
+import contextlib
 import re
 import hashlib
-import requests
+import heapq
+import io
 import csv
+import functools
 import time
+import array
+import codecs
+import collections
+import itertools
 import json
-from mailchimp3 import MailChimp
+import mmap
+import operator
+import os
+import queue
+import struct
+import tempfile
+import threading
+import types
+import importlib.util
+from collections import Counter
+
+
+# held while a lazy module is loaded, and the ids of those being loaded
+_lazy_load = threading.RLock()
+_lazy_loading = set()
+
+
+class _LazyModule(types.ModuleType):
+    """A module that runs its import the first time one of its attributes
+    is used. Other threads wait behind a lock until it is fully loaded: with
+    importlib.util.LazyLoader (before 3.12) two threads touching it first
+    at once could both run the import, or one see it half initialized. The
+    loading thread itself reads it as a plain module meanwhile."""
+    def __getattribute__(self, attr):
+        get = types.ModuleType.__getattribute__
+        with _lazy_load:
+            if (type(self) is _LazyModule and id(self) not in _lazy_loading):
+                _lazy_loading.add(id(self))
+                try:
+                    get(self, '__spec__').loader.exec_module(self)
+                    self.__class__ = types.ModuleType
+                finally:
+                    _lazy_loading.discard(id(self))
+        return get(self, attr)
+
+
+def lazy_import(name):
+    """Returns the named module, deferring the actual import until one of
+    its attributes is used. Keeps the network stack (requests, urllib3, ...)
+    and other heavy modules off the startup path of runs that never need
+    them."""
+    if (name in sys.modules):
+        return sys.modules[name]
+    module = importlib.util.module_from_spec(importlib.util.find_spec(name))
+    module.__class__ = _LazyModule
+    sys.modules[name] = module
+    return module
+
+
+requests = lazy_import('requests')
+sqlite3 = lazy_import('sqlite3')
+
+
+def MailChimp(*args, **kwargs):
+    """mailchimp3.MailChimp, imported the first time a client is needed"""
+    from mailchimp3 import MailChimp
+    return MailChimp(*args, **kwargs)
+
+
+def ProcessPoolExecutor(*args, **kwargs):
+    """concurrent.futures.ProcessPoolExecutor, imported the first time a
+    pool is needed"""
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(*args, **kwargs)
+
+
+def api_error():
+    """mailchimp3's MailChimpError, which it raises for every response of
+    400 or over. Imported when first caught, like MailChimp"""
+    from mailchimp3.mailchimpclient import MailChimpError
+    return MailChimpError
+
 
 # Configuration Global
 CONFIG = ''
@@ -19,6 +98,35 @@ INTERACTION_NOTES_COL = 3
 JOB_ROLE_COL = 4
 COLUMNS = ['email_address', 'first_name', 'last_name', 'interaction_notes',
            'job_role']
+REQUIRED_COLUMNS = COLUMNS[:3]
+# Header names a users file may use for each of the COLUMNS, compared after
+# lower casing and turning underscores and dashes into spaces
+COLUMN_ALIASES = {
+    'email_address': ('email address', 'email', 'e mail', 'mail'),
+    'first_name': ('first name', 'firstname', 'fname', 'given name'),
+    'last_name': ('last name', 'lastname', 'lname', 'surname',
+                  'family name'),
+    'interaction_notes': ('interaction notes', 'notes', 'interactions'),
+    'job_role': ('job role', 'role', 'job title', 'title')}
+# Member statuses as stored in a DigestIndex, coded by their position
+STATUS_CODES = ['', 'subscribed', 'unsubscribed', 'cleaned', 'pending',
+                'transactional', 'archived', 'not_present']
+# Mailchimp caps members_to_add at 500 emails per static segment call
+SEGMENT_BATCH_SIZE = 500
+# all a status lookup needs of the member resource
+MEMBER_FIELDS = 'status,merge_fields'
+# the files of write_users_by_status. invalid takes bad addresses and any
+# other status: transactional, archived, or unknown after a deferred lookup
+STATUS_FILES = ('subscribed', 'unsubscribed', 'cleaned', 'pending',
+                'not_present', 'invalid')
+# the columns load_users interns by default, those that repeat the most
+INTERN_COLUMNS = ('first_name', 'interaction_notes', 'job_role')
+# how many times external_dedup splits a bucket that is still too big
+MAX_SPLIT_DEPTH = 8
+# archive operations sent per Mailchimp batch
+ARCHIVE_BATCH_SIZE = 500
+# an email_hash in hex, the record external_sort_hashes spills to disk
+HASH_RECORD = 32
 
 
 def validate_email(email_address):
@@ -27,6 +135,76 @@ def validate_email(email_address):
     return match is not None
 
 
+def member_hash(email_address):
+    """ returns the id Mailchimp gives the member with an address: the MD5
+    of the lowercased address"""
+    return hashlib.md5(email_address.strip().lower().encode('utf-8'))\
+        .hexdigest()
+
+
+def fields_digest(fields):
+    """ returns 4 bytes of the MD5 of the FNAME and LNAME merge fields, all a
+    DigestIndex keeps of a member's fields"""
+    return hashlib.md5('\0'.join(
+        str(fields.get(field) or '') for field in ('FNAME', 'LNAME'))
+        .encode('utf-8')).digest()[:4]
+
+
+class JSONCodec:
+    """The JSON encoder and decoder for request bodies, responses and member
+    payloads: orjson when it is installed (an optional dependency: pip
+    install orjson) and the JSONCodec conf value allows it, the standard
+    library otherwise. dumps returns UTF-8 bytes, loads takes str or
+    bytes."""
+    def __init__(self, name='auto'):
+        if (name not in ('auto', 'orjson', 'json')):
+            raise ValueError('Unknown JSONCodec {}'.format(name))
+        self.name = 'json'
+        self.dumps = self._stdlib_dumps
+        self.loads = json.loads
+        if (name != 'json'):
+            try:
+                import orjson
+            except ImportError:
+                if (name == 'orjson'):
+                    raise ImportError('JSONCodec = orjson needs orjson '
+                                      'installed')
+            else:
+                self.name = 'orjson'
+                self.dumps = orjson.dumps
+                self.loads = orjson.loads
+
+    @staticmethod
+    def _stdlib_dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def wrap(self, make_request):
+        """ returns make_request with its JSON body encoded, and the JSON
+        of its response decoded, by this codec rather than by requests"""
+        def encoded(**kwargs):
+            body = kwargs.pop('json', None)
+            if (body is not None):
+                kwargs['data'] = self.dumps(body)
+                kwargs['headers'] = dict(kwargs.get('headers') or {})
+                kwargs['headers']['Content-Type'] = 'application/json'
+            response = make_request(**kwargs)
+            response.json = functools.partial(self.loads, response.content)
+            return response
+        return encoded
+
+
+_json_codecs = {}
+
+
+def json_codec(name=None):
+    """ returns the JSONCodec for name, by default the configured one"""
+    if (name is None):
+        name = CONFIG.get('JSONCodec', 'auto') if CONFIG else 'auto'
+    if (name not in _json_codecs):
+        _json_codecs[name] = JSONCodec(name)
+    return _json_codecs[name]
+
+
 class Client:
     """Client is a representation of a CTL client"""
     def __new__(cls, email, first_name, last_name, **kwargs):
@@ -42,6 +220,7 @@ class Client:
         self.last_name = last_name.strip().replace(",", "")
         self.interaction_notes = ''
         self.job_role = ''
+        self.source = ''
         for key, value in kwargs.items():
             if (key == 'interaction_notes'):
                 self.interaction_notes = kwargs['interaction_notes']\
@@ -50,9 +229,9 @@ class Client:
             if (key == 'job_role'):
                 self.job_role = kwargs['job_role'].strip().replace(",", "")
 
-        self.email_hash = hashlib.md5(self.email_address.encode('utf-8'))\
-            .hexdigest()
+        self.email_hash = member_hash(self.email_address)
         self.mailchimp_status = ""
+        self.mailchimp_fields = dict()
 
     def __repr__(self):
         return '<Client: email_mail: {} first_name: {} last_name: {} >'\
@@ -65,22 +244,858 @@ class Client:
                 'interaction_notes': self.interaction_notes,
                 'job_role': self.job_role}
 
+    def get_mc_fields(self):
+        """ returns the merge fields Mailchimp should hold for this client"""
+        return {'FNAME': self.first_name,
+                'LNAME': self.last_name}
+
     def get_mc_fields_json(self):
         """ returns a JSON string to be used as the data payload
         for the Mailchimp API."""
-        values = {'FNAME': self.first_name,
-                  'LNAME': self.last_name}
-        return json.dumps(values)
+        return json_codec().dumps(self.get_mc_fields()).decode('utf-8')
+
+    def get_mc_fields_diff(self):
+        """ returns only the merge fields whose value differs from what
+        set_mailchimp_status found on Mailchimp"""
+        fields = self.get_mc_fields()
+        if (isinstance(self.mailchimp_fields, bytes)):
+            # only a fields_digest, from a DigestIndex
+            if (fields_digest(fields) == self.mailchimp_fields):
+                return {}
+            return fields
+        return {field: value for field, value in fields.items()
+                if self.mailchimp_fields.get(field) != value}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Mailchimp while the circuit breaker is
+    open"""
+
+
+class CircuitBreaker:
+    """Shared by every API call a MailChimp client makes (see
+    make_mc_client). Opens after `failures` consecutive 5xx or timeout
+    responses, or once `error_rate` of the last `window` calls failed. While
+    open, calls fail fast with CircuitOpenError, or with pause=True wait
+    instead; after reset_seconds a single half-open probe is let through and
+    its outcome closes or reopens the circuit. Clients that couldn't be
+    looked up or written because of it are kept in `deferred` for a
+    retry."""
+    def __init__(self, failures=5, error_rate=0.5, window=20,
+                 reset_seconds=30, pause=False):
+        self.failures = failures
+        self.error_rate = error_rate
+        self.outcomes = collections.deque(maxlen=window)
+        self.reset_seconds = reset_seconds
+        self.pause = pause
+        self.state = 'closed'
+        self.consecutive = 0
+        self.opened_at = 0
+        self.trips = 0
+        self.deferred = []
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        """ returns once a call may go ahead"""
+        while (True):
+            with self.lock:
+                if (self.state == 'closed'):
+                    return
+                if (self.state == 'open'):
+                    wait = self.opened_at + self.reset_seconds - time.time()
+                    if (wait <= 0):
+                        # this call is the probe
+                        self.state = 'half_open'
+                        return
+                else:
+                    # a probe is already out
+                    wait = min(1.0, self.reset_seconds)
+                if (not self.pause):
+                    raise CircuitOpenError('Mailchimp circuit ' + self.state)
+            time.sleep(wait)
+
+    def record(self, ok):
+        with self.lock:
+            self.outcomes.append(ok)
+            self.consecutive = 0 if ok else self.consecutive + 1
+            if (ok and self.state == 'half_open'):
+                self.state = 'closed'
+                self.outcomes.clear()
+            elif (not ok and self._should_open()):
+                self.state = 'open'
+                self.opened_at = time.time()
+                self.trips += 1
+
+    def _should_open(self):
+        if (self.state == 'half_open' or self.consecutive >= self.failures):
+            return True
+        failed = self.outcomes.count(False)
+        return (len(self.outcomes) == self.outcomes.maxlen and
+                failed >= self.error_rate * len(self.outcomes))
+
+    def wrap(self, make_request):
+        """ returns make_request guarded by the breaker"""
+        def guarded(**kwargs):
+            self.before_call()
+            try:
+                response = make_request(**kwargs)
+            except Exception:
+                # a timeout, a dropped connection or a garbled response;
+                # a half-open probe must settle the state whatever it was
+                self.record(False)
+                raise
+            self.record(response.status_code < 500)
+            return response
+        return guarded
+
+
+class AdaptiveLimit:
+    """Additive increase, multiplicative decrease control of the calls in
+    flight, between minimum and maximum. Each call that comes back at a
+    steady latency raises the limit by 1/limit, so by about one per round
+    of calls. A 429, a failed call or a latency over `spike` times the
+    running average cuts it by `backoff`, at most once per round, since the
+    calls already in flight saw the same conditions. Throttled calls aren't
+    sent again here: a 429 goes on up like a 5xx, and its client is
+    deferred (see is_server_error), so every attempt is a call of its own
+    to TraceLog and the rest. `history` holds (seconds, limit) at every
+    change of the whole limit."""
+    def __init__(self, initial=1, maximum=16, minimum=1, backoff=0.5,
+                 spike=2.0):
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.maximum = maximum
+        self.minimum = minimum
+        self.backoff = backoff
+        self.spike = spike
+        self.inflight = 0
+        self.average = None
+        self.completed = 0
+        self.last_cut = None
+        self.throttled = 0
+        self.spikes = 0
+        self.start = time.time()
+        self.history = [(0.0, int(self.limit))]
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while (self.inflight >= int(self.limit)):
+                self.condition.wait()
+            self.inflight += 1
+
+    def release(self, latency=None):
+        """ ends a call, with latency None for a throttled or failed one"""
+        with self.condition:
+            self.inflight -= 1
+            self.completed += 1
+            congested = latency is None
+            if (not congested):
+                congested = (self.average is not None and
+                             latency > self.spike * self.average)
+                self.spikes += congested
+                self.average = (latency if self.average is None else
+                                0.9 * self.average + 0.1 * latency)
+            if (not congested):
+                self._set(self.limit + 1.0 / self.limit)
+            elif (self.last_cut is None or
+                  self.completed - self.last_cut >= self.limit):
+                self.last_cut = self.completed
+                self._set(self.limit * self.backoff)
+            self.condition.notify_all()
+
+    def _set(self, limit):
+        limit = max(self.minimum, min(limit, self.maximum))
+        if (int(limit) != int(self.limit)):
+            self.history.append((time.time() - self.start, int(limit)))
+        self.limit = limit
+
+    def wrap(self, make_request):
+        """ returns make_request run within the limit"""
+        def limited(**kwargs):
+            self.acquire()
+            start = time.perf_counter()
+            # a call that raised, whatever it raised, counts as congested
+            latency = None
+            try:
+                response = make_request(**kwargs)
+                if (response.status_code == 429):
+                    self.throttled += 1
+                else:
+                    latency = time.perf_counter() - start
+                return response
+            finally:
+                self.release(latency)
+        return limited
+
+
+def format_concurrency(limiter, points=12):
+    """ returns the limit an AdaptiveLimit chose over the run, at up to
+    `points` of its changes"""
+    history = limiter.history
+    if (len(history) > points):
+        step = (len(history) - 1) / (points - 1)
+        history = [history[round(i * step)] for i in range(points)]
+    return ('concurrency: limit {} (range {}-{}), {} throttled, {} latency '
+            'spikes; over time {}'.format(
+                int(limiter.limit), min(limit for _, limit in limiter.history),
+                max(limit for _, limit in limiter.history), limiter.throttled,
+                limiter.spikes, ' '.join('{:.0f}s={}'.format(seconds, limit)
+                                         for seconds, limit in history)))
+
+
+def requests_response(status_code, content, headers, url):
+    """ wraps a raw HTTP response as a requests.Response, which is what
+    mailchimp3 and the error handling here expect"""
+    response = requests.models.Response()
+    response.status_code = status_code
+    response._content = content
+    response.headers = requests.structures.CaseInsensitiveDict(headers)
+    response.url = url
+    response.encoding = 'utf-8'
+    return response
+
+
+# the member and connection phases of the call in flight on each thread,
+# for TraceLog
+_trace = threading.local()
+
+
+def trace_phases():
+    """ returns the dictionary the call in flight on this thread records
+    its phase timings in, or None when it isn't being traced"""
+    return getattr(_trace, 'phases', None)
+
+
+@contextlib.contextmanager
+def traced_member(email_hash):
+    """Attributes the calls made inside the block to a member in the trace
+    log"""
+    _trace.email_hash = email_hash
+    try:
+        yield
+    finally:
+        _trace.email_hash = None
+
 
+class TimedConnection:
+    """Mixin for urllib3 connections that records the DNS, connect and TLS
+    time of the connections traced calls open. Resolving first and
+    connecting to the address found is what splits DNS from connect."""
+    tls = False
 
-def set_mailchimp_status(client, mc_client, list_id):
+    def _new_conn(self):
+        import socket
+        phases = trace_phases()
+        if (phases is None):
+            return super()._new_conn()
+        host = self._dns_host
+        start = time.perf_counter()
+        try:
+            address = socket.getaddrinfo(host, self.port, 0,
+                                         socket.SOCK_STREAM)[0][4][0]
+        except OSError:
+            # let urllib3 fail the way it normally does
+            return super()._new_conn()
+        resolved = time.perf_counter()
+        self._dns_host = address
+        try:
+            conn = super()._new_conn()
+        finally:
+            self._dns_host = host
+        phases['dns'] = resolved - start
+        phases['connect'] = time.perf_counter() - resolved
+        return conn
+
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        phases = trace_phases()
+        if (self.tls and phases is not None and 'connect' in phases):
+            phases['tls'] = (time.perf_counter() - start - phases['dns'] -
+                             phases['connect'])
+
+
+def timed_pool_classes():
+    """ returns urllib3 connection pool classes, by scheme, whose
+    connections are TimedConnections"""
+    import urllib3
+    pools = {}
+    for scheme, pool in (('http', urllib3.HTTPConnectionPool),
+                         ('https', urllib3.HTTPSConnectionPool)):
+        connection = type('Timed' + pool.ConnectionCls.__name__,
+                          (TimedConnection, pool.ConnectionCls),
+                          {'tls': scheme == 'https'})
+        pools[scheme] = type('Timed' + pool.__name__, (pool,),
+                             {'ConnectionCls': connection})
+    return pools
+
+
+class SessionTransport:
+    """HTTP/1.1 over one pooled requests.Session, instead of the new
+    connection mailchimp3 opens for every call"""
+    def __init__(self, connections=10):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=connections, pool_block=True)
+        adapter.poolmanager.pool_classes_by_scheme = timed_pool_classes()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def __call__(self, **kwargs):
+        return self.session.request(**kwargs)
+
+
+class HTTP2Transport:
+    """HTTP/2 through httpx (an optional dependency: pip install
+    httpx[http2]), multiplexing concurrent requests as streams over a few
+    connections. prior_knowledge speaks HTTP/2 to plain http:// servers,
+    which is only for local stand-ins."""
+    def __init__(self, connections=2, prior_knowledge=False, client=None):
+        try:
+            import httpx
+        except ImportError:
+            raise ImportError('Transport = http2 needs httpx[http2] '
+                              'installed')
+        self.httpx = httpx
+        self.client = client or httpx.Client(
+            http1=not prior_knowledge, http2=True,
+            limits=httpx.Limits(max_connections=connections))
+
+    def __call__(self, method, url, json=None, data=None, auth=None,
+                 timeout=None, hooks=None, headers=None):
+        if (auth is not None):
+            auth = (auth.username, auth.password)
+        phases = trace_phases()
+        extensions = None
+        if (phases is not None):
+            extensions = {'trace': self._tracer(phases, time.perf_counter())}
+        try:
+            response = self.client.request(method, url, json=json,
+                                           content=data, auth=auth,
+                                           timeout=timeout,
+                                           headers=dict(headers or {}),
+                                           extensions=extensions)
+        except self.httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e))
+        except self.httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e))
+        return requests_response(response.status_code, response.content,
+                                 response.headers, str(response.url))
+
+    @staticmethod
+    def _tracer(phases, start):
+        """ returns an httpcore trace callback recording the connect (DNS
+        included), TLS and time to first byte of a call into phases"""
+        started = {}
+
+        def trace(event, info):
+            now = time.perf_counter()
+            step, _, state = event.rpartition('.')
+            if (state == 'started'):
+                started[step] = now
+            elif (step == 'connection.connect_tcp'):
+                phases['connect'] = now - started.get(step, now)
+            elif (step == 'connection.start_tls'):
+                phases['tls'] = now - started.get(step, now)
+            elif (step.endswith('.receive_response_headers')):
+                phases['ttfb'] = now - start
+        return trace
+
+
+def make_transport(name, connections=10):
+    """ returns the _make_request replacement for a Transport conf value,
+    or None to keep mailchimp3's own"""
+    if (name == 'http1'):
+        return SessionTransport(connections)
+    if (name == 'http2'):
+        return HTTP2Transport(connections)
+    if (name not in ('', 'requests')):
+        raise ValueError('Unknown Transport {}'.format(name))
+    return None
+
+
+def endpoint_name(method, url):
+    """ returns the method and API path of a url with the ids in it
+    replaced, e.g. 'GET lists/{id}/members/{id}'. Mailchimp paths alternate
+    collection and id"""
+    path = url.split('?', 1)[0].split('/3.0/', 1)[-1].strip('/').split('/')
+    return '{} {}'.format(method, '/'.join(
+        part if i % 2 == 0 else '{id}' for i, part in enumerate(path)))
+
+
+def response_wire_size(response):
+    """ returns the bytes a response body took on the wire, which for a
+    gzipped body is less than len(response.content)"""
+    raw = getattr(response, 'raw', None)
+    if (hasattr(raw, 'tell')):
+        return raw.tell()
+    length = response.headers.get('Content-Length')
+    return int(length) if length else len(response.content)
+
+
+class TrafficMeter:
+    """Counts the calls and bytes sent and received per endpoint (see
+    endpoint_name) for every call a MailChimp client makes. Request bytes
+    are the url, headers and JSON body; response bytes are as sent on the
+    wire, with the decoded size alongside to show what gzip saved."""
+    COLUMNS = ('endpoint', 'calls', 'sent', 'received', 'decoded')
+
+    def __init__(self):
+        self.endpoints = collections.defaultdict(Counter)
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, sent, received=0, decoded=0):
+        with self.lock:
+            self.endpoints[endpoint].update(
+                {'calls': 1, 'sent': sent, 'received': received,
+                 'decoded': decoded})
+
+    def totals(self):
+        total = Counter()
+        for counts in self.endpoints.values():
+            total.update(counts)
+        return total
+
+    def wrap(self, make_request):
+        """ returns make_request with its traffic counted"""
+        def metered(**kwargs):
+            endpoint = endpoint_name(kwargs['method'], kwargs['url'])
+            sent = len(kwargs['url']) + sum(
+                len(key) + len(value) + 4
+                for key, value in (kwargs.get('headers') or {}).items())
+            if (kwargs.get('data') is not None):
+                sent += len(kwargs['data'])
+            elif (kwargs.get('json') is not None):
+                sent += len(json.dumps(kwargs['json']).encode('utf-8'))
+            try:
+                response = make_request(**kwargs)
+            except requests.exceptions.RequestException:
+                self.record(endpoint, sent)
+                raise
+            self.record(endpoint, sent, response_wire_size(response),
+                        len(response.content))
+            return response
+        return metered
+
+    def write(self, filename):
+        """ writes the counts per endpoint out to a csv file"""
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.COLUMNS)
+            for endpoint, counts in sorted(self.endpoints.items()):
+                writer.writerow([endpoint] + [counts[column] for column in
+                                              self.COLUMNS[1:]])
+
+
+class TraceLog:
+    """Appends a JSON line per API call to path: start time, the member it
+    was made for (see traced_member), method, endpoint, the DNS, connect,
+    TLS, time to first byte and total durations in ms, status, urllib3
+    retries and the request and response bytes. Phases the transport can't
+    time are null; a null connect on Transport = http1 or http2 means the
+    call reused a connection. Records are queued and written out by a
+    background thread, so calls only pay for building them."""
+    PHASES = ('dns', 'connect', 'tls', 'ttfb')
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        self.writer.start()
+
+    def _write(self):
+        dumps = json_codec().dumps
+        with open(self.path, 'ab') as f:
+            while (True):
+                record = self.queue.get()
+                if (record is None):
+                    return
+                f.write(dumps(record) + b'\n')
+
+    def wrap(self, make_request):
+        """ returns make_request with every call traced"""
+        def traced(**kwargs):
+            started = time.time()
+            phases = _trace.phases = {}
+            start = time.perf_counter()
+            response = None
+            try:
+                response = make_request(**kwargs)
+                return response
+            finally:
+                total = time.perf_counter() - start
+                _trace.phases = None
+                self.record(kwargs, started, total, phases, response)
+        return traced
+
+    def record(self, kwargs, started, total, phases, response):
+        if (response is not None and 'ttfb' not in phases):
+            # requests times the call up to its parsed headers
+            phases['ttfb'] = response.elapsed.total_seconds()
+        retries = getattr(getattr(getattr(response, 'raw', None), 'retries',
+                                  None), 'history', ())
+        record = {'t': round(started, 3),
+                  'email_hash': getattr(_trace, 'email_hash', None),
+                  'method': kwargs['method'],
+                  'endpoint': endpoint_name(kwargs['method'], kwargs['url'])}
+        for phase in self.PHASES:
+            record[phase] = (round(phases[phase] * 1000, 2)
+                             if phase in phases else None)
+        record.update(
+            total=round(total * 1000, 2),
+            status=response.status_code if response is not None else None,
+            retries=len(retries),
+            sent=len(kwargs.get('data') or b''),
+            received=(response_wire_size(response)
+                      if response is not None else 0))
+        self.queue.put(record)
+
+    def close(self):
+        """ writes out the records still queued"""
+        self.queue.put(None)
+        self.writer.join()
+
+
+def make_mc_client(mc_user, mc_key):
+    """ returns a MailChimp client using the configured Transport, whose
+    requests all go through a CircuitBreaker configured from CONFIG (and
+    with AdaptiveConcurrency, an AdaptiveLimit) and have their traffic
+    counted by a TrafficMeter"""
+    mc_client = MailChimp(mc_api=mc_key, mc_user=mc_user)
+    # mailchimp3 sends these headers with every call, whatever transport
+    mc_client.request_headers['Accept-Encoding'] = 'gzip'
+    transport = make_transport(CONFIG.get('Transport', ''),
+                               CONFIG.get('Connections', 10))
+    if (transport is not None):
+        mc_client._make_request = transport
+    mc_client.trace = None
+    if (CONFIG.get('TraceFile')):
+        mc_client.trace = TraceLog(CONFIG['TraceFile'])
+        mc_client._make_request = mc_client.trace.wrap(
+            mc_client._make_request)
+    traffic = TrafficMeter()
+    mc_client._make_request = json_codec().wrap(
+        traffic.wrap(mc_client._make_request))
+    mc_client.traffic = traffic
+    mc_client.limiter = None
+    if (CONFIG.get('AdaptiveConcurrency')):
+        mc_client.limiter = AdaptiveLimit(CONFIG.get('Concurrency', 1),
+                                          CONFIG.get('MaxConcurrency', 16))
+        mc_client._make_request = mc_client.limiter.wrap(
+            mc_client._make_request)
+    breaker = CircuitBreaker(
+        failures=CONFIG.get('BreakerFailures', 5),
+        error_rate=CONFIG.get('BreakerErrorRate', 0.5),
+        window=CONFIG.get('BreakerWindow', 20),
+        reset_seconds=CONFIG.get('BreakerResetSeconds', 30),
+        pause=CONFIG.get('BreakerPause', False))
+    mc_client._make_request = breaker.wrap(mc_client._make_request)
+    mc_client.breaker = breaker
+    return mc_client
+
+
+def error_status(error):
+    """ returns the HTTP status of a MailChimpError, which mailchimp3 raises
+    with a dictionary of the response and its JSON error body, if any"""
+    details = error.args[0] if error.args else None
+    if (not isinstance(details, dict)):
+        return None
+    response = details.get('response')
+    if (response is not None):
+        return response.status_code
+    return details.get('status')
+
+
+def is_server_error(error):
+    """Whether a MailChimpError is Mailchimp failing or throttling (429)
+    rather than answering"""
+    status = error_status(error)
+    return isinstance(status, int) and (status >= 500 or status == 429)
+
+
+def defer_client(mc_client, client):
+    """Note a client the circuit breaker kept from being handled"""
+    breaker = getattr(mc_client, 'breaker', None)
+    if (isinstance(breaker, CircuitBreaker)):
+        breaker.deferred.append(client)
+
+
+def write_traffic(mc_client, filename=None):
+    """ writes the traffic counted for mc_client out to the configured
+    TrafficFile, if any, and finishes its trace log. Returns the total bytes
+    sent and received"""
+    trace = getattr(mc_client, 'trace', None)
+    if (isinstance(trace, TraceLog)):
+        trace.close()
+    traffic = getattr(mc_client, 'traffic', None)
+    if (not isinstance(traffic, TrafficMeter)):
+        return Counter()
+    filename = filename or CONFIG.get('TrafficFile')
+    if (filename):
+        traffic.write(filename)
+    totals = traffic.totals()
+    return Counter({'bytes_sent': totals['sent'],
+                    'bytes_received': totals['received']})
+
+
+def write_deferred_clients(mc_client, filename=None):
+    """ writes the clients deferred by the circuit breaker out to a csv
+    file that can be fed back in as a users file. Returns how many"""
+    breaker = getattr(mc_client, 'breaker', None)
+    if (not isinstance(breaker, CircuitBreaker) or not breaker.deferred):
+        return 0
+    if (filename is None):
+        filename = 'Retry Clients ' + time.asctime() + '.csv'
+    return write_clients(breaker.deferred, filename)
+
+
+def set_mailchimp_status(client, mc_client, list_id, mirror=None):
     """Takes in a client object and checks that persons status on Mailchimp.
-    It then assigns that value back to the client object"""
+    It then assigns that value back to the client object. When given a
+    synced ListMirror or DigestIndex it answers from that instead of calling
+    the API"""
+    if (mirror is not None):
+        member = mirror.get(client.email_hash)
+        if (member is None):
+            client.mailchimp_status = 'not_present'
+        else:
+            client.mailchimp_status, client.mailchimp_fields = member
+        return
+
     try:
-        status = mc_client.lists.members.get(list_id, client.email_hash)
+        with traced_member(client.email_hash):
+            status = mc_client.lists.members.get(list_id, client.email_hash,
+                                                 fields=MEMBER_FIELDS)
         client.mailchimp_status = status['status']
-    except requests.exceptions.HTTPError:
-        client.mailchimp_status = 'not_present'
+        client.mailchimp_fields = status.get('merge_fields', {})
+    except (CircuitOpenError, requests.exceptions.RequestException):
+        # no answer at all, e.g. a timeout, says nothing either
+        defer_client(mc_client, client)
+    except api_error() as e:
+        if (is_server_error(e)):
+            # an outage says nothing about whether they are on the list
+            defer_client(mc_client, client)
+        else:
+            client.mailchimp_status = 'not_present'
+
+
+class ListMirror:
+    """A local SQLite copy of a list's members (hash, status, merge fields
+    and last_changed). Each sync only fetches the members changed since the
+    newest last_changed it has already seen."""
+    FIELDS = ('members.id,members.status,members.merge_fields,'
+              'members.last_changed')
+
+    def __init__(self, path, list_id):
+        self.path = path
+        self.list_id = list_id
+        # shared with the lookup threads of pipeline_users, behind self.lock
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute('CREATE TABLE IF NOT EXISTS members ('
+                        'list_id TEXT, hash TEXT, status TEXT, '
+                        'merge_fields TEXT, last_changed TEXT, '
+                        'PRIMARY KEY (list_id, hash))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS watermarks ('
+                        'list_id TEXT PRIMARY KEY, last_changed TEXT)')
+
+    @property
+    def watermark(self):
+        row = self.db.execute('SELECT last_changed FROM watermarks WHERE '
+                              'list_id = ?', (self.list_id,)).fetchone()
+        return row[0] if row else None
+
+    def sync(self, mc_client):
+        """Pull the members changed since the watermark into the mirror.
+        Returns the number of members fetched"""
+        params = {'get_all': True, 'fields': self.FIELDS}
+        if (self.watermark):
+            params['since_last_changed'] = self.watermark
+        members = mc_client.lists.members.all(self.list_id,
+                                              **params)['members']
+        dumps = json_codec().dumps
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?)',
+                [(self.list_id, member['id'], member['status'],
+                  dumps(member.get('merge_fields', {})).decode('utf-8'),
+                  member['last_changed']) for member in members])
+            self.db.execute(
+                'INSERT OR REPLACE INTO watermarks SELECT ?, MAX(last_changed)'
+                ' FROM members WHERE list_id = ?',
+                (self.list_id, self.list_id))
+        return len(members)
+
+    def get(self, email_hash):
+        """ returns a (status, merge_fields) tuple, or None for hashes the
+        list doesn't have"""
+        with self.lock:
+            row = self.db.execute('SELECT status, merge_fields FROM members '
+                                  'WHERE list_id = ? AND hash = ?',
+                                  (self.list_id, email_hash)).fetchone()
+        return (row[0], json_codec().loads(row[1])) if row else None
+
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM members WHERE '
+                               'list_id = ?', (self.list_id,)).fetchone()[0]
+
+    def sorted_statuses(self):
+        """ yields (email_hash, status) for the list in hash order"""
+        return self.db.execute('SELECT hash, status FROM members WHERE '
+                               'list_id = ? ORDER BY hash', (self.list_id,))
+
+    def sorted_members(self):
+        """ yields (email_hash, status, merge_fields JSON) for the list in
+        hash order"""
+        return self.db.execute('SELECT hash, status, merge_fields FROM '
+                               'members WHERE list_id = ? ORDER BY hash',
+                               (self.list_id,))
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DigestIndex:
+    """A compact, memory-mapped, read-only index of member statuses. The
+    file holds the raw 16 byte md5 digests of the list's email hashes in
+    sorted order, each followed by a one byte STATUS_CODES code and the
+    member's fields_digest, and ends with a Bloom filter so that most
+    addresses the list doesn't have never reach the binary search. Build it
+    with build_digest_index."""
+    HEADER = struct.Struct('<4sIQQI')
+    MAGIC = b'MCDX'
+    VERSION = 2
+    RECORD_SIZE = 21
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.size, self.bloom_bits, self.hashes = \
+            self.HEADER.unpack_from(self.mm)
+        if (magic != self.MAGIC or version != self.VERSION):
+            self.mm.close()
+            raise ValueError('{} is not a version {} digest index'.format(
+                path, self.VERSION))
+        self.bloom_offset = self.HEADER.size + self.size * self.RECORD_SIZE
+        self.bloom_skips = 0
+
+    def might_contain(self, digest):
+        for bit in bloom_bits(digest, self.bloom_bits, self.hashes):
+            byte = self.mm[self.bloom_offset + bit // 8]
+            if (not byte & (1 << (bit % 8))):
+                return False
+        return True
+
+    def find(self, digest):
+        """ returns the offset of the record for a raw digest, or None if
+        absent"""
+        if (not self.might_contain(digest)):
+            self.bloom_skips += 1
+            return None
+        lo, hi = 0, self.size
+        while (lo < hi):
+            mid = (lo + hi) // 2
+            offset = self.HEADER.size + mid * self.RECORD_SIZE
+            probe = self.mm[offset:offset + 16]
+            if (probe < digest):
+                lo = mid + 1
+            elif (probe > digest):
+                hi = mid
+            else:
+                return offset
+        return None
+
+    def get(self, email_hash):
+        """ returns a (status, merge_fields) tuple like ListMirror.get, or
+        None. The index only keeps a fields_digest of the merge fields,
+        which Client.get_mc_fields_diff compares against."""
+        offset = self.find(bytes.fromhex(email_hash))
+        if (offset is None):
+            return None
+        return (STATUS_CODES[self.mm[offset + 16]],
+                self.mm[offset + 17:offset + self.RECORD_SIZE])
+
+    def close(self):
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @classmethod
+    def is_current(cls, path):
+        """ whether path holds an index this version can read"""
+        try:
+            with open(path, 'rb') as f:
+                header = cls.HEADER.unpack(f.read(cls.HEADER.size))
+        except (OSError, struct.error):
+            return False
+        return header[:2] == (cls.MAGIC, cls.VERSION)
+
+
+def bloom_bits(digest, size, hashes):
+    """The Bloom filter bits for a digest. md5 digests are already
+    uniformly distributed, so the two halves serve as the pair of hashes
+    for double hashing."""
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + i * h2) % size for i in range(hashes)]
+
+
+def build_digest_index(path, count, members, bits_per_member=10, hashes=7):
+    """Write a DigestIndex of count (email_hash, status, merge_fields)
+    members, which must come in email_hash order (e.g. from
+    ListMirror.sorted_members), to path. Streams the records, so memory is
+    bounded by the Bloom filter."""
+    size = max(count * bits_per_member, 8)
+    bloom = bytearray((size + 7) // 8)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(DigestIndex.HEADER.pack(DigestIndex.MAGIC,
+                                        DigestIndex.VERSION, count, size,
+                                        hashes))
+        for email_hash, status, merge_fields in members:
+            digest = bytes.fromhex(email_hash)
+            f.write(digest + bytes((STATUS_CODES.index(status),)) +
+                    fields_digest(merge_fields))
+            for bit in bloom_bits(digest, size, hashes):
+                bloom[bit // 8] |= 1 << (bit % 8)
+        f.write(bloom)
+    os.replace(tmp_path, path)
+
+
+@contextlib.contextmanager
+def open_status_source(mc_client, list_id):
+    """Sync the configured list mirror, if any, and yield what
+    set_mailchimp_status should answer from: a DigestIndex rebuilt from the
+    mirror when IndexFile is set and the mirror changed, the mirror itself,
+    or None to look every client up on the API. The source is closed on
+    the way out."""
+    if (not CONFIG.get('MirrorFile')):
+        yield None
+        return
+    with ListMirror(CONFIG['MirrorFile'], list_id) as mirror:
+        changed = mirror.sync(mc_client)
+        if (not CONFIG.get('IndexFile')):
+            yield mirror
+            return
+        if (changed or not DigestIndex.is_current(CONFIG['IndexFile'])):
+            loads = json_codec().loads
+            build_digest_index(CONFIG['IndexFile'], mirror.count(),
+                               ((email_hash, status, loads(fields))
+                                for email_hash, status, fields in
+                                mirror.sorted_members()))
+    with DigestIndex(CONFIG['IndexFile']) as index:
+        yield index
 
 
 def load_conf(conf_file):
@@ -93,70 +1108,1431 @@ def load_conf(conf_file):
                                      fallback=False)):
         send_mc_email = True
 
+    tag_fields = [field.strip() for field in
+                  config['DEFAULT'].get('TagFields', '').split(',')
+                  if field.strip()]
+    intern_columns = [column.strip() for column in
+                      config['DEFAULT'].get(
+                          'InternColumns', ', '.join(INTERN_COLUMNS))
+                      .split(',') if column.strip()]
+
     return ({'ListID': config['DEFAULT']['MailchimpListID'],
              'User': config['DEFAULT']['MailchimpUser'],
              'Key': config['DEFAULT']['MailchimpKey'],
-             'SendMCEmail': send_mc_email})
+             'SendMCEmail': send_mc_email,
+             'TagFields': tag_fields,
+             'Concurrency': config['DEFAULT'].getint('Concurrency',
+                                                     fallback=1),
+             'RateLimit': config['DEFAULT'].getfloat('RateLimit',
+                                                     fallback=10.0),
+             'MirrorFile': config['DEFAULT'].get('MirrorFile', ''),
+             'IndexFile': config['DEFAULT'].get('IndexFile', ''),
+             'BreakerFailures': config['DEFAULT'].getint(
+                 'BreakerFailures', fallback=5),
+             'BreakerErrorRate': config['DEFAULT'].getfloat(
+                 'BreakerErrorRate', fallback=0.5),
+             'BreakerWindow': config['DEFAULT'].getint(
+                 'BreakerWindow', fallback=20),
+             'BreakerResetSeconds': config['DEFAULT'].getfloat(
+                 'BreakerResetSeconds', fallback=30),
+             'BreakerPause': config['DEFAULT'].getboolean(
+                 'BreakerPause', fallback=False),
+             'Transport': config['DEFAULT'].get('Transport', 'requests'),
+             'Connections': config['DEFAULT'].getint('Connections',
+                                                     fallback=10),
+             'TrafficFile': config['DEFAULT'].get('TrafficFile', ''),
+             'JSONCodec': config['DEFAULT'].get('JSONCodec', 'auto'),
+             'TraceFile': config['DEFAULT'].get('TraceFile', ''),
+             'AdaptiveConcurrency': config['DEFAULT'].getboolean(
+                 'AdaptiveConcurrency', fallback=False),
+             'MaxConcurrency': config['DEFAULT'].getint('MaxConcurrency',
+                                                        fallback=16),
+             'StatusFiles': config['DEFAULT'].getboolean('StatusFiles',
+                                                         fallback=False),
+             'InternColumns': intern_columns})
+
+
+def sample_file(path, head_size=65536, blocks=8, block_size=4096):
+    """ returns the head of the file and a few blocks spread evenly through
+    the rest of it, so the sample costs the same however large the file"""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        sample = [f.read(head_size)]
+        if (size > head_size + block_size):
+            stride = (size - head_size) // blocks
+            for i in range(1, blocks + 1):
+                f.seek(min(head_size + i * stride, size - block_size))
+                sample.append(f.read(block_size))
+    return sample
+
+
+def is_utf8(block):
+    """Whether a block cut from anywhere in a file decodes as UTF-8,
+    ignoring characters cut in half at either end"""
+    start = 0
+    while (start < min(3, len(block)) and block[start] & 0xC0 == 0x80):
+        start += 1
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(block[start:],
+                                                       final=False)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+_replacements = threading.local()
 
 
-def load_users(users_file):
-    """Read the email addresses from disk.
+def _count_replacement(error):
+    """ the 'replace' error handler, keeping a count per thread of the
+    bytes it replaced"""
+    _replacements.bytes = replaced_bytes() + error.end - error.start
+    return '\ufffd', error.end
+
+
+# users files are decoded with this, so the bytes a guessed encoding leaves
+# undefined (e.g. 0x81, 0x8D, 0x8F, 0x90 and 0x9D in cp1252) don't stop a
+# load halfway
+REPLACE_ERRORS = 'mailchimp_subscriber.replace'
+codecs.register_error(REPLACE_ERRORS, _count_replacement)
+
+
+def replaced_bytes():
+    """ returns how many bytes REPLACE_ERRORS has replaced in this thread"""
+    return getattr(_replacements, 'bytes', 0)
+
+
+def warn_replaced(users_file, encoding, count):
+    if (count):
+        print('Warning: {} bytes of {} are not valid {} and were replaced '
+              'with U+FFFD'.format(count, users_file, encoding),
+              file=sys.stderr)
+
+
+def detect_encoding(path):
+    """Works out the encoding of a users file from a fixed size sample of it.
+    Checks for a BOM, then for the NUL bytes of BOM-less UTF-16, then
+    whether the sample is valid UTF-8, and only then asks chardet, falling
+    back to cp1252, the usual encoding of CRM exports that aren't UTF-8"""
+    sample = sample_file(path)
+    head = sample[0]
+    if (head.startswith(codecs.BOM_UTF8)):
+        return 'utf-8-sig'
+    if (head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE))):
+        return 'utf-16'
+    if (head[1::2].count(0) > len(head) // 4):
+        return 'utf-16-le'
+    if (head[0::2].count(0) > len(head) // 4):
+        return 'utf-16-be'
+    if (all(is_utf8(block) for block in sample)):
+        return 'utf-8'
+
+    import chardet
+    guess = chardet.detect(b''.join(sample))
+    if (guess['encoding'] and guess['confidence'] >= 0.5):
+        encoding = codecs.lookup(guess['encoding']).name
+        # latin-1 guesses are cp1252 in practice, which is a superset
+        return 'cp1252' if encoding == 'iso8859-1' else encoding
+    return 'cp1252'
+
+
+def resolve_header(row):
+    """Maps a header row onto COLUMNS. Returns a dictionary of column name
+    to index, or None if the row isn't a header naming at least the
+    required columns"""
+    names = {alias: column for column, aliases in COLUMN_ALIASES.items()
+             for alias in aliases + (column.replace('_', ' '),)}
+    indexes = dict()
+    for i, cell in enumerate(row):
+        name = re.sub(r'[_-]', ' ', cell.strip().lower())
+        column = names.get(' '.join(name.split()))
+        if (column is not None and column not in indexes):
+            indexes[column] = i
+    if (all(column in indexes for column in REQUIRED_COLUMNS)):
+        return indexes
+    return None
+
+
+class RowProjector:
+    """Turns csv rows into (email, first name, last name, interaction notes,
+    job role) tuples through a single itemgetter resolved once from the
+    header, so no per-row dictionary is built. Without a header the columns
+    are taken positionally."""
+    POSITIONS = {'email_address': EMAIL_COL, 'first_name': FIRST_NAME_COL,
+                 'last_name': LAST_NAME_COL,
+                 'interaction_notes': INTERACTION_NOTES_COL,
+                 'job_role': JOB_ROLE_COL}
+
+    def __init__(self, indexes=None):
+        self.header = indexes is not None
+        self.indexes = indexes or self.POSITIONS
+        self.required = max(self.indexes[c] for c in REQUIRED_COLUMNS) + 1
+        self.width = max(self.indexes.values()) + 1
+        self.padding = [''] * self.width
+        # Columns the header lacks read the '' appended to every row
+        self.getter = operator.itemgetter(*[self.indexes.get(column, -1)
+                                            for column in COLUMNS])
+
+    @classmethod
+    def from_first_row(cls, row):
+        """ returns a projector for a file starting with row, and whether
+        that row is a header to skip"""
+        indexes = resolve_header(row) if row else None
+        return cls(indexes), indexes is not None
+
+    def __call__(self, row):
+        """ returns the COLUMNS values of a row at least self.required
+        long. Pads the row in place."""
+        if (len(row) < self.width):
+            row.extend(self.padding[len(row):])
+        row.append('')
+        return self.getter(row)
+
+
+def read_user_rows(users_file):
+    """ yields the COLUMNS values of every row of a users file long enough
+    to hold the required columns, in whatever encoding detect_encoding
+    finds and with the columns in whatever order the header, if there is
+    one, gives them"""
+    encoding = detect_encoding(users_file)
+    replaced = replaced_bytes()
+    with open(users_file, 'r', encoding=encoding, errors=REPLACE_ERRORS,
+              newline='') as f:
+        reader = csv.reader(f)
+        first = next(reader, [])
+        project, has_header = RowProjector.from_first_row(first)
+        rows = reader if has_header else itertools.chain([first], reader)
+        for row in rows:
+            if (len(row) >= project.required):
+                yield project(row)
+    warn_replaced(users_file, encoding, replaced_bytes() - replaced)
+
+
+def make_client(values, source=''):
+    """ returns a Client from a tuple of COLUMNS values"""
+    email, first_name, last_name, notes, role = values
+    client = Client(email, first_name, last_name, interaction_notes=notes,
+                    job_role=role)
+    client.source = source
+    return client
+
+
+class StringPool:
+    """Interns the values of low-cardinality columns, so that clients with
+    the same job role, say, share one str for it rather than each holding
+    its own stripped copy. A column stops taking new values once it has
+    max_values of them, as a column that varied that much would cost the
+    pool more than it saves. `saved` counts the bytes of the copies
+    dropped, per column."""
+    def __init__(self, columns=INTERN_COLUMNS, max_values=10000):
+        for column in columns:
+            if (column not in COLUMNS[1:]):
+                raise ValueError('Cannot intern {}'.format(column))
+        self.pools = {column: {} for column in columns}
+        self.max_values = max_values
+        self.saved = Counter()
+
+    def intern(self, column, value):
+        pool = self.pools[column]
+        canonical = pool.get(value)
+        if (canonical is None):
+            if (len(pool) < self.max_values):
+                pool[value] = value
+            return value
+        if (canonical is not value):
+            self.saved[column] += sys.getsizeof(value)
+        return canonical
+
+    def intern_client(self, client):
+        for column in self.pools:
+            setattr(client, column, self.intern(column,
+                                                getattr(client, column)))
+        return client
+
+
+def format_string_pool(pool):
+    return 'interned: ' + ', '.join(
+        '{} {} values saved {:.1f} MiB'.format(
+            column, len(pool.pools[column]), saved / 1048576.0)
+        for column, saved in sorted(pool.saved.items()))
+
+
+def load_users(users_file, pool=None):
+    """Read the email addresses from disk, interning the columns of pool (by
+    default a StringPool of the configured InternColumns).
     Returns a set of Client objects"""
+    if (pool is None):
+        pool = StringPool(CONFIG.get('InternColumns', INTERN_COLUMNS)
+                          if CONFIG else INTERN_COLUMNS)
     clients = dict()
-    with open(users_file, 'r') as f:
-        for row in csv.reader(f):
-            # Note that this isn't testing for multiple appearances of the same
-            # client. If theres more than one, it takes the last appearence.
-            try:
-                if (len(row) >= 3):
-                    client = Client(row[EMAIL_COL], row[FIRST_NAME_COL],
-                                    row[LAST_NAME_COL])
-                    clients[client.email_address] = client
-            except ValueError:
-                pass
+    source = os.path.basename(users_file)
+    for values in read_user_rows(users_file):
+        # Note that this isn't testing for multiple appearances of the same
+        # client. If theres more than one, it takes the last appearence.
+        # Appearances are matched by email_hash, as Mailchimp ignores case.
+        try:
+            client = pool.intern_client(make_client(values, source))
+            clients[client.email_hash] = client
+        except ValueError:
+            pass
 
-    return clients
+    return {client.email_address: client for client in clients.values()}
 
 
-def process_users(users, list_id, mc_user, mc_key):
-    """Takes a list of emails and returns a list of those not subscribed
-    to the MailChimp list"""
-    mc_client = MailChimp(mc_user, mc_key)
-    for client in users.values():
-        set_mailchimp_status(client, mc_client, list_id)
+def is_valid_row(values):
+    """Whether make_client would accept a tuple of COLUMNS values"""
+    return bool(validate_email(values[0]) and values[1] and values[2])
+
+
+def external_dedup(users_file, memory_limit=256 * 1024 * 1024, tmp_dir=None,
+                   bytes_per_row=4):
+    """Streams the unique clients of a users file too big to deduplicate in
+    memory. Valid rows are hash partitioned by email_hash into enough bucket
+    files on disk that each one fits in memory_limit (assuming a row takes
+    bytes_per_row times its size on disk once loaded), then each bucket is
+    deduplicated in memory with load_users' last appearance wins rule. No
+    more than max_open_buckets() bucket files are written at once, so a
+    bucket still too big is split again. Yields Client objects, bucket by
+    bucket."""
+    source = os.path.basename(users_file)
+    rows = (values for values in read_user_rows(users_file)
+            if is_valid_row(values))
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        for client in _dedup_rows(rows, os.path.getsize(users_file),
+                                  max(1, memory_limit // bytes_per_row),
+                                  os.path.join(tmp, 'bucket'), source):
+            yield client
+
+
+def max_open_buckets():
+    """ returns how many bucket files external_dedup may have open at once:
+    a quarter of the soft RLIMIT_NOFILE, up to 1024"""
+    try:
+        import resource
+    except ImportError:
+        # Windows, where the C runtime allows 512 open files
+        return 128
+    soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if (soft == resource.RLIM_INFINITY):
+        return 1024
+    return max(2, min(1024, soft // 4))
+
+
+def _dedup_rows(rows, size, max_size, prefix, source, depth=0):
+    """ yields the unique clients of csv rows taking size bytes on disk,
+    splitting them into bucket files named after prefix until each bucket
+    is under max_size bytes. Each depth hashes the addresses afresh, so a
+    bucket split again spreads over new buckets. Past MAX_SPLIT_DEPTH a
+    bucket is taken as it is: it holds few addresses, however many rows."""
+    buckets = min(max_open_buckets(), -(-size // max_size))
+    if (buckets <= 1 or depth >= MAX_SPLIT_DEPTH):
+        yield from _dedup_bucket(rows, source)
+        return
+    for path in _split_rows(rows, buckets, prefix, depth):
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            yield from _dedup_rows(csv.reader(f), os.path.getsize(path),
+                                   max_size, path[:-4] + '-', source,
+                                   depth + 1)
+        os.remove(path)
+
+
+def _split_rows(rows, buckets, prefix, depth):
+    """ writes rows into bucket files by their address' hash at a depth.
+    Returns the paths"""
+    paths = ['{}{}.csv'.format(prefix, i) for i in range(buckets)]
+    files = [open(path, 'w', encoding='utf-8', newline='')
+             for path in paths]
+    try:
+        writers = [csv.writer(f) for f in files]
+        salt = str(depth).encode('ascii')
+        for values in rows:
+            digest = hashlib.md5(
+                salt + values[0].strip().lower().encode('utf-8')).digest()
+            writers[int.from_bytes(digest[:4], 'big') % buckets]\
+                .writerow(values)
+    finally:
+        for f in files:
+            f.close()
+    return paths
+
+
+def _dedup_bucket(rows, source):
+    clients = dict()
+    for values in rows:
+        client = make_client(values, source)
+        clients[client.email_hash] = client
+    return clients.values()
+
+
+def write_clients(clients, out_file):
+    """ writes client objects to a csv file with a COLUMNS header. Returns
+    the number written"""
+    written = 0
+    with open(out_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, COLUMNS)
+        writer.writeheader()
+        for client in clients:
+            writer.writerow(client.get_all_fields())
+            written += 1
+    return written
+
+
+def user_hashes(users_file):
+    """ yields the member_hash of every valid row of a users file"""
+    for values in read_user_rows(users_file):
+        if (is_valid_row(values)):
+            yield member_hash(values[0])
+
+
+def sorted_user_rows(users_file, memory_limit=256 * 1024 * 1024,
+                     tmp_dir=None):
+    """ yields [member_hash] + the COLUMNS of the unique clients of a users
+    file, in hash order, with the last appearance of an address winning as
+    in load_users. Sorted with external_sort_rows, so it holds no more than
+    memory_limit"""
+    def rows():
+        for i, values in enumerate(read_user_rows(users_file)):
+            if (is_valid_row(values)):
+                client = make_client(values, '')
+                # the line number keeps appearances of an address in order
+                yield ([client.email_hash, '{:012d}'.format(i)] +
+                       [getattr(client, column) for column in COLUMNS])
+
+    for _, group in itertools.groupby(
+            external_sort_rows(rows(), memory_limit, tmp_dir),
+            key=operator.itemgetter(0)):
+        row = collections.deque(group, maxlen=1)[0]
+        yield row[:1] + row[2:]
+
+
+def external_sort_rows(rows, memory_limit=256 * 1024 * 1024, tmp_dir=None,
+                       bytes_per_row=512):
+    """Sorts rows (lists of str) that may not fit in memory. Runs of
+    memory_limit // bytes_per_row rows are sorted and, unless the first run
+    holds them all, spilled to temporary csv files that are then merged.
+    Yields the rows in order"""
+    run_size = max(1, memory_limit // bytes_per_row)
+    rows = iter(rows)
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        runs = []
+        for run in iter(lambda: sorted(itertools.islice(rows, run_size)),
+                        []):
+            if (not runs and len(run) < run_size):
+                yield from run
+                return
+            runs.append(os.path.join(tmp, '{}.csv'.format(len(runs))))
+            with open(runs[-1], 'w', encoding='utf-8', newline='') as f:
+                csv.writer(f).writerows(run)
+        files = [open(path, 'r', encoding='utf-8', newline='')
+                 for path in runs]
+        try:
+            yield from heapq.merge(*map(csv.reader, files))
+        finally:
+            for f in files:
+                f.close()
+
+
+def external_sort_hashes(hashes, memory_limit=256 * 1024 * 1024,
+                         tmp_dir=None):
+    """Sorts and deduplicates hex email hashes that may not fit in memory.
+    Runs of as many as fit in memory_limit (about 100 bytes each, held as a
+    list of str) are sorted and, unless the first run holds them all,
+    spilled to temporary files of HASH_RECORD byte records that are then
+    merged. Yields each hash once, in order."""
+    run_size = max(1, memory_limit // 100)
+    hashes = iter(hashes)
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        runs = []
+        for run in iter(lambda: sorted(itertools.islice(hashes, run_size)),
+                        []):
+            if (not runs and len(run) < run_size):
+                yield from _unique(run)
+                return
+            runs.append(os.path.join(tmp, '{}.run'.format(len(runs))))
+            with open(runs[-1], 'wb') as f:
+                f.write(''.join(run).encode('ascii'))
+        files = [open(path, 'rb') for path in runs]
+        try:
+            yield from _unique(heapq.merge(*map(_hash_records, files)))
+        finally:
+            for f in files:
+                f.close()
+
+
+def _hash_records(f, block=4096):
+    for chunk in iter(functools.partial(f.read, HASH_RECORD * block), b''):
+        for i in range(0, len(chunk), HASH_RECORD):
+            yield chunk[i:i + HASH_RECORD].decode('ascii')
+
+
+def _unique(ordered):
+    previous = None
+    for item in ordered:
+        if (item != previous):
+            yield item
+            previous = item
+
+
+def normalize_column(values):
+    """ The batch form of the cleanup Client.__init__ gives each field"""
+    return [value.strip().replace(",", "") for value in values]
+
+
+class ClientTable:
+    """A struct-of-arrays alternative to a dictionary of Client objects for
+    bulk runs: one list per field, the raw md5 digests packed into a single
+    bytearray and statuses as STATUS_CODES codes in an array. Rows are
+    addressed by index; table[i] and values() hand out lightweight ClientRow
+    views, so set_mailchimp_status, add_users_to_mailchimp,
+    write_users_to_file and process_users take a table wherever they take a
+    dictionary of clients."""
+    def __init__(self, emails, first_names, last_names, notes, roles,
+                 source=''):
+        self.emails = emails
+        self.first_names = first_names
+        self.last_names = last_names
+        self.notes = notes
+        self.roles = roles
+        self.source = source
+        self.digests = bytearray(b''.join(
+            hashlib.md5(email.lower().encode('utf-8')).digest()
+            for email in emails))
+        self.statuses = array.array('B', bytes(len(emails)))
+        # only filled in for members set_mailchimp_status finds
+        self.mc_fields = dict()
+
+    @classmethod
+    def from_csv(cls, users_file):
+        """Builds a table from a users file in one pass, with the same
+        header handling, validation and last-appearance-wins deduplication
+        as load_users"""
+        columns = list(zip(*read_user_rows(users_file))) or \
+            [()] * len(COLUMNS)
+        valid = [i for i, (email, first_name, last_name)
+                 in enumerate(zip(*columns[:3]))
+                 if validate_email(email) and first_name and last_name]
+        emails = normalize_column(columns[0][i] for i in valid)
+        # dict keeps each email at its first position but its last index,
+        # matching addresses regardless of case as Mailchimp does
+        keep = [valid[i] for i in
+                {email.lower(): i for i, email in enumerate(emails)}.values()]
+        return cls(*[normalize_column(column[i] for i in keep)
+                     for column in columns],
+                   source=os.path.basename(users_file))
+
+    def __len__(self):
+        return len(self.emails)
+
+    def __getitem__(self, index):
+        if (not 0 <= index < len(self.emails)):
+            raise IndexError(index)
+        return ClientRow(self, index)
+
+    def values(self):
+        return (ClientRow(self, i) for i in range(len(self.emails)))
+
+    def digest(self, index):
+        return bytes(self.digests[index * 16:index * 16 + 16])
+
+    def status_counts(self):
+        return Counter(STATUS_CODES[code] for code in self.statuses)
+
+
+class ClientRow:
+    """A view of one row of a ClientTable that quacks like a Client"""
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __repr__(self):
+        return '<ClientRow {}: {} >'.format(self.index, self.email_address)
+
+    email_address = property(lambda self: self.table.emails[self.index])
+    first_name = property(lambda self: self.table.first_names[self.index])
+    last_name = property(lambda self: self.table.last_names[self.index])
+    interaction_notes = property(lambda self: self.table.notes[self.index])
+    job_role = property(lambda self: self.table.roles[self.index])
+    source = property(lambda self: self.table.source)
+
+    @property
+    def email_hash(self):
+        return self.table.digest(self.index).hex()
+
+    @property
+    def mailchimp_status(self):
+        return STATUS_CODES[self.table.statuses[self.index]]
+
+    @mailchimp_status.setter
+    def mailchimp_status(self, status):
+        self.table.statuses[self.index] = STATUS_CODES.index(status)
+
+    @property
+    def mailchimp_fields(self):
+        return self.table.mc_fields.get(self.index, {})
+
+    @mailchimp_fields.setter
+    def mailchimp_fields(self, fields):
+        self.table.mc_fields[self.index] = fields
+
+    get_all_fields = Client.get_all_fields
+    get_mc_fields = Client.get_mc_fields
+    get_mc_fields_json = Client.get_mc_fields_json
+    get_mc_fields_diff = Client.get_mc_fields_diff
+
 
+def rejection_reason(row, project):
+    """ returns why load_users would drop a csv row, or None if it would
+    load it. Keep in step with Client.__new__"""
+    indexes = project.indexes
+    if (len(row) < project.required):
+        return 'short row'
+    if (not validate_email(row[indexes['email_address']])):
+        return 'bad email'
+    if (len(row[indexes['first_name']]) == 0):
+        return 'empty first name'
+    if (len(row[indexes['last_name']]) == 0):
+        return 'empty last name'
+    return None
+
+
+def file_chunks(path, chunk_size):
+    """ yields (start, end) byte ranges of about chunk_size that cover the
+    file and split it only between csv records: at a line ending with an
+    even number of quotes before it, so never inside a quoted field such as
+    notes holding a newline. A stray quote in an unquoted field throws the
+    count off: chunks grow until the next quote, and a multi-line quoted
+    field after it may be split."""
+    size = os.path.getsize(path)
+    start = 0
+    quotes = 0
+    with open(path, 'rb') as f:
+        while (start < size):
+            target = min(start + chunk_size, size)
+            quotes += f.read(target - start).count(b'"')
+            end = target
+            # finish the line target fell in, and any quoted field after it
+            while (end < size):
+                line = f.readline()
+                quotes += line.count(b'"')
+                end += len(line)
+                if (not quotes % 2):
+                    break
+            yield start, end
+            start = end
+
+
+def read_chunk(path, start, end, encoding='utf-8', header=None):
+    """ returns a csv reader over one byte range of a users file, from
+    file_chunks so it holds whole records, past the header if the range
+    starts the file"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # only the line endings csv itself knows end a line, so line numbers
+    # match what load_users reads
+    reader = csv.reader(io.StringIO(data.decode(encoding, REPLACE_ERRORS),
+                                    newline=''))
+    if (start == 0 and header is not None):
+        next(reader, None)
+    return reader
+
+
+def numbered_rows(reader):
+    """ yields (line, row) for the non-empty records of a csv reader, with
+    the line each record starts on"""
+    line = reader.line_num
+    for row in reader:
+        if (row):
+            yield line + 1, row
+        line = reader.line_num
+
+
+def validate_chunk(path, start, end, encoding='utf-8', header=None):
+    """Checks the rows in one byte range of a users file, with the columns
+    the file's header (if any) resolved to. Only the rejects leave the
+    worker: returns the number of lines in the range, a dictionary of each
+    accepted address to the first and last lines it is on, the rejected
+    rows, the rows a later line of the range duplicates, as (line, row,
+    later line), and how many bytes didn't decode. Line numbers are within
+    the range."""
+    project = RowProjector(header)
+    email_col = project.indexes['email_address']
+    replaced = replaced_bytes()
+    reader = read_chunk(path, start, end, encoding, header)
+    replaced = replaced_bytes() - replaced
+    first = dict()
+    kept = dict()
+    rejected = []
+    duplicates = []
+    for line, row in numbered_rows(reader):
+        reason = rejection_reason(row, project)
+        if (reason is not None):
+            rejected.append((line, reason, row))
+            continue
+        email = row[email_col].strip().lower()
+        if (email in kept):
+            duplicates.append(kept[email] + (line,))
+        first.setdefault(email, line)
+        kept[email] = (line, row)
+    lines = {email: (first[email], line)
+             for email, (line, _) in kept.items()}
+    return reader.line_num, lines, rejected, duplicates, replaced
+
+
+def chunk_rows(path, start, end, encoding, header, lines):
+    """ returns a dictionary of line to row for the given lines of a byte
+    range, numbered as validate_chunk numbers them"""
+    return {line: row for line, row in
+            numbered_rows(read_chunk(path, start, end, encoding, header))
+            if line in lines}
+
+
+def validate_users(users_file, rejects_file, workers=None,
+                   chunk_size=8 * 1024 * 1024):
+    """Checks a users file without touching the network, scanning it in
+    parallel chunks. Writes every row load_users would drop, with its line
+    number and the reason, to rejects_file. Of duplicated addresses only the
+    last appearance is kept, as in load_users. Returns a Counter of rows,
+    accepted rows and rejections by reason, plus the bytes replaced for not
+    decoding, bytes and seconds"""
+    start = time.perf_counter()
+    encoding = detect_encoding(users_file)
+    if (encoding.startswith('utf-16')):
+        # line endings are two bytes wide, so don't split the file
+        chunk_size = os.path.getsize(users_file)
+    with open(users_file, 'r', encoding=encoding, errors=REPLACE_ERRORS,
+              newline='') as f:
+        header = resolve_header(next(csv.reader(f), []))
+    chunks = list(file_chunks(users_file, chunk_size))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(validate_chunk, [users_file] * len(chunks),
+                           *zip(*chunks), [encoding] * len(chunks),
+                           [header] * len(chunks))
+        offsets = [0]
+        # address -> (chunk, line) of its last appearance so far
+        seen = dict()
+        # chunk -> {line: later line} of rows a later chunk duplicates
+        earlier = collections.defaultdict(dict)
+        rejected = []
+        replaced = 0
+        for chunk, (lines, emails, bad, duplicates, undecoded) in \
+                enumerate(results):
+            replaced += undecoded
+            offset = offsets[-1]
+            rejected.extend((offset + line, reason, row)
+                            for line, reason, row in bad)
+            rejected.extend((offset + line, 'duplicate of line {}'.format(
+                offset + later), row) for line, row, later in duplicates)
+            for email, (first, last) in emails.items():
+                if (email in seen):
+                    previous, previous_line = seen[email]
+                    earlier[previous][previous_line] = offset + first
+                seen[email] = (chunk, last)
+            offsets.append(offset + lines)
+
+        # fetch the rows other chunks duplicate, rereading only their chunks
+        fetches = {chunk: pool.submit(chunk_rows, users_file,
+                                      *chunks[chunk], encoding, header,
+                                      set(lines))
+                   for chunk, lines in earlier.items()}
+        for chunk, future in fetches.items():
+            for line, row in future.result().items():
+                rejected.append((offsets[chunk] + line,
+                                 'duplicate of line {}'.format(
+                                     earlier[chunk][line]), row))
+
+    rejected.sort(key=lambda rejection: rejection[0])
+    with open(rejects_file, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['line', 'reason', 'row'])
+        for line, reason, row in rejected:
+            writer.writerow([line, reason] + row)
+
+    stats = Counter(reason.split(' of ')[0] for _, reason, _ in rejected)
+    stats.update(rows=len(seen) + len(rejected), accepted=len(seen),
+                 replaced=replaced, bytes=os.path.getsize(users_file))
+    return dict(stats, seconds=time.perf_counter() - start)
+
+
+def format_validation(stats, rejects_file):
+    rejections = {reason: count for reason, count in stats.items()
+                  if reason not in ('rows', 'accepted', 'replaced', 'bytes',
+                                    'seconds')}
+    seconds = max(stats['seconds'], 1e-9)
+    lines = [
+        '{} rows, {} accepted, {} rejected: {}'.format(
+            stats['rows'], stats['accepted'], sum(rejections.values()),
+            format_counts(rejections)),
+        'rejected rows written to ' + rejects_file,
+        '{:.0f} rows/s, {:.1f} MB/s'.format(
+            stats['rows'] / seconds, stats['bytes'] / seconds / 1e6)]
+    if (stats.get('replaced')):
+        lines.insert(1, '{} bytes did not decode and were replaced with '
+                        'U+FFFD'.format(stats['replaced']))
+    return '\n'.join(lines)
+
+
+def process_users(users, list_id, mc_user, mc_key, filename=None,
+                  mc_client=None):
+    """Looks up every client on the MailChimp list, then either adds those
+    not subscribed or writes them out to a file. Calls run on
+    concurrency_workers() threads. Pass mc_client from make_mc_client to
+    look at its limiter or traffic afterwards. Returns a Counter of the
+    writes made to Mailchimp"""
+    mc_client = mc_client or make_mc_client(mc_user, mc_key)
+    workers = concurrency_workers()
+    with open_status_source(mc_client, list_id) as mirror:
+        for _ in map_concurrently(functools.partial(
+                _set_status, mc_client, list_id, mirror), users.values(),
+                workers):
+            pass
+
+    writes = Counter()
     if (CONFIG['SendMCEmail']):
-        add_users_to_mailchimp(users.values(), mc_client, list_id)
+        writes = add_users_to_mailchimp(users.values(), mc_client, list_id,
+                                        workers, make_tagger(mc_client,
+                                                             list_id))
     else:
-        write_users_to_file(users.values())
+        writes = write_users_out(users.values(), filename)
+    writes['retry'] = write_deferred_clients(mc_client)
+    writes.update(write_traffic(mc_client))
+    return +writes
+
+
+def _set_status(mc_client, list_id, mirror, client):
+    set_mailchimp_status(client, mc_client, list_id, mirror)
+
+
+def concurrency_workers():
+    """ returns how many threads make API calls: the most AdaptiveConcurrency
+    may allow in flight, or else the fixed Concurrency"""
+    if (CONFIG.get('AdaptiveConcurrency')):
+        return CONFIG.get('MaxConcurrency', 16)
+    return CONFIG.get('Concurrency', 1)
+
+
+def map_concurrently(function, items, workers):
+    """ yields function(item) for each item, running up to workers calls at
+    once on a thread pool. At most twice that many items are taken from
+    items ahead of the results, so a lazy iterator stays lazy. With more
+    than one worker results come back in the order they finish."""
+    if (workers <= 1):
+        for item in items:
+            yield function(item)
+        return
+    from concurrent.futures import (ThreadPoolExecutor, FIRST_COMPLETED,
+                                    wait)
+    with ThreadPoolExecutor(workers) as pool:
+        pending = set()
+        for item in items:
+            if (len(pending) >= 2 * workers):
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(pool.submit(function, item))
+        for future in pending:
+            yield future.result()
+
+
+def stream_unique_clients(users_file):
+    """ yields the clients load_users would return without holding them
+    all in memory. A first pass over the file notes the last line each
+    address appears on; the second yields each client from that line, so
+    the last appearance still wins."""
+    last = dict()
+    for i, values in enumerate(read_user_rows(users_file)):
+        if (is_valid_row(values)):
+            last[values[0].strip().lower()] = i
+    source = os.path.basename(users_file)
+    for i, values in enumerate(read_user_rows(users_file)):
+        if (is_valid_row(values) and last[values[0].strip().lower()] == i):
+            yield make_client(values, source)
+
+
+class PipelineQueue:
+    """A bounded queue between two pipeline stages that keeps track of its
+    depth and of how long each side spent blocked on it: the producer
+    waiting for room (backpressure) and the consumer waiting for work
+    (idle)."""
+    DONE = object()
+
+    def __init__(self, name, maxsize, producers=1):
+        self.name = name
+        self.queue = queue.Queue(maxsize)
+        self.producers = producers
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+        self.max_depth = 0
+        self.depth_total = 0
+        self.items = 0
+        self.lock = threading.Lock()
+
+    def put(self, item):
+        start = time.perf_counter()
+        self.queue.put(item)
+        waited = time.perf_counter() - start
+        with self.lock:
+            self.put_wait += waited
+            depth = self.queue.qsize()
+            self.max_depth = max(self.max_depth, depth)
+            self.depth_total += depth
+            self.items += 1
+
+    def get(self):
+        start = time.perf_counter()
+        item = self.queue.get()
+        with self.lock:
+            self.get_wait += time.perf_counter() - start
+        return item
+
+    def close(self):
+        """ called once by each producer when it has nothing more"""
+        self.queue.put(self.DONE)
+
+    def drain(self):
+        """ yields items until every producer has closed the queue. Only
+        for a single consumer."""
+        open_producers = self.producers
+        while (open_producers):
+            item = self.get()
+            if (item is self.DONE):
+                open_producers -= 1
+            else:
+                yield item
+
+    def stats(self):
+        return {'queue': self.name, 'items': self.items,
+                'max_depth': self.max_depth,
+                'mean_depth': self.depth_total / max(self.items, 1),
+                'producer_blocked': self.put_wait,
+                'consumer_idle': self.get_wait}
+
+
+def _parse_stage(source, lookups, consumers, errors):
+    try:
+        for client in source:
+            lookups.put(client)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        for _ in range(consumers):
+            lookups.close()
+
+
+def _lookup_stage(lookups, writes, mc_client, list_id, mirror, errors):
+    item = lookups.get()
+    while (item is not PipelineQueue.DONE):
+        try:
+            if (not errors):
+                set_mailchimp_status(item, mc_client, list_id, mirror)
+                writes.put(item)
+        except Exception as e:
+            # keep taking items so the parser is never left blocked
+            errors.append(e)
+        item = lookups.get()
+    writes.close()
+
+
+def pipeline_users(clients, list_id, mc_user, mc_key, filename=None,
+                   lookup_workers=None, queue_size=1000, mc_client=None):
+    """The streaming form of process_users. Parsing, status lookups and the
+    upserts or file write run as concurrent stages joined by bounded queues,
+    so a slow API holds the parser back rather than letting clients pile up
+    in memory. clients may be any iterable, e.g. stream_unique_clients.
+    Returns a Counter of the writes made to Mailchimp and the stats of each
+    queue"""
+    mc_client = mc_client or make_mc_client(mc_user, mc_key)
+    lookup_workers = lookup_workers or concurrency_workers()
+    lookups = PipelineQueue('parse -> lookup', queue_size)
+    writes = PipelineQueue('lookup -> write', queue_size,
+                           producers=lookup_workers)
+    errors = []
+    with open_status_source(mc_client, list_id) as mirror:
+        threads = [threading.Thread(target=_parse_stage,
+                                    args=(clients, lookups, lookup_workers,
+                                          errors))]
+        threads.extend(threading.Thread(target=_lookup_stage,
+                                        args=(lookups, writes, mc_client,
+                                              list_id, mirror, errors))
+                       for _ in range(lookup_workers))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        counts = _write_stage(writes, mc_client, list_id, filename)
+        # the lookups are done with the mirror once they have all joined
+        for thread in threads:
+            thread.join()
+    if (errors):
+        raise errors[0]
+    counts['retry'] = write_deferred_clients(mc_client)
+    counts.update(write_traffic(mc_client))
+    return +counts, [lookups.stats(), writes.stats()]
+
+
+def _write_stage(writes, mc_client, list_id, filename):
+    if (not CONFIG['SendMCEmail']):
+        return write_users_out(writes.drain(), filename)
+    return add_users_to_mailchimp(writes.drain(), mc_client, list_id,
+                                  concurrency_workers(),
+                                  make_tagger(mc_client, list_id))
+
+
+def format_pipeline_stats(stats):
+    return '\n'.join(
+        '{queue}: {items} items, depth max {max_depth} mean {mean_depth:.1f}, '
+        'producer blocked {producer_blocked:.2f}s, consumer idle '
+        '{consumer_idle:.2f}s'.format(**stat) for stat in stats)
+
+
+def add_users_to_mailchimp(clients, mc_client, list_id, workers=1,
+                           tagger=None):
+    """Creates the clients missing from the list and brings pending members'
+    merge fields up to date, sending only the fields that changed, with up
+    to `workers` writes in flight. Clients left on the list are handed to
+    tagger (see make_tagger) as their writes finish. Returns a Counter of
+    created, updated, skipped, failed and (circuit breaker) deferred
+    clients, plus the tagger's counts"""
+    counts = Counter()
+    for client, outcome in map_concurrently(
+            functools.partial(_add_user, mc_client, list_id), clients,
+            workers):
+        if (outcome):
+            counts[outcome] += 1
+        if (tagger is not None and is_taggable(client, outcome)):
+            tagger.put(client)
+    if (tagger is not None):
+        counts.update(tagger.close())
+    return counts
+
+
+def planned_write(client):
+    """ returns the write add_users_to_mailchimp makes for a looked up
+    client: 'created', 'updated' for a pending member whose merge fields
+    changed, 'skipped' for one whose fields didn't, or None"""
+    if (client.mailchimp_status == 'pending'):
+        return 'updated' if client.get_mc_fields_diff() else 'skipped'
+    if (client.mailchimp_status == 'not_present'):
+        return 'created'
+    return None
+
+
+def _add_user(mc_client, list_id, client):
+    write = planned_write(client)
+    if (write == 'updated'):
+        return client, _write_member(
+            mc_client, client, 'updated', mc_client.lists.members.update,
+            list_id, client.email_hash,
+            {'merge_fields': client.get_mc_fields_diff()})
+
+    if (write == 'created'):
+        return client, _write_member(
+            mc_client, client, 'created', mc_client.lists.members.create,
+            list_id, {'email_address': client.email_address,
+                      'status': 'pending',
+                      'merge_fields': client.get_mc_fields()})
+    return client, write
+
+
+def is_taggable(client, outcome):
+    """Whether a client is on the list once add_users_to_mailchimp is done
+    with it: just created, or subscribed or pending and not left with a
+    failed or deferred write. Cleaned and unsubscribed members, and
+    clients whose lookup was deferred, are not"""
+    if (outcome in ('failed', 'deferred')):
+        return False
+    return (outcome == 'created' or
+            client.mailchimp_status in ('subscribed', 'pending'))
+
+
+def _write_member(mc_client, client, outcome, write, *args):
+    try:
+        with traced_member(client.email_hash):
+            write(*args)
+        return outcome
+    except (CircuitOpenError, requests.exceptions.RequestException):
+        defer_client(mc_client, client)
+        return 'deferred'
+    except api_error() as e:
+        # e.g. a 400 for Member Exists or an invalid merge field
+        if (is_server_error(e)):
+            defer_client(mc_client, client)
+        return 'failed'
 
 
-def add_users_to_mailchimp(clients, mc_client, list_id):
+def group_clients_by_tag(clients, tag_fields):
+    """Takes in client objects and the names of the Client attributes to tag
+    by (e.g. job_role, source). Returns a dictionary of tag to clients"""
+    groups = dict()
     for client in clients:
-        if (client.mailchimp_status == 'pending'):
-            try:
-                mc_client.update.list.members\
-                                        .update(list_id,
-                                                client.email_hash,
-                                                client.get_mc_fields_json())
-                return True
-            except requests.exceptions.HTTPError:
-                return False
+        for field in tag_fields:
+            tag = getattr(client, field, '')
+            if (tag):
+                groups.setdefault(tag, []).append(client)
+
+    return groups
+
+
+def get_static_segments(mc_client, list_id):
+    """ returns a dictionary of the list's tag names to segment ids"""
+    segments = mc_client.lists.segments.all(list_id, get_all=True,
+                                            type='static',
+                                            fields='segments.id,segments.name')
+    return {segment['name']: segment['id']
+            for segment in segments['segments']}
+
+
+def get_segment_member_hashes(mc_client, list_id, segment_id):
+    """ returns the set of email hashes already carrying a tag"""
+    members = mc_client.lists.segments.members.all(list_id, segment_id,
+                                                   get_all=True,
+                                                   fields='members.id')
+    return {member['id'] for member in members['members']}
+
+
+class SegmentTagger:
+    """Tags clients on Mailchimp by the given Client attributes as they are
+    put, pushing each tag through the static segment bulk endpoint once
+    SEGMENT_BATCH_SIZE members have it, so only a batch per tag is held.
+    The list's segments and the members already carrying a tag are fetched
+    the first time the tag is pushed, and those members are skipped."""
+    def __init__(self, mc_client, list_id, tag_fields):
+        self.mc_client = mc_client
+        self.list_id = list_id
+        self.tag_fields = tag_fields
+        self.segments = None
+        self.have = dict()
+        self.batches = dict()
+        self.counts = Counter()
+
+    def put(self, client):
+        for field in self.tag_fields:
+            tag = getattr(client, field, '')
+            if (tag):
+                batch = self.batches.setdefault(tag, [])
+                batch.append(client)
+                if (len(batch) >= SEGMENT_BATCH_SIZE):
+                    self._push(tag, self.batches.pop(tag))
+
+    def close(self):
+        """ pushes the batches still held. Returns a Counter of tagged,
+        already_tagged and tag_failed members"""
+        for tag, batch in self.batches.items():
+            self._push(tag, batch)
+        self.batches.clear()
+        # drop the zero counts
+        return +self.counts
+
+    def _segment(self, tag):
+        """ returns the tag's segment id and the hashes of the members
+        already carrying it, creating the segment if the list lacks it"""
+        if (self.segments is None):
+            self.segments = get_static_segments(self.mc_client, self.list_id)
+        if (tag not in self.have):
+            if (tag in self.segments):
+                self.have[tag] = get_segment_member_hashes(
+                    self.mc_client, self.list_id, self.segments[tag])
+            else:
+                self.segments[tag] = self.mc_client.lists.segments.create(
+                    self.list_id, {'name': tag, 'static_segment': []})['id']
+                self.have[tag] = set()
+        return self.segments[tag], self.have[tag]
+
+    def _push(self, tag, clients):
+        try:
+            segment_id, have = self._segment(tag)
+        except (CircuitOpenError, requests.exceptions.RequestException,
+                api_error()):
+            self.counts['tag_failed'] += len(clients)
+            return
+        emails = []
+        for client in clients:
+            if (client.email_hash not in have):
+                have.add(client.email_hash)
+                emails.append(client.email_address)
+        self.counts['already_tagged'] += len(clients) - len(emails)
+        if (emails):
+            self.counts.update(_add_segment_members(
+                self.mc_client, self.list_id, segment_id, emails))
+
+
+def make_tagger(mc_client, list_id):
+    """ returns a SegmentTagger for the configured TagFields, or None"""
+    if (not CONFIG.get('TagFields')):
+        return None
+    return SegmentTagger(mc_client, list_id, CONFIG['TagFields'])
+
+
+def tag_clients(clients, mc_client, list_id, tag_fields):
+    """Tags clients on Mailchimp by the given Client attributes with a
+    SegmentTagger. Returns a Counter of tagged, already_tagged and
+    tag_failed members"""
+    tagger = SegmentTagger(mc_client, list_id, tag_fields)
+    for client in clients:
+        tagger.put(client)
+    return tagger.close()
+
+
+def _add_segment_members(mc_client, list_id, segment_id, emails):
+    try:
+        response = mc_client.lists.segments.update_members(
+            list_id, segment_id, {'members_to_add': emails})
+    except (CircuitOpenError, requests.exceptions.RequestException,
+            api_error()):
+        return Counter({'tag_failed': len(emails)})
+    failed = response.get('error_count', 0)
+    return Counter({'tagged': len(emails) - failed, 'tag_failed': failed})
+
+
+def load_known_statuses(status_file):
+    """Read email_hash,status rows from disk, e.g. saved from an earlier run.
+    Returns a dictionary of email hash to a (status, merge_fields) tuple like
+    ListMirror.get; the file has no merge fields, so they come back empty"""
+    with open(status_file, 'r') as f:
+        return {row[0].strip(): (row[1].strip(), {})
+                for row in csv.reader(f) if len(row) >= 2}
+
+
+PLANNED_COUNTS = {'created': 'creates', 'updated': 'updates'}
+
+
+def plan_run(users_file, config, known=None, latency=0.25):
+    """Works out what a run would cost without talking to Mailchimp. known
+    maps email hashes to (status, merge_fields), e.g. a ListMirror or
+    load_known_statuses. Clients it knows are projected straight to the
+    create, update or skip add_users_to_mailchimp would make; the rest cost
+    a GET and their write is counted as unknown. Returns a dictionary of
+    projected counts, wall time and load_users memory"""
+    import tracemalloc
+    known = dict() if known is None else known
+    tracemalloc.start()
+    try:
+        users = load_users(users_file)
+        memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    plan = Counter(clients=len(users), gets=0, creates=0, updates=0,
+                   skips=0, unknown=0, tag_calls=0)
+    for client in users.values():
+        member = known.get(client.email_hash)
+        if (member is None):
+            plan['gets'] += 1
+            plan['unknown'] += 1
+        elif (not config['SendMCEmail']):
+            plan['skips'] += 1
+        else:
+            client.mailchimp_status, client.mailchimp_fields = member
+            plan[PLANNED_COUNTS.get(planned_write(client), 'skips')] += 1
+
+    if (config['SendMCEmail'] and config.get('TagFields')):
+        for tagged in group_clients_by_tag(users.values(),
+                                           config['TagFields']).values():
+            plan['tag_calls'] += 2 + (len(tagged) - 1) // SEGMENT_BATCH_SIZE
+
+    calls = plan['gets'] + plan['creates'] + plan['updates'] + \
+        plan['tag_calls']
+    if (config['SendMCEmail']):
+        # unknown clients may turn out to need a write as well
+        calls += plan['unknown']
+    rate = min(config['Concurrency'] / latency, config['RateLimit'])
+    return dict(plan, calls=calls, memory=memory, seconds=calls / rate)
+
+
+def format_plan(plan):
+    return '\n'.join([
+        '{clients} clients'.format(**plan),
+        'GETs: {gets}'.format(**plan),
+        'creates: {creates}, updates: {updates}, skips: {skips}, '
+        'unknown: {unknown}'.format(**plan),
+        'tag calls: {tag_calls}'.format(**plan),
+        'at most {calls} API calls, about {minutes:.1f} minutes'.format(
+            minutes=plan['seconds'] / 60.0, **plan),
+        'load_users peak memory: {:.1f} MiB'.format(
+            plan['memory'] / 1048576.0)])
+
+
+def missing_members(user_hashes, members):
+    """A streaming merge of two streams in email_hash order: the unique
+    hashes of the users file and the (email_hash, status) of the list's
+    members. Yields the members the users file doesn't have."""
+    user_hashes = iter(user_hashes)
+    user = next(user_hashes, None)
+    for email_hash, status in members:
+        while (user is not None and user < email_hash):
+            user = next(user_hashes, None)
+        if (user != email_hash):
+            yield email_hash, status
+
+
+def plan_archive(users_file, mirror, memory_limit=256 * 1024 * 1024):
+    """Takes a users file and a synced ListMirror. Returns the (email_hash,
+    status) of the list members missing from the users file, which a
+    reconciliation would archive, and how many members aren't archived
+    already"""
+    active = Counter()
+
+    def members():
+        for email_hash, status in mirror.sorted_statuses():
+            if (status != 'archived'):
+                active['members'] += 1
+                yield email_hash, status
+
+    extras = list(missing_members(
+        external_sort_hashes(user_hashes(users_file), memory_limit),
+        members()))
+    return extras, active['members']
+
+
+def archive_members(mc_client, list_id, hashes, batch_size=ARCHIVE_BATCH_SIZE,
+                    poll=5, timeout=3600):
+    """Archives members (a DELETE on the member) in Mailchimp batch
+    operations of batch_size, then waits up to timeout seconds for each
+    batch to finish. Returns a Counter of archived and archive_failed
+    members"""
+    counts = Counter()
+    batches = []
+    for i in range(0, len(hashes), batch_size):
+        operations = [{'method': 'DELETE',
+                       'path': '/lists/{}/members/{}'.format(list_id,
+                                                             email_hash)}
+                      for email_hash in hashes[i:i + batch_size]]
+        try:
+            batches.append(mc_client.batch_operations.create(
+                {'operations': operations})['id'])
+        except (CircuitOpenError, requests.exceptions.RequestException,
+                api_error()):
+            counts['archive_failed'] += len(operations)
+    for batch_id in batches:
+        batch = wait_for_batch(mc_client, batch_id, poll, timeout)
+        failed = batch.get('errored_operations', 0)
+        counts['archived'] += batch.get('total_operations', 0) - failed
+        counts['archive_failed'] += failed
+    return +counts
+
+
+def wait_for_batch(mc_client, batch_id, poll=5, timeout=3600):
+    """ returns a Mailchimp batch operation once it has finished. Raises
+    TimeoutError if it hasn't after timeout seconds"""
+    deadline = time.monotonic() + timeout
+    while (True):
+        batch = mc_client.batch_operations.get(batch_id)
+        if (batch.get('status') == 'finished'):
+            return batch
+        remaining = deadline - time.monotonic()
+        if (remaining <= 0):
+            raise TimeoutError('Mailchimp batch {} still {} after {:g}s'
+                               .format(batch_id, batch.get('status'),
+                                       timeout))
+        time.sleep(min(poll, remaining))
+
+
+def format_archive_plan(extras, members, max_percent):
+    percent = 100.0 * len(extras) / members if members else 0.0
+    return ('{} of {} list members ({:.1f}%) are missing from the users '
+            'file and would be archived, limit {:.1f}%'.format(
+                len(extras), members, percent, max_percent))
+
+
+DIFF_REPORTS = {
+    'new': ['email_hash'] + COLUMNS + ['mailchimp_status'],
+    'changed': ['email_hash', 'email_address', 'field', 'last_run',
+                'users_file'],
+    'drift': ['email_hash', 'email_address', 'field', 'users_file',
+              'mailchimp'],
+    'removed': ['email_hash'] + COLUMNS + ['mailchimp_status'],
+}
+
+
+def merge_join(*streams):
+    """Joins streams of rows sorted by their first item, the email_hash.
+    Yields (email_hash, [row from each stream, or None])"""
+    tagged = [_tag_rows(stream, i) for i, stream in enumerate(streams)]
+    for email_hash, group in itertools.groupby(
+            heapq.merge(*tagged, key=operator.itemgetter(0, 1)),
+            key=operator.itemgetter(0)):
+        rows = [None] * len(streams)
+        for _, i, row in group:
+            rows[i] = row
+        yield email_hash, rows
+
+
+def _tag_rows(rows, i):
+    for row in rows:
+        yield row[0], i, row
 
-        if (client.mailchimp_status == 'not_present'):
-            try:
-                mc_client.update.list.members\
-                                        .create(list_id,
-                                                client.get_mc_fields_json())
-                return True
-            except requests.exceptions.HTTPError:
-                return False
 
+def diff_rows(current, last, member):
+    """ yields the (report, row) entries for one email_hash, given its
+    users file and last run rows ([email_hash] + COLUMNS) and its list
+    member (email_hash, status, merge_fields JSON), each of which may be
+    None"""
+    status = member[1] if member else 'not_present'
+    if (current and not last):
+        yield 'new', current + [status]
+    elif (last and not current):
+        yield 'removed', last + [status]
+    elif (current):
+        for i, column in enumerate(COLUMNS[1:], 2):
+            if (current[i] != last[i]):
+                yield 'changed', [current[0], current[1], column, last[i],
+                                  current[i]]
+    yield from drift_rows(current, status, member)
 
-def write_users_to_file(clients):
+
+def drift_rows(current, status, member):
+    """ yields where a users file row and its list member disagree: a
+    status that can't be mailed, an active member the file lacks, or merge
+    fields that differ"""
+    active = status in ('subscribed', 'pending')
+    if (current is None):
+        if (active):
+            yield 'drift', [member[0], '', 'status', '', status]
+        return
+    if (not active):
+        yield 'drift', [current[0], current[1], 'status', 'present', status]
+        return
+    fields = json_codec().loads(member[2])
+    for field, value in (('FNAME', current[2]), ('LNAME', current[3])):
+        if (fields.get(field) != value):
+            yield 'drift', [current[0], current[1], field, value,
+                            fields.get(field, '')]
+
+
+def diff_users(users_file, last_file, mirror, out_dir,
+               memory_limit=256 * 1024 * 1024):
+    """Three-way diff of a users file against the one from the last run and
+    a synced ListMirror. Each side is externally sorted by email_hash
+    (memory_limit each) and joined in one streaming pass, writing a csv per
+    DIFF_REPORTS entry to out_dir. Returns a Counter of rows per report"""
+    os.makedirs(out_dir, exist_ok=True)
+    files = {report: open(os.path.join(out_dir, report + '.csv'), 'w',
+                          newline='') for report in DIFF_REPORTS}
+    counts = Counter()
+    try:
+        writers = {report: csv.writer(f) for report, f in files.items()}
+        for report, header in DIFF_REPORTS.items():
+            writers[report].writerow(header)
+        for _, (current, last, member) in merge_join(
+                sorted_user_rows(users_file, memory_limit),
+                sorted_user_rows(last_file, memory_limit),
+                mirror.sorted_members()):
+            for report, row in diff_rows(current, last, member):
+                writers[report].writerow(row)
+                counts[report] += 1
+    finally:
+        for f in files.values():
+            f.close()
+    return counts
+
+
+def write_users_to_file(clients, filename=None):
     """ Takes in a dictionary of client objects, and writes them out a
     csv file."""
-    filename = 'Non-subscribed Clients ' + time.asctime() + '.csv'
+    if (filename is None):
+        filename = 'Non-subscribed Clients ' + time.asctime() + '.csv'
     with open(filename, 'w') as f:
         writer = csv.DictWriter(f, COLUMNS)
         writer.writeheader()
@@ -166,7 +2542,814 @@ def write_users_to_file(clients):
                 writer.writerow(client.get_all_fields())
 
 
+class StatusSink:
+    """One csv file of clients, written by its own thread from batches of
+    rows handed over through a small bounded queue"""
+    def __init__(self, filename, batches=4):
+        self.filename = filename
+        self.rows = 0
+        self.error = None
+        self.batches = queue.Queue(batches)
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def _write(self):
+        try:
+            with open(self.filename, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(COLUMNS)
+                batch = self.batches.get()
+                while (batch is not None):
+                    writer.writerows(batch)
+                    batch = self.batches.get()
+        except Exception as e:
+            self.error = e
+            # keep taking batches so the writer is never left blocked
+            while (self.batches.get() is not None):
+                pass
+
+    def put(self, batch):
+        self.rows += len(batch)
+        self.batches.put(batch)
+
+    def close(self):
+        self.batches.put(None)
+        self.thread.join()
+        if (self.error is not None):
+            raise self.error
+
+
+def write_users_by_status(clients, prefix=None, buffer_rows=1000):
+    """Writes clients to a csv file per STATUS_FILES entry in one pass:
+    '<prefix> <status>.csv'. Rows are buffered per status and handed
+    buffer_rows at a time to each file's StatusSink, so the files are
+    written in parallel with the pass. Returns a Counter of clients per
+    status"""
+    if (prefix is None):
+        prefix = 'Clients ' + time.asctime()
+    sinks = {status: StatusSink('{} {}.csv'.format(prefix, status))
+             for status in STATUS_FILES}
+    buffers = {status: [] for status in STATUS_FILES}
+    try:
+        for client in clients:
+            status = client.mailchimp_status
+            if (status not in buffers or
+                    not validate_email(client.email_address)):
+                status = 'invalid'
+            buffer = buffers[status]
+            buffer.append([getattr(client, column) for column in COLUMNS])
+            if (len(buffer) >= buffer_rows):
+                sinks[status].put(buffer)
+                buffers[status] = []
+    finally:
+        for status, sink in sinks.items():
+            if (buffers[status]):
+                sink.put(buffers[status])
+            sink.close()
+    return Counter({status: sink.rows for status, sink in sinks.items()})
+
+
+def write_users_out(clients, filename=None):
+    """The file output of a run without SendMCEmail: every client to a file
+    per status with StatusFiles (filename is then the prefix), or else the
+    ones still to subscribe with write_users_to_file. Returns a Counter of
+    clients per status file"""
+    if (CONFIG.get('StatusFiles')):
+        return write_users_by_status(clients, filename)
+    write_users_to_file(clients, filename)
+    return Counter()
+
+
+def load_manifest(manifest_file):
+    """Read a manifest of jobs from disk. Each row holds the path to a
+    conf file and the path to the users file to run against it.
+    Returns a list of (conf_file, users_file) tuples"""
+    jobs = []
+    with open(manifest_file, 'r') as f:
+        for row in csv.reader(f):
+            if (len(row) >= 2 and not row[0].strip().startswith('#')):
+                jobs.append((row[0].strip(), row[1].strip()))
+
+    return jobs
+
+
+def run_job(conf_file, users_file):
+    """Run a single (conf, users) job and report how it went. Meant to be
+    called in a worker process, so it sets up its own CONFIG."""
+    global CONFIG
+    result = {'conf': conf_file, 'users': users_file, 'clients': 0,
+              'ok': False, 'error': ''}
+    start = time.perf_counter()
+    try:
+        CONFIG = load_conf(conf_file)
+        users = load_users(users_file)
+        result['clients'] = len(users)
+        writes = process_users(users, CONFIG['ListID'], CONFIG['User'],
+                               CONFIG['Key'])
+        result['statuses'] = dict(Counter(
+            client.mailchimp_status for client in users.values()))
+        result['writes'] = dict(writes)
+        result['ok'] = True
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def job_account(conf_file):
+    """The Mailchimp account a job runs against, used to cap how many
+    jobs hit the same account at once."""
+    try:
+        return load_conf(conf_file)['User']
+    except KeyError:
+        return conf_file
+
+
+def run_jobs(jobs, max_workers=None, per_account=1):
+    """Takes a list of (conf_file, users_file) jobs and runs them in a
+    process pool, never running more than per_account jobs against the
+    same Mailchimp account at a time. Returns the job results in manifest
+    order."""
+    from concurrent.futures import wait, FIRST_COMPLETED
+    if (per_account < 1):
+        raise ValueError('per_account must be at least 1')
+    waiting = [(i, job_account(conf), conf, users)
+               for i, (conf, users) in enumerate(jobs)]
+    running = dict()
+    in_flight = Counter()
+    results = [None] * len(jobs)
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        while (waiting or running):
+            for job in list(waiting):
+                index, account, conf, users = job
+                if (in_flight[account] < per_account):
+                    waiting.remove(job)
+                    in_flight[account] += 1
+                    future = pool.submit(run_job, conf, users)
+                    running[future] = (index, account)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, account = running.pop(future)
+                in_flight[account] -= 1
+                results[index] = future.result()
+
+    return results
+
+
+def format_counts(counts):
+    """ returns a Counter or dictionary of counts as 'key=count, ...'"""
+    return ', '.join('{}={}'.format(key, count)
+                     for key, count in sorted(counts.items()))
+
+
+def format_job_report(results):
+    """Takes the results of run_jobs and returns a printable report with
+    the timing and outcome of every job."""
+    lines = []
+    for result in results:
+        outcome = 'ok' if result['ok'] else 'FAILED ' + result['error']
+        lines.append('{} {}: {} clients in {:.2f}s {} {} {}'.format(
+            result['conf'], result['users'], result['clients'],
+            result['seconds'], outcome,
+            format_counts(result.get('statuses', {})),
+            format_counts(result.get('writes', {}))).rstrip())
+    failed = sum(1 for result in results if not result['ok'])
+    lines.append('{} jobs, {} failed, {:.2f}s total job time'.format(
+        len(results), failed, sum(r['seconds'] for r in results)))
+    return '\n'.join(lines)
+
+
+def shard_prefixes(prefix_len):
+    """All the email_hash prefixes of the given length, one per shard"""
+    width = 16 ** prefix_len
+    return ['{:0{}x}'.format(i, prefix_len) for i in range(width)]
+
+
+def shard_users(users, prefix):
+    """Takes a dictionary of client objects and returns the ones whose
+    email_hash falls in the shard"""
+    return {email: client for email, client in users.items()
+            if client.email_hash.startswith(prefix)}
+
+
+class ShardQueue:
+    """A shared work queue of email_hash shards, backed by SQLite so it can
+    stand in for a real queue on a shared filesystem or in local testing.
+    Claims are leases: a shard whose worker stops heartbeating goes back
+    up for grabs once its lease expires, until it has been claimed
+    max_attempts times. A shard that keeps killing its workers is then
+    marked failed rather than handed out forever."""
+    def __init__(self, path, lease_seconds=600, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS shards ('
+                       'prefix TEXT PRIMARY KEY, users_file TEXT, '
+                       'state TEXT, worker TEXT, lease_expires REAL, '
+                       'attempts INTEGER DEFAULT 0, result TEXT)')
+
+    def _connect(self):
+        # A connection per call keeps the queue safe to use from the
+        # heartbeat thread as well as the worker loop.
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.execute('BEGIN IMMEDIATE')
+        return _Transaction(db)
+
+    def publish(self, users_file, prefixes, reset=False):
+        """Queue a pending shard per prefix. Refuses to overwrite a queue
+        that already holds shards, whose done and claimed state would be
+        lost, unless reset"""
+        with self._connect() as db:
+            queued = db.execute('SELECT COUNT(*) FROM shards').fetchone()[0]
+            if (queued and not reset):
+                raise ValueError('{} already holds {} shards, reset it to '
+                                 'publish again'.format(self.path, queued))
+            db.execute('DELETE FROM shards')
+            db.executemany('INSERT OR REPLACE INTO shards (prefix, users_file,'
+                           ' state) VALUES (?, ?, ?)',
+                           [(prefix, users_file, 'pending')
+                            for prefix in prefixes])
+
+    def claim(self, worker_id):
+        """Claim a pending shard, or one whose lease has expired. Returns a
+        (prefix, users_file) tuple, or None when there is nothing left to
+        claim."""
+        now = time.time()
+        with self._connect() as db:
+            self._give_up(db, now)
+            row = db.execute('SELECT prefix, users_file FROM shards WHERE '
+                             'state = ? OR (state = ? AND lease_expires < ?) '
+                             'ORDER BY prefix LIMIT 1',
+                             ('pending', 'claimed', now)).fetchone()
+            if (row is not None):
+                db.execute('UPDATE shards SET state = ?, worker = ?, '
+                           'lease_expires = ?, attempts = attempts + 1 '
+                           'WHERE prefix = ?',
+                           ('claimed', worker_id, now + self.lease_seconds,
+                            row[0]))
+        return row
+
+    def _give_up(self, db, now):
+        """ marks failed the expired shards out of attempts"""
+        db.execute('UPDATE shards SET state = ? WHERE state = ? AND '
+                   'lease_expires < ? AND attempts >= ?',
+                   ('failed', 'claimed', now, self.max_attempts))
+
+    def heartbeat(self, prefix, worker_id):
+        with self._connect() as db:
+            db.execute('UPDATE shards SET lease_expires = ? WHERE prefix = ? '
+                       'AND worker = ? AND state = ?',
+                       (time.time() + self.lease_seconds, prefix, worker_id,
+                        'claimed'))
+
+    def complete(self, prefix, worker_id, result):
+        with self._connect() as db:
+            db.execute('UPDATE shards SET state = ?, result = ? WHERE '
+                       'prefix = ? AND worker = ?',
+                       ('done', json.dumps(result), prefix, worker_id))
+
+    def progress(self):
+        """Returns a dictionary of shard counts keyed on state"""
+        with self._connect() as db:
+            self._give_up(db, time.time())
+            return dict(db.execute('SELECT state, COUNT(*) FROM shards '
+                                   'GROUP BY state').fetchall())
+
+    def results(self):
+        with self._connect() as db:
+            rows = db.execute('SELECT prefix, worker, attempts, result FROM '
+                              'shards WHERE state = ? ORDER BY prefix',
+                              ('done',)).fetchall()
+        return [dict(json.loads(result), prefix=prefix, worker=worker,
+                     attempts=attempts)
+                for prefix, worker, attempts, result in rows]
+
+    def failed(self):
+        """ returns the (prefix, attempts) of the shards given up on"""
+        with self._connect() as db:
+            return db.execute('SELECT prefix, attempts FROM shards WHERE '
+                              'state = ? ORDER BY prefix',
+                              ('failed',)).fetchall()
+
+
+class _Transaction:
+    """Commits on a clean exit, rolls back otherwise, and always closes"""
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
+        self.db.close()
+
+
+def _keep_lease(queue, prefix, worker_id, stop):
+    while (not stop.wait(queue.lease_seconds / 3.0)):
+        queue.heartbeat(prefix, worker_id)
+
+
+def run_worker(queue, worker_id, list_id, mc_user, mc_key):
+    """Claim shards from the queue until it runs dry, running the status
+    lookups and writes for each one. Returns the number of shards done."""
+    loaded = dict()
+    done = 0
+    claim = queue.claim(worker_id)
+    while (claim is not None):
+        prefix, users_file = claim
+        if (users_file not in loaded):
+            loaded[users_file] = load_users(users_file)
+        users = shard_users(loaded[users_file], prefix)
+        stop = threading.Event()
+        keeper = threading.Thread(target=_keep_lease,
+                                  args=(queue, prefix, worker_id, stop))
+        keeper.daemon = True
+        keeper.start()
+        start = time.perf_counter()
+        try:
+            writes = process_users(
+                users, list_id, mc_user, mc_key,
+                'Non-subscribed Clients shard-{} {}.csv'.format(
+                    prefix, time.asctime()))
+        finally:
+            stop.set()
+            keeper.join()
+        queue.complete(prefix, worker_id, {
+            'clients': len(users),
+            'seconds': time.perf_counter() - start,
+            'statuses': dict(Counter(
+                client.mailchimp_status for client in users.values())),
+            'writes': dict(writes)})
+        done += 1
+        claim = queue.claim(worker_id)
+
+    return done
+
+
+def coordinate(queue, users_file, prefix_len=1, poll_seconds=5,
+               reset=False):
+    """Split users_file into email_hash shards, publish them to the queue and
+    wait for the workers to finish them all, or give up on them. Returns
+    the shard results."""
+    queue.publish(users_file, shard_prefixes(prefix_len), reset)
+    progress = queue.progress()
+    while (set(progress) - {'done', 'failed'}):
+        time.sleep(poll_seconds)
+        progress = queue.progress()
+
+    return queue.results()
+
+
+def format_shard_report(results, failed=()):
+    statuses = Counter()
+    writes = Counter()
+    for result in results:
+        statuses.update(result['statuses'])
+        writes.update(result.get('writes', {}))
+    workers = Counter(result['worker'] for result in results)
+    retried = sum(1 for result in results if result['attempts'] > 1)
+    lines = ['{}: {} shards'.format(worker, count)
+             for worker, count in sorted(workers.items())]
+    lines.append('{} shards ({} reassigned), {} clients: {}'.format(
+        len(results), retried, sum(r['clients'] for r in results),
+        format_counts(statuses)))
+    if (writes):
+        lines.append('writes: ' + format_counts(writes))
+    if (failed):
+        lines.append('{} shards failed: {}'.format(len(failed), ', '.join(
+            '{} after {} attempts'.format(prefix, attempts)
+            for prefix, attempts in failed)))
+    return '\n'.join(lines)
+
+
+class Profiler:
+    """Profiles a run, or with stage only the calls to that stage function.
+    cProfile records each thread with its own profile, for pstats: the
+    thread the run started on and the threads started during it, or with
+    stage whichever threads call it. A sampling thread records the stacks
+    of every thread (with stage, of the threads inside it) every `interval`
+    seconds, as collapsed stacks for flamegraph tools."""
+    STAGES = ('load_users', 'set_mailchimp_status', 'add_users_to_mailchimp',
+              'write_users_to_file')
+
+    def __init__(self, stage=None, interval=0.005):
+        if (stage is not None and stage not in self.STAGES):
+            raise ValueError('Unknown stage {}'.format(stage))
+        self.stage = stage
+        self.interval = interval
+        # thread ident -> cProfile.Profile
+        self.profiles = dict()
+        self.stacks = Counter()
+        self.inside = Counter()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def __enter__(self):
+        self.sampler = threading.Thread(target=self._sample, daemon=True)
+        self.sampler.start()
+        if (self.stage is None):
+            # threads started from here on enable their own profile
+            threading.setprofile(self._profile_thread)
+            self._thread_profile().enable()
+        else:
+            self.function = globals()[self.stage]
+            globals()[self.stage] = self._wrap(self.function)
+        return self
+
+    def __exit__(self, *exc_info):
+        if (self.stage is None):
+            self._thread_profile().disable()
+            threading.setprofile(None)
+        else:
+            globals()[self.stage] = self.function
+        self.stopped.set()
+        self.sampler.join()
+
+    def _thread_profile(self):
+        """ returns the calling thread's profile"""
+        import cProfile
+        ident = threading.get_ident()
+        with self.lock:
+            if (ident not in self.profiles):
+                self.profiles[ident] = cProfile.Profile()
+            return self.profiles[ident]
+
+    def _profile_thread(self, frame, event, arg):
+        # set by threading.setprofile, called once as a thread starts; the
+        # thread's own profile takes over from it
+        self._thread_profile().enable()
+
+    def _wrap(self, function):
+        @functools.wraps(function)
+        def profiled(*args, **kwargs):
+            ident = threading.get_ident()
+            with self.lock:
+                self.inside[ident] += 1
+                # only the outermost call turns the profile on and off
+                outermost = self.inside[ident] == 1
+            profile = self._thread_profile()
+            if (outermost):
+                profile.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                if (outermost):
+                    profile.disable()
+                with self.lock:
+                    self.inside[ident] -= 1
+        return profiled
+
+    def _sample(self):
+        me = threading.get_ident()
+        names = {}
+        while (not self.stopped.wait(self.interval)):
+            with self.lock:
+                inside = +self.inside
+            for ident, frame in sys._current_frames().items():
+                if (ident == me or (self.stage and ident not in inside)):
+                    continue
+                if (ident not in names):
+                    names = {thread.ident: thread.name
+                             for thread in threading.enumerate()}
+                self.stacks[self._collapse(names.get(ident, ident),
+                                           frame)] += 1
+
+    @staticmethod
+    def _collapse(thread_name, frame):
+        """ returns 'thread;file:function;...' from the root to frame"""
+        stack = []
+        while (frame is not None):
+            code = frame.f_code
+            stack.append('{}:{}'.format(os.path.basename(code.co_filename),
+                                        code.co_name))
+            frame = frame.f_back
+        stack.append(str(thread_name))
+        return ';'.join(reversed(stack))
+
+    def write(self, filename):
+        """ writes the pstats of every thread's profile, merged, to filename
+        and the collapsed stacks to filename.folded. Returns the number of
+        samples, or None if no profile recorded anything"""
+        import pstats
+        stats = None
+        for profile in self.profiles.values():
+            profile.create_stats()
+            if (not profile.stats):
+                continue
+            if (stats is None):
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        if (stats is None):
+            return None
+        stats.dump_stats(filename)
+        with open(filename + '.folded', 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('{} {}\n'.format(stack, count))
+        return sum(self.stacks.values())
+
+
+def format_profile(filename, samples, top=15):
+    """ returns the functions with the most cumulative time in the pstats
+    at filename, and where the profile was written"""
+    import pstats
+    out = io.StringIO()
+    pstats.Stats(filename, stream=out).sort_stats('cumulative').print_stats(
+        top)
+    return ('{}\nprofile: pstats in {}, {} samples of collapsed stacks in '
+            '{}.folded'.format(out.getvalue().strip(), filename, samples,
+                               filename))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Subscribe users to a Mailchimp list')
+    parser.add_argument('conf_file', nargs='?')
+    parser.add_argument('users_file', nargs='?')
+    parser.add_argument('--manifest',
+                        help='CSV of conf_file,users_file jobs to run in '
+                             'parallel')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='size of the process pool for --manifest and '
+                             '--validate')
+    parser.add_argument('--per-account', type=int, default=1,
+                        help='max concurrent jobs per Mailchimp account')
+    parser.add_argument('--coordinator', metavar='QUEUE',
+                        help='shard users_file onto the QUEUE database and '
+                             'wait for workers to process it')
+    parser.add_argument('--worker', metavar='QUEUE',
+                        help='process shards from the QUEUE database '
+                             'using conf_file')
+    parser.add_argument('--worker-id',
+                        help='defaults to hostname:pid')
+    parser.add_argument('--shard-prefix', type=int, default=1,
+                        help='email_hash prefix length to shard on')
+    parser.add_argument('--lease', type=float, default=600,
+                        help='seconds before a silent worker loses its shard')
+    parser.add_argument('--max-attempts', type=int, default=3,
+                        help='times a shard is claimed before it is given '
+                             'up on as failed')
+    parser.add_argument('--reset', action='store_true',
+                        help='let --coordinator publish over a queue that '
+                             'already holds shards')
+    parser.add_argument('--plan', action='store_true',
+                        help='estimate the API calls and run time without '
+                             'contacting Mailchimp')
+    parser.add_argument('--statuses', metavar='FILE',
+                        help='email_hash,status CSV of known statuses for '
+                             '--plan')
+    parser.add_argument('--latency', type=float, default=0.25,
+                        help='assumed seconds per API call for --plan')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='stream users through concurrent parse, '
+                             'lookup and write stages')
+    parser.add_argument('--queue-size', type=int, default=1000,
+                        help='capacity of each --pipeline queue')
+    parser.add_argument('--table', action='store_true',
+                        help='hold the users in a columnar ClientTable '
+                             'rather than one Client object each')
+    parser.add_argument('--dedup', metavar='USERS_FILE',
+                        help='deduplicate USERS_FILE on disk, for files too '
+                             'big to hold in memory')
+    parser.add_argument('--out', metavar='FILE',
+                        help='where --dedup writes the unique clients, '
+                             '--reconcile the members it would archive, and '
+                             '--diff its report directory')
+    parser.add_argument('--memory-limit', type=int, default=256,
+                        help='MiB --dedup may hold in memory at once')
+    parser.add_argument('--validate', metavar='USERS_FILE',
+                        help='check USERS_FILE offline and report the rows '
+                             'load_users would drop')
+    parser.add_argument('--rejects', metavar='FILE',
+                        help='where --validate writes the rejected rows')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='profile the run, writing pstats to FILE and '
+                             'collapsed stacks to FILE.folded')
+    parser.add_argument('--profile-stage', choices=Profiler.STAGES,
+                        help='profile only the calls to this stage')
+    parser.add_argument('--reconcile', action='store_true',
+                        help='archive the list members missing from '
+                             'users_file')
+    parser.add_argument('--max-archive', type=float, default=5.0,
+                        metavar='PERCENT',
+                        help='abort --reconcile if it would archive more '
+                             'than PERCENT of the list')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only report what --reconcile would archive')
+    parser.add_argument('--batch-timeout', type=float, default=3600,
+                        metavar='SECONDS',
+                        help='give up on a --reconcile batch that has not '
+                             'finished after SECONDS')
+    parser.add_argument('--diff', metavar='LAST_USERS_FILE',
+                        help='report how users_file differs from '
+                             'LAST_USERS_FILE and from the list')
+    args = parser.parse_args(argv)
+    if (args.per_account < 1):
+        parser.error('--per-account must be at least 1')
+    if (args.profile_stage and not args.profile):
+        parser.error('--profile-stage needs --profile')
+    if (args.worker and args.conf_file is None):
+        parser.error('conf_file is required with --worker')
+    if (not (args.manifest or args.worker or args.validate or args.dedup) and
+            args.users_file is None):
+        parser.error('conf_file and users_file are required')
+    return args
+
+
+def run_manifest(args):
+    results = run_jobs(load_manifest(args.manifest), args.workers,
+                       args.per_account)
+    print(format_job_report(results))
+    return 0 if all(result['ok'] for result in results) else 1
+
+
+def run_coordinator(args):
+    queue = ShardQueue(args.coordinator, args.lease, args.max_attempts)
+    try:
+        results = coordinate(queue, args.users_file, args.shard_prefix,
+                             reset=args.reset)
+    except ValueError as e:
+        print('Aborting: {}'.format(e))
+        return 1
+    failed = queue.failed()
+    print(format_shard_report(results, failed))
+    return 1 if failed else 0
+
+
+def run_shard_worker(args):
+    import socket
+    worker_id = args.worker_id or '{}:{}'.format(socket.gethostname(),
+                                                 os.getpid())
+    queue = ShardQueue(args.worker, args.lease, args.max_attempts)
+    run_worker(queue, worker_id, CONFIG['ListID'], CONFIG['User'],
+               CONFIG['Key'])
+    return 0
+
+
+def run_plan(args):
+    with contextlib.ExitStack() as stack:
+        known = None
+        if (args.statuses):
+            known = load_known_statuses(args.statuses)
+        elif (CONFIG['MirrorFile'] and os.path.exists(CONFIG['MirrorFile'])):
+            known = stack.enter_context(ListMirror(CONFIG['MirrorFile'],
+                                                   CONFIG['ListID']))
+        print(format_plan(plan_run(args.users_file, CONFIG, known,
+                                   args.latency)))
+    return 0
+
+
+def run_validate(args):
+    rejects_file = args.rejects or \
+        'Rejected rows ' + time.asctime() + '.csv'
+    stats = validate_users(args.validate, rejects_file, args.workers)
+    print(format_validation(stats, rejects_file))
+    return 0
+
+
+def run_dedup(args):
+    out_file = args.out or \
+        'Deduplicated Clients ' + time.asctime() + '.csv'
+    start = time.perf_counter()
+    written = write_clients(external_dedup(args.dedup,
+                                           args.memory_limit * 1048576),
+                            out_file)
+    print('{} unique clients written to {} in {:.1f}s'.format(
+        written, out_file, time.perf_counter() - start))
+    return 0
+
+
+@contextlib.contextmanager
+def synced_mirror(mc_client):
+    """ yields the configured ListMirror, or a temporary one, synced"""
+    with tempfile.TemporaryDirectory() as tmp:
+        mirror = ListMirror(CONFIG.get('MirrorFile') or
+                            os.path.join(tmp, 'mirror.db'), CONFIG['ListID'])
+        try:
+            mirror.sync(mc_client)
+            yield mirror
+        finally:
+            mirror.close()
+
+
+def run_reconcile(args):
+    mc_client = make_mc_client(CONFIG['User'], CONFIG['Key'])
+    with synced_mirror(mc_client) as mirror:
+        extras, members = plan_archive(args.users_file, mirror,
+                                       args.memory_limit * 1048576)
+    print(format_archive_plan(extras, members, args.max_archive))
+    if (args.out):
+        with open(args.out, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['email_hash', 'status'])
+            writer.writerows(extras)
+    if (extras and 100.0 * len(extras) > args.max_archive * members):
+        print('Aborting: raise --max-archive to archive this many')
+        return 1
+    if (args.dry_run or not extras):
+        return 0
+    try:
+        counts = archive_members(mc_client, CONFIG['ListID'],
+                                 [email_hash for email_hash, _ in extras],
+                                 timeout=args.batch_timeout)
+    except TimeoutError as e:
+        print('Aborting: {}'.format(e))
+        return 1
+    print(format_counts(counts))
+    return 0
+
+
+def run_diff(args):
+    out_dir = args.out or 'Diff ' + time.asctime()
+    mc_client = make_mc_client(CONFIG['User'], CONFIG['Key'])
+    with synced_mirror(mc_client) as mirror:
+        counts = diff_users(args.users_file, args.diff, mirror, out_dir,
+                            args.memory_limit * 1048576)
+    print('{} written to {}'.format(format_counts(counts) or 'no differences',
+                                    out_dir))
+    return 0
+
+
+def run_pipeline(args):
+    mc_client = make_mc_client(CONFIG['User'], CONFIG['Key'])
+    writes, stats = pipeline_users(stream_unique_clients(args.users_file),
+                                   CONFIG['ListID'], CONFIG['User'],
+                                   CONFIG['Key'],
+                                   queue_size=args.queue_size,
+                                   mc_client=mc_client)
+    if (writes):
+        print(format_counts(writes))
+    print(format_pipeline_stats(stats))
+    if (mc_client.limiter is not None):
+        print(format_concurrency(mc_client.limiter))
+    return 0
+
+
+def run_users(args):
+    if (args.pipeline):
+        return run_pipeline(args)
+    pool = StringPool(CONFIG['InternColumns'])
+    if (args.table):
+        users = ClientTable.from_csv(args.users_file)
+    else:
+        users = load_users(args.users_file, pool)
+    mc_client = make_mc_client(CONFIG['User'], CONFIG['Key'])
+    writes = process_users(users, CONFIG['ListID'], CONFIG['User'],
+                           CONFIG['Key'], mc_client=mc_client)
+    if (writes):
+        print(format_counts(writes))
+    if (pool.saved):
+        print(format_string_pool(pool))
+    if (mc_client.limiter is not None):
+        print(format_concurrency(mc_client.limiter))
+    return 0
+
+
+def run_profiled(args):
+    profiler = Profiler(args.profile_stage)
+    with profiler:
+        status = dispatch(args)
+    samples = profiler.write(args.profile)
+    if (samples is None):
+        # only with a stage, as the run itself is always profiled
+        print('profile: no samples, {} was never called'.format(
+            args.profile_stage))
+    else:
+        print(format_profile(args.profile, samples))
+    return status
+
+
+def dispatch(args):
+    global CONFIG
+    if (args.manifest):
+        return run_manifest(args)
+    if (args.coordinator):
+        return run_coordinator(args)
+    if (args.validate):
+        return run_validate(args)
+    if (args.dedup):
+        return run_dedup(args)
+
+    CONFIG = load_conf(args.conf_file)
+    if (args.worker):
+        return run_shard_worker(args)
+    if (args.plan):
+        return run_plan(args)
+    if (args.reconcile):
+        return run_reconcile(args)
+    if (args.diff):
+        return run_diff(args)
+    return run_users(args)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if (args.profile):
+        return run_profiled(args)
+    return dispatch(args)
+
+
 if __name__ == "__main__":
-    CONFIG = load_conf(sys.argv[1])
-    users = load_users(sys.argv[2])
-    process_users(users, CONFIG['ListID'], CONFIG['User'], CONFIG['Key'])
+    sys.exit(main())
@@ -1,13 +1,59 @@
+import csv
+import hashlib
+import json
+import sqlite3
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from collections import Counter
 import requests
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
 from hypothesis import given, strategies as st
 from unittest.mock import patch, MagicMock, call, mock_open
+from mailchimp3.mailchimpclient import MailChimpError
 from mailchimp_subscriber import (
     load_conf, load_users, validate_email,
     add_users_to_mailchimp, Client, set_mailchimp_status,
-    write_users_to_file, EMAIL_RE
+    write_users_to_file, EMAIL_RE, load_manifest, run_job, run_jobs,
+    format_job_report, ShardQueue, run_worker, shard_prefixes, shard_users,
+    format_shard_report, tag_clients, group_clients_by_tag, plan_run,
+    format_plan, main, ListMirror, DigestIndex, build_digest_index,
+    validate_users, detect_encoding, RowProjector, resolve_header,
+    ClientTable, external_dedup, stream_unique_clients, pipeline_users,
+    CircuitBreaker, CircuitOpenError, make_mc_client, HTTP2Transport,
+    make_transport, TrafficMeter, endpoint_name, requests_response,
+    JSONCodec, TraceLog, SessionTransport, traced_member, AdaptiveLimit,
+    format_concurrency, external_sort_hashes, missing_members, diff_users,
+    member_hash, sorted_user_rows, write_users_by_status, StringPool,
+    plan_archive, make_tagger, lazy_import, validate_chunk,
+    format_validation
 )
 
+
+def mailchimp_error(status, title='Resource Not Found'):
+    """ the MailChimpError mailchimp3 raises for an error response"""
+    response = requests_response(status, b'', {}, 'https://x/3.0/')
+    return MailChimpError({'response': response, 'status': status,
+                           'title': title})
+
+
+def stub_transport(responses):
+    """ returns a transport answering each call with the next (status, body)
+    of responses, for a real mailchimp3 client from make_mc_client"""
+    responses = iter(responses)
+
+    def make_request(**kwargs):
+        status, body = next(responses)
+        return requests_response(status, json.dumps(body).encode('utf-8'),
+                                 {}, kwargs['url'])
+    return make_request
+
+
 CLIENT_FACTORY = st.builds(
                     Client,
                     st.from_regex(EMAIL_RE),
@@ -41,6 +87,8 @@ class TestMailchimpSubscriber(unittest.TestCase):
             return_value={'status': 'pending'})
         set_mailchimp_status(ctl_client, mock_client, '1234')
         self.assertEqual(ctl_client.mailchimp_status, 'pending')
+        mock_client.lists.members.get.assert_called_once_with(
+            '1234', ctl_client.email_hash, fields='status,merge_fields')
 
         # Test subscribed
         ctl_client = Client('foo@bar.com', 'John', 'Doe')
@@ -66,10 +114,32 @@ class TestMailchimpSubscriber(unittest.TestCase):
         # Test not_present
         ctl_client = Client('foo@bar.com', 'John', 'Doe')
         mock_client.lists.members.get = MagicMock(
-            side_effect=requests.exceptions.HTTPError)
+            side_effect=mailchimp_error(404))
         set_mailchimp_status(ctl_client, mock_client, '1234')
         self.assertEqual(ctl_client.mailchimp_status, 'not_present')
 
+    def test_import_skips_network_stack(self):
+        # requests is registered lazily, so look for what it would pull in
+        code = ('import sys, mailchimp_subscriber; '
+                'print(sorted(m for m in ("urllib3", "mailchimp3") '
+                'if m in sys.modules))')
+        output = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(output.strip(), b'[]')
+
+    def test_lazy_import_loads_once_across_threads(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'slow_module.py'), 'w') as f:
+                f.write('import time\nLOADS = []\ntime.sleep(0.1)\n'
+                        'LOADS.append(1)\nVALUE = 42\n')
+            sys.path.insert(0, tmp)
+            self.addCleanup(sys.path.remove, tmp)
+            self.addCleanup(sys.modules.pop, 'slow_module', None)
+            module = lazy_import('slow_module')
+            with ThreadPoolExecutor(4) as pool:
+                values = list(pool.map(lambda _: module.VALUE, range(4)))
+        self.assertEqual(values, [42] * 4)
+        self.assertEqual(module.LOADS, [1])
+
     def test_load_conf(self):
         config = load_conf('tests/test.conf')
         self.assertEqual(config['ListID'], '1234')
@@ -77,6 +147,191 @@ class TestMailchimpSubscriber(unittest.TestCase):
         self.assertEqual(config['Key'], '123xyz')
         self.assertEqual(config['SendMCEmail'], False)
 
+    def test_load_users_with_header(self):
+        rows = ['Role,Surname,E-Mail,Notes,First Name',
+                'Faculty,Foo,alice@columbia.edu,"Met at, the fair",Alice',
+                'Staff,Bar,bob@columbia.edu,,Bob',
+                'Staff,Baz,carol@columbia.edu']
+        with tempfile.TemporaryDirectory() as tmp:
+            users_file = os.path.join(tmp, 'users.csv')
+            with open(users_file, 'w') as f:
+                f.write('\n'.join(rows) + '\n')
+            users = load_users(users_file)
+
+        self.assertEqual(sorted(users), ['alice@columbia.edu',
+                                         'bob@columbia.edu'])
+        alice = users['alice@columbia.edu']
+        self.assertEqual((alice.first_name, alice.last_name,
+                          alice.interaction_notes, alice.job_role),
+                         ('Alice', 'Foo', 'Met at the fair', 'Faculty'))
+
+    def test_load_users_interns_columns(self):
+        rows = ['Role,Surname,E-Mail,First Name',
+                'Faculty,Foo,alice@columbia.edu,Alice',
+                'Faculty,Bar,bob@columbia.edu,Bob',
+                'Staff,Baz,carol@columbia.edu,Carol',
+                'Faculty,Baz,dan@columbia.edu,Dan']
+        with tempfile.TemporaryDirectory() as tmp:
+            users_file = os.path.join(tmp, 'users.csv')
+            with open(users_file, 'w') as f:
+                f.write('\n'.join(rows) + '\n')
+            pool = StringPool(['job_role', 'last_name'], max_values=2)
+            users = load_users(users_file, pool)
+
+        roles = [client.job_role for client in users.values()]
+        self.assertEqual(roles, ['Faculty', 'Faculty', 'Staff', 'Faculty'])
+        self.assertIs(roles[0], roles[1])
+        self.assertIs(roles[0], roles[3])
+        # the cap left Baz out of the pool, so its copies are kept
+        self.assertEqual(sorted(pool.pools['last_name']), ['Bar', 'Foo'])
+        self.assertIsNot(users['carol@columbia.edu'].last_name,
+                         users['dan@columbia.edu'].last_name)
+        self.assertEqual(pool.saved,
+                         {'job_role': 2 * sys.getsizeof('Faculty')})
+        with self.assertRaises(ValueError):
+            StringPool(['email_address'])
+
+    def test_row_projector(self):
+        self.assertIsNone(resolve_header(['alice@columbia.edu', 'Alice',
+                                          'Foo']))
+        project = RowProjector(resolve_header(['email', 'fname', 'lname',
+                                               'job_title']))
+        self.assertEqual(project(['a@b.com', 'A', 'B', 'Dean']),
+                         ('a@b.com', 'A', 'B', '', 'Dean'))
+        project = RowProjector()
+        self.assertEqual(project(['a@b.com', 'A', 'B']),
+                         ('a@b.com', 'A', 'B', '', ''))
+        self.assertEqual(project(['a@b.com', 'A', 'B', 'Notes', 'Dean']),
+                         ('a@b.com', 'A', 'B', 'Notes', 'Dean'))
+
+    def test_load_users_encodings(self):
+        text = ('jose@columbia.edu,Jos\xe9,M\xfcller\r\n'
+                'zoe@columbia.edu,Zo\xeb,Stra\xdfe\r\n') * 50
+        encodings = [('utf-8', 'utf-8'), ('utf-8-sig', 'utf-8-sig'),
+                     ('cp1252', 'cp1252'), ('utf-16', 'utf-16'),
+                     ('utf-16-le', 'utf-16-le')]
+        with tempfile.TemporaryDirectory() as tmp:
+            users_file = os.path.join(tmp, 'users.csv')
+            for encoding, expected in encodings:
+                with open(users_file, 'w', encoding=encoding,
+                          newline='') as f:
+                    f.write(text)
+                self.assertEqual(detect_encoding(users_file), expected)
+                users = load_users(users_file)
+                self.assertEqual(users['jose@columbia.edu'].first_name,
+                                 'Jos\xe9')
+                self.assertEqual(users['zoe@columbia.edu'].last_name,
+                                 'Stra\xdfe')
+
+    @patch('mailchimp_subscriber.ProcessPoolExecutor', ThreadPoolExecutor)
+    def test_undefined_cp1252_bytes(self):
+        # 0x81 has no character in cp1252, so a strict decode would stop
+        # the load at the last row
+        data = ('jose@columbia.edu,Jos\xe9,M\xfcller\r\n' * 50).encode(
+            'cp1252') + b'ann@columbia.edu,An\x81n,Doe\r\n'
+        with tempfile.TemporaryDirectory() as tmp:
+            users_file = os.path.join(tmp, 'users.csv')
+            with open(users_file, 'wb') as f:
+                f.write(data)
+            self.assertEqual(detect_encoding(users_file), 'cp1252')
+            with patch('sys.stderr') as mock_stderr:
+                users = load_users(users_file)
+            self.assertEqual(users['ann@columbia.edu'].first_name,
+                             'An\ufffdn')
+            self.assertIn('1 bytes of {} are not valid cp1252'.format(
+                users_file), str(mock_stderr.write.call_args_list))
+            stats = validate_users(users_file, os.path.join(tmp, 'r.csv'),
+                                   workers=2, chunk_size=256)
+        self.assertEqual((stats['accepted'], stats['replaced']), (2, 1))
+        self.assertIn('1 bytes did not decode',
+                      format_validation(stats, 'r.csv'))
+
+    @patch('mailchimp_subscriber.MailChimp')
+    def test_plan_run(self, mock_mail_chimp):
+        config = load_conf('tests/test.conf')
+        config['SendMCEmail'] = True
+        users = load_users('tests/test-user-list.csv')
+        nick = users['nick@columbia.edu']
+        # bob's fields are unknown, so his update is assumed; nick is
+        # pending with the fields the file has, so he is skipped
+        known = {users['alice@columbia.edu'].email_hash: ('not_present', {}),
+                 users['bob@columbia.edu'].email_hash: ('pending', {}),
+                 nick.email_hash: ('pending', nick.get_mc_fields())}
+        plan = plan_run('tests/test-user-list.csv', config, known,
+                        latency=0.5)
+        self.assertEqual((plan['gets'], plan['creates'], plan['updates'],
+                          plan['skips'], plan['unknown']), (1, 1, 1, 1, 1))
+        # one GET, one create, one update and a possible write for joe,
+        # at one call in flight every half second
+        self.assertEqual(plan['calls'], 4)
+        self.assertEqual(plan['seconds'], 2.0)
+        self.assertGreater(plan['memory'], 0)
+        self.assertIn('at most 4 API calls', format_plan(plan))
+        mock_mail_chimp.assert_not_called()
+
+        with patch('builtins.print') as mock_print:
+            self.assertEqual(main(['--plan', 'tests/test.conf',
+                                   'tests/test-user-list.csv']), 0)
+        self.assertIn('GETs: 4', mock_print.call_args[0][0])
+        mock_mail_chimp.assert_not_called()
+
+    def test_profile(self):
+        import mailchimp_subscriber
+        import pstats
+        load = mailchimp_subscriber.load_users
+        with tempfile.TemporaryDirectory() as tmp:
+            profile = os.path.join(tmp, 'run.prof')
+            for stage in ([], ['--profile-stage', 'load_users']):
+                with patch('builtins.print') as mock_print:
+                    self.assertEqual(main(['--plan', 'tests/test.conf',
+                                           'tests/test-user-list.csv',
+                                           '--profile', profile] + stage),
+                                     0)
+                self.assertIn('profile: pstats in ' + profile,
+                              mock_print.call_args[0][0])
+                functions = {function[2] for function in
+                             pstats.Stats(profile).stats}
+                self.assertIn('load_users', functions)
+                # only the stage was profiled, not the plan around it
+                self.assertEqual('plan_run' in functions, not stage)
+                self.assertTrue(os.path.exists(profile + '.folded'))
+        self.assertIs(mailchimp_subscriber.load_users, load)
+
+    @patch('mailchimp_subscriber.MailChimp')
+    def test_profile_threaded_stage(self, mock_mail_chimp):
+        import mailchimp_subscriber
+        import pstats
+        mock_mail_chimp().lists.members.get.return_value = {
+            'status': 'subscribed'}
+        users = load_users('tests/test-user-list.csv')
+        config = load_conf('tests/test.conf')
+        config['Concurrency'] = 3
+        with tempfile.TemporaryDirectory() as tmp:
+            profile = os.path.join(tmp, 'run.prof')
+            profiler = mailchimp_subscriber.Profiler('set_mailchimp_status')
+            with patch.dict(mailchimp_subscriber.CONFIG, config), \
+                    patch('mailchimp_subscriber.write_users_out'), \
+                    profiler:
+                mailchimp_subscriber.process_users(users, '1234', 'ctl',
+                                                   '123xyz')
+            self.assertIsNotNone(profiler.write(profile))
+            stats = pstats.Stats(profile).stats
+            # the lookups all ran on pool threads
+            self.assertEqual(
+                sum(calls[1] for function, calls in stats.items()
+                    if function[2] == 'set_mailchimp_status'), 4)
+            self.assertNotIn(threading.get_ident(), profiler.profiles)
+
+            # the plan never looks anyone up
+            with patch('builtins.print') as mock_print:
+                self.assertEqual(main(['--plan', 'tests/test.conf',
+                                       'tests/test-user-list.csv',
+                                       '--profile', profile,
+                                       '--profile-stage',
+                                       'set_mailchimp_status']), 0)
+        mock_print.assert_called_with(
+            'profile: no samples, set_mailchimp_status was never called')
+
     def test_load_users(self):
         # load_users takes in a csv file and returns Client objects
         # Note that test-user-list.csv has some dummy addresses thrown in
@@ -110,39 +365,142 @@ class TestMailchimpSubscriber(unittest.TestCase):
 
         client_1 = Client('foo@bar.com', 'John', 'Doe')
         client_1.mailchimp_status = 'pending'
-        mock_client.lists.members.update = MagicMock(
-            return_value={'status': 'pending'})
-        self.assertTrue(add_users_to_mailchimp(
-                        [client_1], mock_client, '1234'))
+        self.assertEqual(add_users_to_mailchimp(
+                         [client_1], mock_client, '1234'), {'updated': 1})
+        mock_client.lists.members.update.assert_called_once_with(
+            '1234', client_1.email_hash,
+            {'merge_fields': {'FNAME': 'John', 'LNAME': 'Doe'}})
 
         client_2 = Client('foo@bar.com', 'John', 'Doe')
         client_2.mailchimp_status = 'not_present'
-        mock_client.lists.members.update = MagicMock(
-            return_value={'status': 'not_present'})
-        self.assertTrue(add_users_to_mailchimp(
-                        [client_2], mock_client, '1234'))
+        self.assertEqual(add_users_to_mailchimp(
+                         [client_2], mock_client, '1234'), {'created': 1})
 
         client_3 = Client('foo@bar.com', 'John', 'Doe')
         client_3.mailchimp_status = 'subscribed'
-        mock_client.lists.members.update = MagicMock(
-            return_value={'status': 'subscribed'})
         self.assertFalse(add_users_to_mailchimp(
                          [client_3], mock_client, '1234'))
 
         client_4 = Client('foo@bar.com', 'John', 'Doe')
         client_4.mailchimp_status = 'unsubscribed'
-        mock_client.lists.members.update = MagicMock(
-            return_value={'status': 'unsubscribed'})
         self.assertFalse(add_users_to_mailchimp(
                          [client_4], mock_client, '1234'))
 
         client_5 = Client('foo@bar.com', 'John', 'Doe')
         client_5.mailchimp_status = 'cleaned'
-        mock_client.lists.members.update = MagicMock(
-            return_value={'status': 'cleaned'})
         self.assertFalse(add_users_to_mailchimp(
                          [client_5], mock_client, '1234'))
 
+        mock_client.lists.members.create.side_effect = \
+            mailchimp_error(400, 'Member Exists')
+        self.assertEqual(add_users_to_mailchimp(
+                         [client_2], mock_client, '1234'), {'failed': 1})
+
+    @patch('mailchimp_subscriber.CONFIG', {})
+    def test_rejected_writes_fail_alone(self):
+        # a real mailchimp3 client, which raises MailChimpError for the 400s
+        with patch('mailchimp_subscriber.make_transport', return_value=(
+                stub_transport([
+                    (400, {'status': 400, 'title': 'Member Exists'}),
+                    (400, {'status': 400, 'title': 'Invalid Resource'}),
+                    (200, {'id': 'abc'}),
+                    (200, {'segments': [{'name': 'Staff', 'id': 7}],
+                           'total_items': 1}),
+                    (200, {'members': [], 'total_items': 0}),
+                    (400, {'status': 400, 'title': 'Invalid Resource'})]))):
+            mc_client = make_mc_client('ctl', '0' * 32 + '-us1')
+        clients = [Client('user{}@bar.com'.format(i), 'J', 'D',
+                          job_role='Staff') for i in range(3)]
+        for client, status in zip(clients, ['not_present', 'pending',
+                                            'not_present']):
+            client.mailchimp_status = status
+        self.assertEqual(add_users_to_mailchimp(clients, mc_client, '1234'),
+                         {'failed': 2, 'created': 1})
+        self.assertEqual(tag_clients(clients, mc_client, '1234',
+                                     ['job_role']), {'tag_failed': 3})
+
+    @patch('mailchimp_subscriber.MailChimp')
+    def test_add_users_sends_only_changed_fields(self, mock_mail_chimp):
+        mock_client = mock_mail_chimp()
+        mock_client.lists.members.get = MagicMock(return_value={
+            'status': 'pending',
+            'merge_fields': {'FNAME': 'John', 'LNAME': 'Smith'}})
+        renamed = Client('foo@bar.com', 'John', 'Doe')
+        unchanged = Client('bar@bar.com', 'John', 'Smith')
+        for client in (renamed, unchanged):
+            set_mailchimp_status(client, mock_client, '1234')
+
+        self.assertEqual(unchanged.get_mc_fields_diff(), {})
+        counts = add_users_to_mailchimp([renamed, unchanged], mock_client,
+                                        '1234')
+        self.assertEqual(counts, {'updated': 1, 'skipped': 1})
+        mock_client.lists.members.update.assert_called_once_with(
+            '1234', renamed.email_hash, {'merge_fields': {'LNAME': 'Doe'}})
+
+    def test_group_clients_by_tag(self):
+        alice = Client('alice@bar.com', 'Alice', 'Doe', job_role='Faculty')
+        bob = Client('bob@bar.com', 'Bob', 'Doe')
+        bob.source = 'export.csv'
+        groups = group_clients_by_tag([alice, bob], ['job_role', 'source'])
+        self.assertEqual(groups, {'Faculty': [alice], 'export.csv': [bob]})
+
+    @patch('mailchimp_subscriber.SEGMENT_BATCH_SIZE', 2)
+    @patch('mailchimp_subscriber.MailChimp')
+    def test_tag_clients(self, mock_mail_chimp):
+        mock_client = mock_mail_chimp()
+        clients = [Client('user{}@bar.com'.format(i), 'J', 'D',
+                          job_role='Staff') for i in range(4)]
+        clients.append(Client('new@bar.com', 'J', 'D', job_role='Faculty'))
+        segments = mock_client.lists.segments
+        segments.all.return_value = {'segments': [{'name': 'Staff',
+                                                   'id': 7}]}
+        segments.members.all.return_value = {
+            'members': [{'id': clients[0].email_hash}]}
+        segments.create.return_value = {'id': 8}
+        segments.update_members.return_value = {'error_count': 0}
+
+        counts = tag_clients(clients, mock_client, '1234', ['job_role'])
+        self.assertEqual(counts, {'tagged': 4, 'already_tagged': 1})
+        segments.create.assert_called_once_with(
+            '1234', {'name': 'Faculty', 'static_segment': []})
+        # batches of two as they come, less the member already tagged
+        self.assertEqual(segments.update_members.call_args_list, [
+            call('1234', 7, {'members_to_add': ['user1@bar.com']}),
+            call('1234', 7, {'members_to_add': ['user2@bar.com',
+                                                'user3@bar.com']}),
+            call('1234', 8, {'members_to_add': ['new@bar.com']})])
+
+    @patch('mailchimp_subscriber.MailChimp')
+    def test_tags_only_members_left_on_list(self, mock_mail_chimp):
+        mock_client = mock_mail_chimp()
+        segments = mock_client.lists.segments
+        segments.all.return_value = {'segments': [{'name': 'Staff',
+                                                   'id': 7}]}
+        segments.members.all.return_value = {'members': [
+            {'id': member_hash('tagged@bar.com')}]}
+        segments.update_members.return_value = {'error_count': 0}
+        mock_client.lists.members.create.side_effect = [
+            {'id': 'abc'}, mailchimp_error(400, 'Member Exists')]
+        clients = []
+        for name, status in [('subscribed', 'subscribed'),
+                             ('cleaned', 'cleaned'), ('deferred', ''),
+                             ('created', 'not_present'),
+                             ('failed', 'not_present'),
+                             ('Tagged', 'subscribed')]:
+            client = Client(name + '@bar.com', 'J', 'D', job_role='Staff')
+            client.mailchimp_status = status
+            clients.append(client)
+        with patch('mailchimp_subscriber.CONFIG',
+                   {'TagFields': ['job_role']}):
+            counts = add_users_to_mailchimp(
+                clients, mock_client, '1234',
+                tagger=make_tagger(mock_client, '1234'))
+        self.assertEqual(counts, {'created': 1, 'failed': 1, 'tagged': 2,
+                                  'already_tagged': 1})
+        segments.update_members.assert_called_once_with(
+            '1234', 7, {'members_to_add': ['subscribed@bar.com',
+                                           'created@bar.com']})
+
 # This test should look at the actual file stream rather than the
 # system calls because you could have commas in the input which would
 # break the CSV file
@@ -173,6 +531,1074 @@ class TestMailchimpSubscriber(unittest.TestCase):
                                         'job_role': client.job_role}),
                                   mock_writerow.mock_calls)
 
+    def test_write_users_by_status(self):
+        statuses = ['subscribed', 'unsubscribed', 'cleaned', 'pending',
+                    'not_present', 'archived', '']
+        clients = []
+        for i in range(70):
+            client = Client('user{}@columbia.edu'.format(i), 'J', 'D')
+            client.mailchimp_status = statuses[i % len(statuses)]
+            clients.append(client)
+        clients[0].email_address = 'not-an-address'
+        with tempfile.TemporaryDirectory() as tmp:
+            prefix = os.path.join(tmp, 'run')
+            # small buffers, so every file gets several batches
+            counts = write_users_by_status(iter(clients), prefix,
+                                           buffer_rows=3)
+            files = {}
+            for status in counts:
+                with open('{} {}.csv'.format(prefix, status)) as f:
+                    files[status] = f.read().splitlines()
+
+        self.assertEqual(counts, {'subscribed': 9, 'unsubscribed': 10,
+                                  'cleaned': 10, 'pending': 10,
+                                  'not_present': 10, 'invalid': 21})
+        self.assertEqual(files['pending'][0],
+                         'email_address,first_name,last_name,'
+                         'interaction_notes,job_role')
+        self.assertEqual(files['pending'][1:4], [
+            'user3@columbia.edu,J,D,,', 'user10@columbia.edu,J,D,,',
+            'user17@columbia.edu,J,D,,'])
+        self.assertIn('not-an-address,J,D,,', files['invalid'])
+        self.assertEqual({status: len(rows) - 1
+                          for status, rows in files.items()}, counts)
+
+
+class TestClientTable(unittest.TestCase):
+    def test_from_csv_matches_load_users(self):
+        table = ClientTable.from_csv('tests/test-user-list.csv')
+        users = load_users('tests/test-user-list.csv')
+        self.assertEqual(len(table), len(users))
+        for row, client in zip(table.values(), users.values()):
+            self.assertEqual(row.get_all_fields(), client.get_all_fields())
+            self.assertEqual(row.email_hash, client.email_hash)
+            self.assertEqual(row.source, 'test-user-list.csv')
+
+    @patch('mailchimp_subscriber.MailChimp')
+    def test_operations_by_index(self, mock_mail_chimp):
+        mock_client = mock_mail_chimp()
+        table = ClientTable.from_csv('tests/test-user-list.csv')
+        mock_client.lists.members.get = MagicMock(side_effect=[
+            {'status': 'subscribed'},
+            {'status': 'pending',
+             'merge_fields': {'FNAME': 'Bob', 'LNAME': 'Foobar'}},
+            {'status': 'pending', 'merge_fields': {}},
+            mailchimp_error(404)])
+        for row in table.values():
+            set_mailchimp_status(row, mock_client, '1234')
+        self.assertEqual(table.status_counts(), {'subscribed': 1,
+                                                 'pending': 2,
+                                                 'not_present': 1})
+        self.assertEqual(table[3].mailchimp_status, 'not_present')
+
+        counts = add_users_to_mailchimp(table.values(), mock_client, '1234')
+        self.assertEqual(counts, {'skipped': 1, 'updated': 1, 'created': 1})
+        with patch('mailchimp_subscriber.open', mock_open(), create=True):
+            with patch('mailchimp_subscriber.csv.DictWriter.writerow') \
+                    as mock_writerow:
+                write_users_to_file(table.values())
+        # the header plus the two pending and one not_present clients
+        self.assertEqual(mock_writerow.call_count, 4)
+
+
+class TestExternalDedup(unittest.TestCase):
+    def test_matches_load_users(self):
+        rows = ['user{}@columbia.edu,First{},Last'.format(i % 50, i)
+                for i in range(200)]
+        rows.insert(10, 'bad@notld,Bad,Email')
+        with tempfile.TemporaryDirectory() as tmp:
+            users_file = os.path.join(tmp, 'users.csv')
+            with open(users_file, 'w') as f:
+                f.write('\n'.join(rows) + '\n')
+            # a tiny memory limit forces many buckets
+            clients = list(external_dedup(users_file, memory_limit=512,
+                                          tmp_dir=tmp))
+            users = load_users(users_file)
+            self.assertEqual(sorted(os.listdir(tmp)), ['users.csv'])
+
+        self.assertEqual(len(clients), 50)
+        for client in clients:
+            expected = users[client.email_address]
+            self.assertEqual(client.get_all_fields(),
+                             expected.get_all_fields())
+            self.assertEqual(client.source, 'users.csv')
+
+    def test_splits_buckets_again(self):
+        import mailchimp_subscriber
+        rows = ['user{}@columbia.edu,First{},Last'.format(i % 50, i)
+                for i in range(200)]
+        dedup_bucket = mailchimp_subscriber._dedup_bucket
+        in_memory = []
+
+        def spy(rows, source):
+            rows = list(rows)
+            in_memory.append(len(rows))
+            return dedup_bucket(rows, source)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            users_file = os.path.join(tmp, 'users.csv')
+            with open(users_file, 'w') as f:
+                f.write('\n'.join(rows) + '\n')
+            # four files open at a time, far fewer than the limit asks for
+            with patch('mailchimp_subscriber.max_open_buckets',
+                       return_value=4), \
+                    patch('mailchimp_subscriber._dedup_bucket', spy):
+                clients = list(external_dedup(users_file, memory_limit=512,
+                                              tmp_dir=tmp))
+            self.assertEqual(sorted(os.listdir(tmp)), ['users.csv'])
+
+        self.assertEqual(sorted(client.first_name for client in clients),
+                         sorted('First{}'.format(i) for i in range(150, 200)))
+        # about 3 rows fit the limit, and an address appears 4 times
+        self.assertLessEqual(max(in_memory), 4)
+        self.assertLessEqual(
+            mailchimp_subscriber.max_open_buckets(), 1024)
+
+
+class TestPipeline(unittest.TestCase):
+    def test_stream_unique_clients(self):
+        rows = ['alice@columbia.edu,Alice,Old', 'bob@columbia.edu,Bob,B',
+                'alice@columbia.edu,Alice,New', 'bad@notld,Bad,Email']
+        with tempfile.TemporaryDirectory() as tmp:
+            users_file = os.path.join(tmp, 'users.csv')
+            with open(users_file, 'w') as f:
+                f.write('\n'.join(rows) + '\n')
+            streamed = {client.email_address: client.last_name
+                        for client in stream_unique_clients(users_file)}
+            loaded = {email: client.last_name for email, client
+                      in load_users(users_file).items()}
+        self.assertEqual(streamed, loaded)
+        self.assertEqual(streamed['alice@columbia.edu'], 'New')
+
+    @patch('mailchimp_subscriber.MailChimp')
+    def test_pipeline_users(self, mock_mail_chimp):
+        mock_client = mock_mail_chimp()
+
+        def slow_get(list_id, email_hash, **queryparams):
+            time.sleep(0.01)
+            if (email_hash == clients[0].email_hash):
+                raise mailchimp_error(404)
+            return {'status': 'subscribed'}
+
+        mock_client.lists.members.get = MagicMock(side_effect=slow_get)
+        clients = [Client('user{}@bar.com'.format(i), 'J', 'D')
+                   for i in range(20)]
+        config = {'SendMCEmail': True, 'Concurrency': 2}
+        with patch('mailchimp_subscriber.CONFIG', config):
+            writes, stats = pipeline_users(iter(clients), '1234', 'ctl',
+                                           'key', queue_size=1)
+        self.assertEqual(writes, {'created': 1})
+        self.assertEqual(mock_client.lists.members.get.call_count, 20)
+        lookups, written = stats
+        self.assertEqual((lookups['items'], written['items']), (20, 20))
+        self.assertLessEqual(lookups['max_depth'], 1)
+        # the lookups are the bottleneck, so the parser had to wait
+        self.assertGreater(lookups['producer_blocked'], 0)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def response(self, status_code):
+        response = MagicMock()
+        response.status_code = status_code
+        return response
+
+    def test_opens_on_consecutive_failures_and_probes(self):
+        breaker = CircuitBreaker(failures=3, window=100, reset_seconds=0.05)
+        make_request = MagicMock(return_value=self.response(503))
+        guarded = breaker.wrap(make_request)
+        for _ in range(3):
+            guarded(method='GET', url='x')
+        self.assertEqual(breaker.state, 'open')
+        self.assertRaises(CircuitOpenError, guarded, method='GET', url='x')
+        self.assertEqual(make_request.call_count, 3)
+
+        time.sleep(0.06)
+        make_request.return_value = self.response(200)
+        guarded(method='GET', url='x')
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_opens_on_error_rate(self):
+        breaker = CircuitBreaker(failures=100, error_rate=0.5, window=4)
+        for ok in (True, False, True, False):
+            breaker.record(ok)
+        self.assertEqual(breaker.state, 'open')
+
+    def test_timeouts_count_as_failures(self):
+        breaker = CircuitBreaker(failures=1)
+        make_request = MagicMock(side_effect=requests.exceptions.Timeout)
+        guarded = breaker.wrap(make_request)
+        self.assertRaises(requests.exceptions.Timeout, guarded)
+        self.assertEqual(breaker.state, 'open')
+
+    def test_any_error_settles_probe(self):
+        breaker = CircuitBreaker(failures=1, reset_seconds=0)
+        make_request = MagicMock(side_effect=[
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            self.response(200)])
+        guarded = breaker.wrap(make_request)
+        self.assertRaises(requests.exceptions.Timeout, guarded)
+        # the probe fails with an error that isn't a timeout
+        self.assertRaises(requests.exceptions.ChunkedEncodingError, guarded)
+        self.assertEqual(breaker.state, 'open')
+        self.assertEqual(guarded().status_code, 200)
+        self.assertEqual(breaker.state, 'closed')
+
+    @patch('mailchimp_subscriber.CONFIG', {'BreakerFailures': 2})
+    def test_outage_defers_clients(self):
+        # a real mailchimp3 client, which raises MailChimpError for both
+        with patch('mailchimp_subscriber.make_transport', return_value=(
+                stub_transport([(404, {'status': 404}),
+                                (503, {'status': 503})]))):
+            mc_client = make_mc_client('ctl', '0' * 32 + '-us1')
+        missing = Client('missing@bar.com', 'John', 'Doe')
+        set_mailchimp_status(missing, mc_client, '1234')
+        self.assertEqual(missing.mailchimp_status, 'not_present')
+        client = Client('foo@bar.com', 'John', 'Doe')
+        set_mailchimp_status(client, mc_client, '1234')
+        # a 5xx is not proof the member is missing
+        self.assertEqual(client.mailchimp_status, '')
+        self.assertEqual(mc_client.breaker.deferred, [client])
+
+        client.mailchimp_status = 'not_present'
+        mc_client.lists.members.create = MagicMock(
+            side_effect=CircuitOpenError)
+        self.assertEqual(add_users_to_mailchimp([client], mc_client, '1234'),
+                         {'deferred': 1})
+        self.assertEqual(mc_client.breaker.deferred, [client, client])
+
+    def test_timeouts_open_breaker_and_defer_clients(self):
+        import mailchimp_subscriber
+        calls = []
+
+        def timing_out(**kwargs):
+            calls.append(kwargs['url'])
+            raise requests.exceptions.Timeout('read timed out')
+
+        config = load_conf('tests/test.conf')
+        config.update(SendMCEmail=True, BreakerFailures=2, TagFields=[])
+        users = load_users('tests/test-user-list.csv')
+        write_clients = mailchimp_subscriber.write_clients
+        with tempfile.TemporaryDirectory() as tmp:
+            retry_file = os.path.join(tmp, 'retry.csv')
+            with patch.dict(mailchimp_subscriber.CONFIG, config), \
+                    patch('mailchimp_subscriber.make_transport',
+                          return_value=timing_out), \
+                    patch('mailchimp_subscriber.write_clients',
+                          lambda clients, _: write_clients(clients,
+                                                           retry_file)):
+                mc_client = make_mc_client('ctl', '0' * 32 + '-us1')
+                writes = mailchimp_subscriber.process_users(
+                    users, '1234', 'ctl', '0' * 32 + '-us1',
+                    mc_client=mc_client)
+            retried = load_users(retry_file)
+        # two timeouts open the breaker, which turns the rest away
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(mc_client.breaker.state, 'open')
+        self.assertEqual(writes['retry'], 4)
+        self.assertEqual(sorted(retried), sorted(users))
+
+
+class TestAdaptiveLimit(unittest.TestCase):
+    def run_calls(self, limiter, make_request, calls=400, threads=16):
+        limited = limiter.wrap(make_request)
+        with ThreadPoolExecutor(threads) as pool:
+            return list(pool.map(lambda i: limited(method='GET', url=str(i)),
+                                 range(calls)))
+
+    def test_errors_release_their_slot(self):
+        limiter = AdaptiveLimit(initial=1, maximum=1)
+        limited = limiter.wrap(MagicMock(side_effect=[
+            ValueError('undecodable body'),
+            requests_response(200, b'{}', {}, 'x')]))
+        self.assertRaises(ValueError, limited, method='GET', url='x')
+        self.assertEqual(limiter.inflight, 0)
+        # the one slot is free again, so this doesn't block
+        self.assertEqual(limited(method='GET', url='x').status_code, 200)
+        self.assertEqual(limiter.inflight, 0)
+
+    def test_increases_while_latency_is_flat(self):
+        def make_request(**kwargs):
+            time.sleep(0.01)
+            return requests_response(200, b'{}', {}, kwargs['url'])
+
+        limiter = AdaptiveLimit(initial=1, maximum=8)
+        self.run_calls(limiter, make_request, calls=200)
+        self.assertEqual(int(limiter.limit), 8)
+        self.assertEqual([limit for _, limit in limiter.history],
+                         list(range(1, 9)))
+
+    def test_backs_off_when_throttled(self):
+        # the server turns away calls beyond 4 at a time
+        lock = threading.Lock()
+        inflight = [0]
+
+        def make_request(**kwargs):
+            with lock:
+                inflight[0] += 1
+                status = 429 if inflight[0] > 4 else 200
+            time.sleep(0.002)
+            with lock:
+                inflight[0] -= 1
+            return requests_response(status, b'{}', {'Retry-After': '0'},
+                                     kwargs['url'])
+
+        limiter = AdaptiveLimit(initial=2, maximum=16)
+        responses = self.run_calls(limiter, make_request)
+        # throttled calls come back for their clients to be deferred
+        statuses = Counter(r.status_code for r in responses)
+        self.assertEqual(statuses[429], limiter.throttled)
+        self.assertGreater(limiter.throttled, 0)
+        self.assertGreater(statuses[200], statuses[429])
+        limits = [limit for _, limit in limiter.history]
+        self.assertLess(max(limits), 16)
+        self.assertLessEqual(int(limiter.limit), 8)
+        self.assertIn('throttled', format_concurrency(limiter))
+        self.assertLessEqual(
+            len(format_concurrency(limiter, points=5).split('s=')), 6)
+
+    def test_throttled_lookup_is_deferred_and_traced_once(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            config = {'AdaptiveConcurrency': True,
+                      'TraceFile': os.path.join(tmp, 'trace.jsonl')}
+            with patch('mailchimp_subscriber.CONFIG', config), \
+                    patch('mailchimp_subscriber.make_transport',
+                          return_value=stub_transport(
+                              [(429, {'status': 429})])):
+                mc_client = make_mc_client('ctl', '0' * 32 + '-us1')
+            client = Client('foo@bar.com', 'John', 'Doe')
+            set_mailchimp_status(client, mc_client, '1234')
+            mc_client.trace.close()
+            with open(config['TraceFile']) as f:
+                records = [json.loads(line) for line in f]
+        self.assertEqual(mc_client.breaker.deferred, [client])
+        self.assertEqual(mc_client.limiter.throttled, 1)
+        self.assertEqual([(r['status'], r['retries']) for r in records],
+                         [(429, 0)])
+
+    def test_backs_off_on_latency_spikes(self):
+        def make_request(**kwargs):
+            time.sleep(0.1 if int(kwargs['url']) == 30 else 0.01)
+            return requests_response(200, b'{}', {}, kwargs['url'])
+
+        limiter = AdaptiveLimit(initial=4, maximum=4)
+        self.run_calls(limiter, make_request, calls=40, threads=1)
+        self.assertGreaterEqual(limiter.spikes, 1)
+        self.assertIn(2, [limit for _, limit in limiter.history])
+
+
+class TestTransports(unittest.TestCase):
+    def test_make_transport(self):
+        self.assertIsNone(make_transport('requests'))
+        self.assertRaises(ValueError, make_transport, 'carrier-pigeon')
+
+    @unittest.skipUnless(importlib.util.find_spec('httpx'),
+                         'httpx is not installed')
+    def test_http2_transport(self):
+        import httpx
+
+        def handler(request):
+            self.assertEqual(request.headers['authorization'],
+                             httpx.BasicAuth('ctl', 'key')._auth_header)
+            if (request.url.path.endswith('/missing')):
+                return httpx.Response(404, json={'status': 404})
+            return httpx.Response(200, json={'status': 'subscribed'})
+
+        transport = HTTP2Transport(client=httpx.Client(
+            transport=httpx.MockTransport(handler)))
+        auth = requests.auth.HTTPBasicAuth('ctl', 'key')
+        response = transport(method='GET', url='https://x/members/abc',
+                             auth=auth)
+        self.assertEqual(response.json(), {'status': 'subscribed'})
+        response = transport(method='GET', url='https://x/members/missing',
+                             auth=auth)
+        self.assertRaises(requests.exceptions.HTTPError,
+                          response.raise_for_status)
+
+    def test_traffic_meter(self):
+        self.assertEqual(
+            endpoint_name('GET', 'https://us1.api.mailchimp.com/3.0/lists/'
+                          'abc/members/0123?fields=status'),
+            'GET lists/{id}/members/{id}')
+
+        def make_request(method, url, json=None, headers=None):
+            if (url.endswith('/missing')):
+                raise requests.exceptions.ConnectionError()
+            # a gzipped body, 10 bytes on the wire and 22 decoded
+            return requests_response(200, b'{"status": "pending"}\n',
+                                     {'Content-Length': '10'}, url)
+
+        traffic = TrafficMeter()
+        metered = traffic.wrap(make_request)
+        metered(method='GET', url='https://x/3.0/lists/1/members/a',
+                headers={'Accept-Encoding': 'gzip'})
+        metered(method='PATCH', url='https://x/3.0/lists/1/members/a',
+                json={'status': 'subscribed'})
+        self.assertRaises(requests.exceptions.ConnectionError, metered,
+                          method='GET', url='https://x/3.0/lists/1/missing')
+        get = traffic.endpoints['GET lists/{id}/members/{id}']
+        self.assertEqual(get, {'calls': 1, 'sent': 31 + 23,
+                               'received': 10, 'decoded': 22})
+        patched = traffic.endpoints['PATCH lists/{id}/members/{id}']
+        self.assertEqual(patched['sent'], 31 + 24)
+        self.assertEqual(traffic.endpoints['GET lists/{id}/missing'],
+                         {'calls': 1, 'sent': 29, 'received': 0,
+                          'decoded': 0})
+        self.assertEqual(traffic.totals()['received'], 20)
+
+    def test_json_codec(self):
+        self.assertRaises(ValueError, JSONCodec, 'pickle')
+        names = ['json'] + (['orjson'] if importlib.util.find_spec('orjson')
+                            else [])
+        for name in names:
+            codec = JSONCodec(name)
+            self.assertEqual(codec.name, name)
+            sent = []
+
+            def make_request(**kwargs):
+                sent.append(kwargs)
+                return requests_response(200, b'{"status":"pending"}', {},
+                                         kwargs['url'])
+
+            response = codec.wrap(make_request)(
+                method='POST', url='https://x/3.0/lists/1/members',
+                json={'FNAME': 'Zo\u00eb'}, headers={'Accept': '*/*'})
+            self.assertNotIn('json', sent[0])
+            self.assertEqual(codec.loads(sent[0]['data']),
+                             {'FNAME': 'Zo\u00eb'})
+            self.assertEqual(sent[0]['headers'],
+                             {'Accept': '*/*',
+                              'Content-Type': 'application/json'})
+            self.assertEqual(response.json(), {'status': 'pending'})
+
+    def test_trace_log(self):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                body = b'{"status":"subscribed"}'
+                self.send_response(200 if 'missing' not in self.path
+                                   else 404)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('localhost', 0), Handler)
+        self.addCleanup(server.server_close)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        url = 'http://localhost:{}/3.0/lists/1/members/'.format(
+            server.server_address[1])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'trace.jsonl')
+            trace = TraceLog(path)
+            traced = trace.wrap(SessionTransport(1))
+            with traced_member('abc'):
+                traced(method='GET', url=url + 'abc')
+            traced(method='GET', url=url + 'missing')
+            trace.close()
+            with open(path) as f:
+                first, second = [json.loads(line) for line in f]
+
+        self.assertEqual((first['email_hash'], first['method'],
+                          first['endpoint'], first['status']),
+                         ('abc', 'GET', 'GET lists/{id}/members/{id}', 200))
+        self.assertIsNotNone(first['dns'])
+        self.assertIsNotNone(first['connect'])
+        self.assertIsNone(first['tls'])
+        self.assertGreaterEqual(first['total'], first['ttfb'])
+        self.assertEqual(first['received'], 23)
+        # the second call reused the connection
+        self.assertEqual((second['email_hash'], second['status'],
+                          second['connect']), (None, 404, None))
+
+
+class TestValidateUsers(unittest.TestCase):
+    @patch('mailchimp_subscriber.ProcessPoolExecutor', ThreadPoolExecutor)
+    def test_validate_users(self):
+        rows = ['alice@columbia.edu,Alice,Foo',
+                'bad@notld,Bad,Email',
+                '',
+                'bob@columbia.edu,,Foobar',
+                'alice@columbia.edu,Alice,Bar',
+                'joe@columbia.edu',
+                'carol@columbia.edu,Carol,Baz']
+        with tempfile.TemporaryDirectory() as tmp:
+            users_file = os.path.join(tmp, 'users.csv')
+            rejects_file = os.path.join(tmp, 'rejects.csv')
+            with open(users_file, 'w') as f:
+                f.write('\n'.join(rows) + '\n')
+            # tiny chunks so rows and duplicates span chunk boundaries
+            stats = validate_users(users_file, rejects_file, workers=2,
+                                   chunk_size=16)
+            with open(rejects_file) as f:
+                rejects = f.read().splitlines()
+            loaded = load_users(users_file)
+
+        self.assertEqual(stats['accepted'], len(loaded))
+        self.assertEqual(rejects[1:], [
+            '1,duplicate of line 5,alice@columbia.edu,Alice,Foo',
+            '2,bad email,bad@notld,Bad,Email',
+            '4,empty first name,bob@columbia.edu,,Foobar',
+            '6,short row,joe@columbia.edu'])
+        self.assertEqual(stats['rows'], 6)
+
+    @patch('mailchimp_subscriber.ProcessPoolExecutor', ThreadPoolExecutor)
+    def test_validate_multiline_notes(self):
+        # each row's quoted notes take two lines, which chunks can't split
+        rows = ['user{}@columbia.edu,U,D,"line one\nline two",Dean'.format(i)
+                for i in range(40)]
+        rows.append('bad@notld,Bad,Email')
+        with tempfile.TemporaryDirectory() as tmp:
+            users_file = os.path.join(tmp, 'users.csv')
+            rejects_file = os.path.join(tmp, 'rejects.csv')
+            with open(users_file, 'w', newline='') as f:
+                f.write('\n'.join(rows) + '\n')
+            for chunk_size in (100, 1 << 20):
+                stats = validate_users(users_file, rejects_file, workers=2,
+                                       chunk_size=chunk_size)
+                with open(rejects_file) as f:
+                    rejects = f.read().splitlines()[1:]
+                self.assertEqual(rejects, ['81,bad email,bad@notld,Bad,Email'])
+                self.assertEqual(stats['accepted'], 40)
+            self.assertEqual(len(load_users(users_file)), 40)
+
+    @patch('mailchimp_subscriber.ProcessPoolExecutor', ThreadPoolExecutor)
+    def test_validate_line_numbers(self):
+        # \x0b and \u2028 end a line for str.splitlines but not for csv
+        rows = ['alice@columbia.edu,Al\x0bice,Foo',
+                'bob@columbia.edu,Bob,Foo\u2028Bar',
+                'alice@columbia.edu,Alice,Foo',
+                'bad@notld,Bad,Email',
+                'alice@columbia.edu,Alice,Baz',
+                'carol@columbia.edu,,Foo']
+        with tempfile.TemporaryDirectory() as tmp:
+            users_file = os.path.join(tmp, 'users.csv')
+            rejects_file = os.path.join(tmp, 'rejects.csv')
+            with open(users_file, 'w', encoding='utf-8', newline='') as f:
+                f.write('\r\n'.join(rows) + '\r\n')
+            # the worker sends back addresses and rejects, not good rows
+            lines, emails, rejected, duplicates, _ = validate_chunk(
+                users_file, 0, os.path.getsize(users_file))
+            self.assertEqual(lines, 6)
+            self.assertEqual(emails, {'alice@columbia.edu': (1, 5),
+                                      'bob@columbia.edu': (2, 2)})
+            self.assertEqual([line for line, _, _ in rejected], [4, 6])
+            self.assertEqual([(line, later) for line, _, later in
+                              duplicates], [(1, 3), (3, 5)])
+
+            for chunk_size in (16, 1024):
+                validate_users(users_file, rejects_file, workers=2,
+                               chunk_size=chunk_size)
+                with open(rejects_file, encoding='utf-8', newline='') as f:
+                    rejects = [row[:2] for row in csv.reader(f)][1:]
+                self.assertEqual(rejects, [
+                    ['1', 'duplicate of line 3'],
+                    ['3', 'duplicate of line 5'], ['4', 'bad email'],
+                    ['6', 'empty first name']])
+
+
+class TestJobRunner(unittest.TestCase):
+    def test_load_manifest(self):
+        jobs = load_manifest('tests/test-manifest.csv')
+        job = ('tests/test.conf', 'tests/test-user-list.csv')
+        self.assertEqual(jobs, [job, job])
+
+    @patch('mailchimp_subscriber.process_users')
+    def test_run_job(self, mock_process_users):
+        result = run_job('tests/test.conf', 'tests/test-user-list.csv')
+        self.assertTrue(result['ok'])
+        self.assertEqual(result['clients'], 4)
+        self.assertEqual(mock_process_users.call_args[0][1:],
+                         ('1234', 'ctl', '123xyz'))
+
+        mock_process_users.side_effect = RuntimeError('outage')
+        result = run_job('tests/test.conf', 'tests/test-user-list.csv')
+        self.assertFalse(result['ok'])
+        self.assertEqual(result['error'], 'RuntimeError: outage')
+        self.assertIn('FAILED RuntimeError: outage',
+                      format_job_report([result]))
+
+    @patch('mailchimp_subscriber.ProcessPoolExecutor', ThreadPoolExecutor)
+    @patch('mailchimp_subscriber.run_job')
+    def test_run_jobs_caps_per_account(self, mock_run_job):
+        # Six jobs share the 'ctl' account. Each waits for a second job to
+        # be running before it finishes, so jobs overlap as far as the cap
+        # lets them.
+        lock = threading.Lock()
+        active = [0]
+        peaks = []
+        pairs = threading.Barrier(2, timeout=5)
+
+        def fake_job(conf, users):
+            with lock:
+                active[0] += 1
+                peaks.append(active[0])
+            pairs.wait()
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+            return {'conf': conf, 'users': users, 'ok': True}
+
+        mock_run_job.side_effect = fake_job
+        jobs = load_manifest('tests/test-manifest.csv') * 3
+        results = run_jobs(jobs, max_workers=6, per_account=2)
+        self.assertEqual(len(results), 6)
+        self.assertEqual(max(peaks), 2)
+
+    def test_per_account_must_be_positive(self):
+        self.assertRaises(ValueError, run_jobs, [], per_account=0)
+        with patch('sys.stderr'):
+            self.assertRaises(SystemExit, main, [
+                '--manifest', 'tests/test-manifest.csv', '--per-account',
+                '0'])
+
+
+class TestShardedProcessing(unittest.TestCase):
+    def setUp(self):
+        fd, self.queue_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, self.queue_path)
+
+    def test_shard_users(self):
+        self.assertEqual(len(shard_prefixes(1)), 16)
+        self.assertEqual(shard_prefixes(2)[:2], ['00', '01'])
+        users = load_users('tests/test-user-list.csv')
+        sharded = [shard_users(users, prefix) for prefix in shard_prefixes(1)]
+        self.assertEqual(sum(len(shard) for shard in sharded), len(users))
+
+    def test_dead_worker_shard_is_reassigned(self):
+        queue = ShardQueue(self.queue_path, lease_seconds=0.01)
+        queue.publish('users.csv', ['0', '1'])
+        self.assertEqual(queue.claim('dead'), ('0', 'users.csv'))
+        self.assertEqual(queue.claim('alive'), ('1', 'users.csv'))
+        queue.complete('1', 'alive', {'clients': 0, 'statuses': {}})
+        time.sleep(0.02)
+        # 'dead' never heartbeated, so its lease has lapsed
+        self.assertEqual(queue.claim('alive'), ('0', 'users.csv'))
+        queue.complete('0', 'alive', {'clients': 0, 'statuses': {}})
+        # a late completion from the dead worker must not clobber it
+        queue.complete('0', 'dead', {'clients': 99, 'statuses': {}})
+        self.assertIsNone(queue.claim('alive'))
+        results = queue.results()
+        self.assertEqual([r['worker'] for r in results], ['alive', 'alive'])
+        self.assertEqual(results[0]['attempts'], 2)
+        self.assertEqual(results[0]['clients'], 0)
+        self.assertIn('2 shards (1 reassigned)', format_shard_report(results))
+
+    def test_poison_shard_fails_after_max_attempts(self):
+        queue = ShardQueue(self.queue_path, lease_seconds=0.01,
+                           max_attempts=2)
+        queue.publish('users.csv', ['0'])
+        for _ in range(2):
+            # each worker dies without heartbeating
+            self.assertEqual(queue.claim('doomed'), ('0', 'users.csv'))
+            time.sleep(0.02)
+        # the coordinator gives up on it even with no worker left
+        self.assertEqual(queue.progress(), {'failed': 1})
+        self.assertIsNone(queue.claim('next'))
+        self.assertEqual(queue.failed(), [('0', 2)])
+        self.assertIn('1 shards failed: 0 after 2 attempts',
+                      format_shard_report([], queue.failed()))
+
+    def test_publish_refuses_a_queue_in_use(self):
+        queue = ShardQueue(self.queue_path)
+        queue.publish('users.csv', ['0', '1'])
+        queue.claim('w1')
+        queue.complete('0', 'w1', {'clients': 0, 'statuses': {}})
+        self.assertRaises(ValueError, queue.publish, 'users.csv', ['0', '1'])
+        self.assertEqual(queue.progress(), {'done': 1, 'pending': 1})
+        with patch('builtins.print') as mock_print:
+            self.assertEqual(main(['--coordinator', self.queue_path,
+                                   'tests/test.conf', 'users.csv']), 1)
+        self.assertIn('reset', mock_print.call_args[0][0])
+        queue.publish('users.csv', ['0', '1'], reset=True)
+        self.assertEqual(queue.progress(), {'pending': 2})
+
+    @patch('mailchimp_subscriber.process_users')
+    def test_run_worker(self, mock_process_users):
+        queue = ShardQueue(self.queue_path)
+        queue.publish('tests/test-user-list.csv', shard_prefixes(1))
+        self.assertEqual(run_worker(queue, 'w1', '1234', 'ctl', 'key'), 16)
+        self.assertEqual(queue.progress(), {'done': 16})
+        calls = mock_process_users.call_args_list
+        self.assertEqual(sum(len(c[0][0]) for c in calls), 4)
+
+
+class TestListMirror(unittest.TestCase):
+    def setUp(self):
+        fd, self.mirror_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, self.mirror_path)
+
+    @patch('mailchimp_subscriber.MailChimp')
+    def test_incremental_sync(self, mock_mail_chimp):
+        mock_client = mock_mail_chimp()
+        alice = Client('alice@bar.com', 'Alice', 'Doe')
+        bob = Client('bob@bar.com', 'Bob', 'Doe')
+        mock_client.lists.members.all.return_value = {'members': [
+            {'id': alice.email_hash, 'status': 'pending',
+             'merge_fields': {'FNAME': 'Alice', 'LNAME': 'Doe'},
+             'last_changed': '2020-01-01T00:00:00+00:00'}]}
+        mirror = ListMirror(self.mirror_path, '1234')
+        self.addCleanup(mirror.close)
+        self.assertEqual(mirror.sync(mock_client), 1)
+        self.assertNotIn('since_last_changed',
+                         mock_client.lists.members.all.call_args[1])
+
+        mock_client.lists.members.all.return_value = {'members': [
+            {'id': alice.email_hash, 'status': 'subscribed',
+             'merge_fields': {'FNAME': 'Alice', 'LNAME': 'Doe'},
+             'last_changed': '2020-02-01T00:00:00+00:00'}]}
+        mirror.sync(mock_client)
+        self.assertEqual(
+            mock_client.lists.members.all.call_args[1]['since_last_changed'],
+            '2020-01-01T00:00:00+00:00')
+        self.assertEqual(mirror.watermark, '2020-02-01T00:00:00+00:00')
+
+        mock_client.lists.members.get = MagicMock()
+        set_mailchimp_status(alice, mock_client, '1234', mirror)
+        set_mailchimp_status(bob, mock_client, '1234', mirror)
+        self.assertEqual(alice.mailchimp_status, 'subscribed')
+        self.assertEqual(alice.mailchimp_fields['FNAME'], 'Alice')
+        self.assertEqual(bob.mailchimp_status, 'not_present')
+        mock_client.lists.members.get.assert_not_called()
+
+    def test_digest_index(self):
+        clients = [Client('user{}@bar.com'.format(i), 'J', 'D')
+                   for i in range(200)]
+        statuses = ['subscribed', 'pending', 'cleaned', 'unsubscribed']
+        # every other member has been renamed on Mailchimp
+        members = sorted((client.email_hash, statuses[i % 4],
+                          {'FNAME': 'J' if i % 2 else 'K', 'LNAME': 'D'})
+                         for i, client in enumerate(clients[:100]))
+        build_digest_index(self.mirror_path, len(members), members)
+        index = DigestIndex(self.mirror_path)
+        self.addCleanup(index.close)
+
+        for i, client in enumerate(clients[:100]):
+            set_mailchimp_status(client, None, '1234', index)
+            self.assertEqual(client.mailchimp_status, statuses[i % 4])
+            self.assertEqual(client.get_mc_fields_diff(),
+                             {} if i % 2 else client.get_mc_fields())
+        for client in clients[100:]:
+            self.assertIsNone(index.get(client.email_hash))
+        # with 10 bits per member nearly all the misses stop at the filter
+        self.assertGreater(index.bloom_skips, 90)
+
+    @patch('mailchimp_subscriber.MailChimp')
+    def test_index_rebuilds_old_versions(self, mock_mail_chimp):
+        import mailchimp_subscriber
+        mock_client = mock_mail_chimp()
+        alice = Client('alice@bar.com', 'Alice', 'Doe')
+        mock_client.lists.members.all.return_value = {'members': [
+            {'id': alice.email_hash, 'status': 'pending',
+             'merge_fields': {'FNAME': 'Alice', 'LNAME': 'Doe'},
+             'last_changed': '2020-01-01T00:00:00+00:00'}]}
+        index_path = self.mirror_path + '.idx'
+        self.addCleanup(os.remove, index_path)
+        with open(index_path, 'wb') as f:
+            # a version 1 header, from before the index kept fields
+            f.write(DigestIndex.HEADER.pack(DigestIndex.MAGIC, 1, 0, 8, 7))
+            f.write(b'\0')
+        self.assertFalse(DigestIndex.is_current(index_path))
+        with ListMirror(self.mirror_path, '1234') as mirror:
+            mirror.sync(mock_client)
+        # nothing changed on the list since, but the old file is rebuilt
+        mock_client.lists.members.all.return_value = {'members': []}
+        config = {'MirrorFile': self.mirror_path, 'IndexFile': index_path}
+        with patch.dict(mailchimp_subscriber.CONFIG, config):
+            with mailchimp_subscriber.open_status_source(mock_client,
+                                                         '1234') as index:
+                set_mailchimp_status(alice, mock_client, '1234', index)
+        self.assertIsInstance(index, DigestIndex)
+        self.assertEqual(alice.mailchimp_status, 'pending')
+        self.assertEqual(alice.get_mc_fields_diff(), {})
+        self.assertTrue(DigestIndex.is_current(index_path))
+        # the mmap is closed once the block is done with it
+        self.assertTrue(index.mm.closed)
+
+    @patch('mailchimp_subscriber.MailChimp')
+    def test_plan_matches_write_path(self, mock_mail_chimp):
+        import mailchimp_subscriber
+        mock_client = mock_mail_chimp()
+        users = load_users('tests/test-user-list.csv')
+
+        def member(address, first):
+            return {'id': users[address].email_hash, 'status': 'pending',
+                    'merge_fields': {'FNAME': first,
+                                     'LNAME': users[address].last_name},
+                    'last_changed': '2020-01-01T00:00:00+00:00'}
+
+        mock_client.lists.members.all.return_value = {'members': [
+            member('alice@columbia.edu', 'Alice'),
+            member('bob@columbia.edu', 'Robert')]}
+        config = load_conf('tests/test.conf')
+        config.update(SendMCEmail=True, MirrorFile=self.mirror_path)
+        with patch.dict(mailchimp_subscriber.CONFIG, config):
+            with mailchimp_subscriber.open_status_source(
+                    mock_client, '1234') as mirror:
+                plan = plan_run('tests/test-user-list.csv', config, mirror)
+                for client in users.values():
+                    set_mailchimp_status(client, mock_client, '1234', mirror)
+            writes = add_users_to_mailchimp(users.values(), mock_client,
+                                            '1234')
+        # alice is up to date, only bob's first name changed
+        self.assertEqual((plan['updates'], plan['skips']), (1, 1))
+        self.assertEqual((writes['updated'], writes['skipped']), (1, 1))
+        mock_client.lists.members.update.assert_called_once_with(
+            '1234', users['bob@columbia.edu'].email_hash,
+            {'merge_fields': {'FNAME': 'Bob'}})
+        # the source is closed once the block is done with it
+        with self.assertRaises(sqlite3.ProgrammingError):
+            mirror.count()
+
 
 if __name__ == "__main__":
     unittest.main()
+
+
+class TestReconcile(unittest.TestCase):
+    def test_external_sort_hashes(self):
+        hashes = ['{:032x}'.format((i * 7919) % 50) for i in range(200)]
+        # runs of three hashes, so most of the sort happens on disk
+        self.assertEqual(list(external_sort_hashes(hashes, memory_limit=300)),
+                         sorted(set(hashes)))
+        self.assertEqual(list(external_sort_hashes(hashes[:2])),
+                         sorted(set(hashes[:2])))
+        self.assertEqual(list(missing_members(
+            ['a', 'c', 'd'], [('a', 's'), ('b', 's'), ('d', 's'),
+                              ('e', 's')])), [('b', 's'), ('e', 's')])
+
+    @patch('mailchimp_subscriber.MailChimp')
+    def test_reconcile(self, mock_mail_chimp):
+        mock_client = mock_mail_chimp()
+        kept = [Client('user{}@columbia.edu'.format(i), 'J', 'D')
+                for i in range(20)]
+        stale = Client('stale@columbia.edu', 'S', 'D')
+        members = [{'id': client.email_hash, 'status': 'subscribed',
+                    'last_changed': '2020-01-01T00:00:00+00:00'}
+                   for client in kept + [stale]]
+        members.append({'id': '0' * 32, 'status': 'archived',
+                        'last_changed': '2020-01-01T00:00:00+00:00'})
+        mock_client.lists.members.all.return_value = {'members': members}
+        mock_client.batch_operations.create.return_value = {'id': 'b1'}
+        mock_client.batch_operations.get.return_value = {
+            'status': 'finished', 'total_operations': 1,
+            'errored_operations': 0}
+        with tempfile.TemporaryDirectory() as tmp:
+            users_file = os.path.join(tmp, 'users.csv')
+            preview = os.path.join(tmp, 'preview.csv')
+            with open(users_file, 'w') as f:
+                # Mailchimp hashes the lowercased address
+                f.write('USER0@columbia.edu,J,D\n')
+                f.writelines('{},J,D\n'.format(client.email_address)
+                             for client in kept[1:])
+            argv = ['--reconcile', 'tests/test.conf', users_file]
+            with patch('builtins.print') as mock_print:
+                self.assertEqual(main(argv + ['--max-archive', '4']), 1)
+            self.assertIn('1 of 21 list members (4.8%)',
+                          mock_print.call_args_list[0][0][0])
+            with patch('builtins.print'):
+                self.assertEqual(main(argv + ['--dry-run', '--out',
+                                              preview]), 0)
+            mock_client.batch_operations.create.assert_not_called()
+            with open(preview) as f:
+                self.assertEqual(f.read().splitlines()[1:],
+                                 [stale.email_hash + ',subscribed'])
+
+            with patch('builtins.print') as mock_print:
+                self.assertEqual(main(argv), 0)
+        operations = mock_client.batch_operations.create.call_args[0][0]
+        self.assertEqual(operations['operations'], [
+            {'method': 'DELETE',
+             'path': '/lists/1234/members/' + stale.email_hash}])
+        mock_print.assert_called_with('archived=1')
+
+    @patch('mailchimp_subscriber.MailChimp')
+    def test_reconcile_gives_up_on_stuck_batch(self, mock_mail_chimp):
+        mock_client = mock_mail_chimp()
+        stale = Client('stale@columbia.edu', 'S', 'D')
+        mock_client.lists.members.all.return_value = {'members': [
+            {'id': member_hash('user{}@columbia.edu'.format(i)),
+             'status': 'subscribed',
+             'last_changed': '2020-01-01T00:00:00+00:00'}
+            for i in range(20)] + [
+            {'id': stale.email_hash, 'status': 'subscribed',
+             'last_changed': '2020-01-01T00:00:00+00:00'}]}
+        mock_client.batch_operations.create.return_value = {'id': 'b1'}
+        mock_client.batch_operations.get.return_value = {'status': 'pending'}
+        with tempfile.TemporaryDirectory() as tmp:
+            users_file = os.path.join(tmp, 'users.csv')
+            with open(users_file, 'w') as f:
+                f.writelines('user{}@columbia.edu,J,D\n'.format(i)
+                             for i in range(20))
+            clock = [0.0]
+
+            def sleep(seconds):
+                clock[0] += seconds
+
+            with patch('builtins.print') as mock_print, \
+                    patch('mailchimp_subscriber.time.monotonic',
+                          lambda: clock[0]), \
+                    patch('mailchimp_subscriber.time.sleep', sleep):
+                self.assertEqual(main(['--reconcile', 'tests/test.conf',
+                                       users_file, '--batch-timeout',
+                                       '12']), 1)
+        # polled at 0, 5, 10 and, last, at the deadline
+        self.assertEqual(mock_client.batch_operations.get.call_count, 4)
+        self.assertEqual(clock[0], 12)
+        mock_print.assert_called_with(
+            'Aborting: Mailchimp batch b1 still pending after 12s')
+
+
+class TestDiffUsers(unittest.TestCase):
+    def write(self, path, rows):
+        with open(path, 'w') as f:
+            f.write('\n'.join(rows) + '\n')
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read().splitlines()[1:]
+
+    @patch('mailchimp_subscriber.MailChimp')
+    def test_diff_users(self, mock_mail_chimp):
+        mock_client = mock_mail_chimp()
+
+        def member(email, status, first='J', last='D'):
+            return {'id': member_hash(email), 'status': status,
+                    'merge_fields': {'FNAME': first, 'LNAME': last},
+                    'last_changed': '2020-01-01T00:00:00+00:00'}
+
+        mock_client.lists.members.all.return_value = {'members': [
+            member('same@columbia.edu', 'subscribed'),
+            member('renamed@columbia.edu', 'subscribed'),
+            member('gone@columbia.edu', 'subscribed'),
+            member('unsub@columbia.edu', 'unsubscribed'),
+            member('stranger@columbia.edu', 'pending')]}
+        filler = ['user{}@columbia.edu,J,D'.format(i) for i in range(10)]
+        with tempfile.TemporaryDirectory() as tmp:
+            users_file = os.path.join(tmp, 'users.csv')
+            last_file = os.path.join(tmp, 'last.csv')
+            self.write(last_file, filler + [
+                'same@columbia.edu,J,D', 'renamed@columbia.edu,J,D',
+                'gone@columbia.edu,J,D', 'unsub@columbia.edu,J,D'])
+            self.write(users_file, filler + [
+                'same@columbia.edu,J,D', 'renamed@columbia.edu,Jo,D',
+                'unsub@columbia.edu,J,D', 'NEW@columbia.edu,N,D',
+                'renamed@columbia.edu,Joe,D'])
+            # runs of three rows, so every side is merged from disk
+            rows = list(sorted_user_rows(users_file, memory_limit=1536))
+            self.assertEqual([row[0] for row in rows],
+                             sorted(row[0] for row in rows))
+            self.assertEqual(len(rows), 14)
+
+            mirror = ListMirror(os.path.join(tmp, 'mirror.db'), '1234')
+            self.addCleanup(mirror.close)
+            mirror.sync(mock_client)
+            out_dir = os.path.join(tmp, 'diff')
+            counts = diff_users(users_file, last_file, mirror, out_dir,
+                                memory_limit=1536)
+            reports = {report: self.read(os.path.join(out_dir,
+                                                      report + '.csv'))
+                       for report in counts}
+            with patch('builtins.print') as mock_print:
+                main(['--diff', last_file, 'tests/test.conf', users_file,
+                      '--out', out_dir])
+            mock_print.assert_called_once_with(
+                'changed=1, drift=15, new=1, removed=1 written to ' +
+                out_dir)
+
+        renamed = member_hash('renamed@columbia.edu')
+        self.assertEqual(reports['new'], [
+            member_hash('new@columbia.edu') +
+            ',NEW@columbia.edu,N,D,,,not_present'])
+        self.assertEqual(reports['removed'], [
+            member_hash('gone@columbia.edu') +
+            ',gone@columbia.edu,J,D,,,subscribed'])
+        # the last appearance of an address wins
+        self.assertEqual(reports['changed'], [
+            renamed + ',renamed@columbia.edu,first_name,J,Joe'])
+        self.assertEqual(sorted(reports['drift']), sorted([
+            renamed + ',renamed@columbia.edu,FNAME,Joe,J',
+            member_hash('unsub@columbia.edu') +
+            ',unsub@columbia.edu,status,present,unsubscribed',
+            member_hash('stranger@columbia.edu') + ',,status,,pending',
+            member_hash('gone@columbia.edu') + ',,status,,subscribed'] +
+            [member_hash(address) + ',{},status,present,not_present'.format(
+                address) for address in
+             ['NEW@columbia.edu'] + [row.split(',')[0] for row in filler]]))
+        self.assertEqual(counts['drift'], 15)
+
+
+class TestMixedCaseAddresses(unittest.TestCase):
+    @patch('mailchimp_subscriber.MailChimp')
+    def test_modes_agree_on_mixed_case(self, mock_mail_chimp):
+        mock_client = mock_mail_chimp()
+        # Mailchimp ids members by the MD5 of the lowercased address
+        mock_client.lists.members.all.return_value = {'members': [
+            {'id': hashlib.md5(address.lower().encode()).hexdigest(),
+             'status': 'subscribed',
+             'merge_fields': {'FNAME': 'J', 'LNAME': 'D'},
+             'last_changed': '2020-01-01T00:00:00+00:00'}
+            for address in ('foo@bar.com', 'baz@bar.com')]}
+        with tempfile.TemporaryDirectory() as tmp:
+            users_file = os.path.join(tmp, 'users.csv')
+            with open(users_file, 'w') as f:
+                f.write('Foo@Bar.com,J,D\nBAZ@bar.com,J,D\n')
+            mirror = ListMirror(os.path.join(tmp, 'mirror.db'), '1234')
+            self.addCleanup(mirror.close)
+            mirror.sync(mock_client)
+
+            users = load_users(users_file)
+            table = ClientTable.from_csv(users_file)
+            for client in list(users.values()) + list(table.values()):
+                set_mailchimp_status(client, mock_client, '1234', mirror)
+                self.assertEqual(client.mailchimp_status, 'subscribed')
+            self.assertEqual(plan_archive(users_file, mirror), ([], 2))
+            counts = diff_users(users_file, users_file, mirror,
+                                os.path.join(tmp, 'diff'))
+        self.assertEqual(counts, {})
+        foo = users['Foo@Bar.com']
+        self.assertEqual(foo.email_hash, member_hash('foo@bar.com'))
+        self.assertIn('Foo@Bar.com',
+                      shard_users(users, foo.email_hash[0]))
+
+    @patch('mailchimp_subscriber.ProcessPoolExecutor', ThreadPoolExecutor)
+    def test_modes_agree_on_mixed_case_duplicates(self):
+        # one member to Mailchimp, so the last appearance wins everywhere
+        rows = ['Foo@columbia.edu,First,D', 'bar@columbia.edu,Bar,D',
+                'foo@columbia.edu,Second,D']
+        with tempfile.TemporaryDirectory() as tmp:
+            users_file = os.path.join(tmp, 'users.csv')
+            rejects_file = os.path.join(tmp, 'rejects.csv')
+            with open(users_file, 'w') as f:
+                f.write('\n'.join(rows) + '\n')
+            users = load_users(users_file)
+            modes = {
+                'load_users': users.values(),
+                'ClientTable': ClientTable.from_csv(users_file).values(),
+                'stream_unique_clients': stream_unique_clients(users_file),
+                'external_dedup': external_dedup(users_file, tmp_dir=tmp),
+                'external_dedup split': external_dedup(
+                    users_file, memory_limit=64, tmp_dir=tmp)}
+            for mode, clients in modes.items():
+                self.assertEqual(
+                    sorted((client.email_address, client.first_name)
+                           for client in clients),
+                    [('bar@columbia.edu', 'Bar'),
+                     ('foo@columbia.edu', 'Second')], mode)
+            self.assertEqual([row[2] for row in sorted_user_rows(users_file)
+                              if row[1] == 'foo@columbia.edu'], ['Second'])
+            stats = validate_users(users_file, rejects_file, workers=2,
+                                   chunk_size=16)
+            with open(rejects_file) as f:
+                rejects = f.read().splitlines()[1:]
+        self.assertEqual(stats['accepted'], 2)
+        self.assertEqual(rejects, [
+            '1,duplicate of line 3,Foo@columbia.edu,First,D'])